@@ -12,13 +12,15 @@ import uuid
 import queue
 import shutil
 import signal
+import socket
 import tempfile
 import threading
 import contextlib
 import subprocess
+import collections
 from datetime import datetime
 from flask_socketio import SocketIO, emit
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, Response, render_template, request, jsonify, session
 
 
 # Add current directory to path for imports
@@ -27,15 +29,37 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 # Try to import Noobie interpreter
 try:
     from func import *
-    from noobie02 import NoobieInterpreter
+    from noobie02 import NoobieInterpreter, ExecutionControl, ExecutionStopped, RunJournal, IncrementalValidator, validate
 except ImportError as e:
     print(f"Error importing Noobie modules: {e}")
     print("Make sure noobie02.py and func.py are in the same directory")
     # For development without the files, create a simple stub
+    class ExecutionControl:
+        # The stub cannot interrupt a run
+        cancelled = paused = False
+        def stop(self): pass
+        def pause(self): pass
+        def resume(self): pass
+        def clear(self): pass
+
+    class ExecutionStopped(Exception):
+        pass
+
+    # The stub keeps no checkpoints, every run starts from line 1
+    RunJournal = None
+
     class NoobieInterpreter:
-        def __init__(self):
+        def __init__(self, output=None, error_output=None, input_provider=None, control=None):
+            self.variables = {}
+            self.output = output
+            self.input_provider = input_provider or input
+            
+        def reset(self):
             self.variables = {}
             
+        def load_variables(self, variables):
+            self.variables = dict(variables)
+            
         def _process_line(self, line, line_num):
             # Simple stub implementation
             line = line.strip()
@@ -50,10 +74,19 @@ except ImportError as e:
                 if len(parts) >= 3:
                     var_name = parts[2]
                     prompt = ' '.join(parts[3:]).strip('"\'')
-                    value = input(prompt)
+                    value = self.input_provider(prompt)
                     self.variables[var_name] = value
             else:
-                print(f"Command not implemented in stub: {line}")
+                print(f"Command not implemented in stub: {line}", file=self.output)
+                
+        def take_statement(self, line, index=0):
+            # The stub has no blocks, every line runs on its own
+            return [line.strip()], index
+            
+        def _run(self, lines, line_offset=0):
+            for i, line in enumerate(lines):
+                if line:
+                    self._process_line(line, line_offset + i + 1)
                 
         def interpret(self, code):
             lines = code.split('\n')
@@ -61,71 +94,290 @@ except ImportError as e:
                 if line.strip():
                     self._process_line(line, i + 1)
 
+    def validate(code, warnings=None):
+        # The stub cannot check programs statically
+        return []
+
+    # Nor can it give the editor diagnostics
+    IncrementalValidator = None
+
+try:
+    from workers import ProcessWorkerPool, run_job
+except ImportError:
+    ProcessWorkerPool = run_job = None
+
+try:
+    from cache import ResultCache, result_key, is_deterministic
+except ImportError:
+    ResultCache = None
+
+from wire import EVENT_CODES, encode_event
+from registry import create_registry
+from metrics import MetricRegistry, CONTENT_TYPE as METRICS_CONTENT_TYPE
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'noobie-secret-key-2024')
-socketio = SocketIO(app, cors_allowed_origins="*")
+
+# Multi-process deployments share a message queue (e.g. redis://host:6379/0)
+# so an emit from any process reaches the client wherever it is connected
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE') or None
+socketio = SocketIO(app, cors_allowed_origins="*", message_queue=SOCKETIO_MESSAGE_QUEUE)
+
+# Long-polling needs every request of a session on the same process; behind a
+# load balancer without sticky sessions, clients are told to use websockets only
+SOCKETIO_TRANSPORTS = os.environ.get(
+    'SOCKETIO_TRANSPORTS', 'websocket' if SOCKETIO_MESSAGE_QUEUE else 'polling,websocket'
+).split(',')
+
+# Identifies this process in the session registry
+NODE_ID = os.environ.get('NODE_ID') or f"{socket.gethostname()}:{os.getpid()}"
 
 # Global storage for active sessions
 session_inputs = {}
 active_sessions = {}
-session_threads = {}
 session_interpreters = {}
+# Sessions that negotiated the compact binary encoding
+session_encodings = {}
+# session_id -> socket id and time of the last client event, for the reaper
+session_sids = {}
+session_activity = {}
+# session_id -> RunJournal of its last finished run
+session_journals = {}
+# session_id -> (version, IncrementalValidator) of the document open in the editor
+session_documents = {}
+
+
+def send_event(session_id, event, data=None, callback=None):
+    """Emit an event to a session in the encoding it negotiated"""
+    data = data or {}
+    if session_encodings.get(session_id) == 'compact' and event in EVENT_CODES:
+        socketio.emit('frame', encode_event(event, data), room=session_id, callback=callback)
+        return
+    data['timestamp'] = datetime.now().isoformat()
+    socketio.emit(event, data, room=session_id, callback=callback)
+
+
+# Metrics served by /api/metrics; rates (e.g. statements per second) are
+# derived from the counters by the scraper
+metrics = MetricRegistry()
+CONNECTIONS = metrics.counter('noobie_connections_total', 'Client connections accepted')
+SESSIONS_REAPED = metrics.counter('noobie_sessions_reaped_total', 'Sessions evicted by the reaper', ('reason',))
+SESSIONS_PAGED = metrics.counter('noobie_sessions_paged_total', 'Idle sessions swapped to disk and back',
+                                 ('direction',))
+EXECUTION_SECONDS = metrics.histogram('noobie_execution_duration_seconds',
+                                      'Time programs spent executing, excluding waits at LISTEN')
+QUEUE_WAIT_SECONDS = metrics.histogram('noobie_execution_queue_wait_seconds',
+                                       'Time jobs waited for a free execution worker')
+STATEMENTS = metrics.counter('noobie_statements_executed_total', 'Statements executed by programs')
+STATEMENTS_SKIPPED = metrics.counter('noobie_statements_skipped_total',
+                                     'Statements skipped by resuming an edited program from a checkpoint')
+OUTPUT_BYTES = metrics.counter('noobie_output_bytes_total', 'Program output sent to clients', ('stream',))
+OUTPUT_FRAMES = metrics.counter('noobie_output_frames_total', 'Output frames emitted', ('stream',))
+OUTPUT_DROPPED_BYTES = metrics.counter('noobie_output_dropped_bytes_total', 'Program output dropped by the output limit')
+LISTEN_WAITS = metrics.counter('noobie_listen_waits_total', 'LISTEN prompts answered by clients')
+LISTEN_WAIT_SECONDS = metrics.histogram('noobie_listen_wait_seconds', 'Time programs waited for LISTEN input',
+                                        buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900))
+ERRORS = metrics.counter('noobie_errors_total', 'Errors by type', ('type',))
+POOL_ACQUIRES = metrics.counter('noobie_interpreter_pool_acquires_total',
+                                'Interpreter checkouts, reused from the pool or newly created', ('result',))
+RESULT_CACHE_LOOKUPS = metrics.counter('noobie_result_cache_lookups_total',
+                                      'Result cache lookups for deterministic programs', ('result',))
+BLOCK_CACHE_LOOKUPS = metrics.counter('noobie_block_cache_lookups_total',
+                                      'IF/WHILE block structure lookups by cache result', ('result',))
+
+
+def record_run_stats(stats):
+    """Add an interpreter's run_stats() to the server metrics"""
+    STATEMENTS.inc(stats['statements'])
+    STATEMENTS_SKIPPED.inc(stats.get('statements_skipped', 0))
+    if stats['errors']:
+        ERRORS.labels('program').inc(stats['errors'])
+    BLOCK_CACHE_LOOKUPS.labels('hit').inc(stats['block_cache_hits'])
+    BLOCK_CACHE_LOOKUPS.labels('miss').inc(stats['block_cache_misses'])
+
+
+# Output is coalesced into frames of whole lines, emitted at most once per
+# window unless the frame grows past the size limit
+OUTPUT_FRAME_WINDOW = int(os.environ.get('OUTPUT_FRAME_MS', 30)) / 1000
+OUTPUT_FRAME_MAX_BYTES = int(os.environ.get('OUTPUT_FRAME_MAX_BYTES', 16 * 1024))
+
+# Per-run output limits: after OUTPUT_LIMIT_BYTES only the last OUTPUT_TAIL_BYTES
+# are kept, and a writer waits while more than OUTPUT_MAX_IN_FLIGHT frames are
+# still unacknowledged by the client
+OUTPUT_LIMIT_BYTES = int(os.environ.get('OUTPUT_LIMIT_BYTES', 1024 * 1024))
+OUTPUT_TAIL_BYTES = int(os.environ.get('OUTPUT_TAIL_BYTES', 64 * 1024))
+OUTPUT_MAX_IN_FLIGHT = int(os.environ.get('OUTPUT_MAX_IN_FLIGHT', 8))
+OUTPUT_ACK_TIMEOUT = 2.0
+
+# Bytes of variable values and buffered output one run may hold before it is
+# aborted with an error; also the cap for /api/run jobs, 0 disables
+RUN_MEMORY_LIMIT = int(os.environ.get('RUN_MEMORY_LIMIT', 16 * 1024 * 1024))
+
+# REPL pieces one session may have waiting behind the one running; lines past
+# it are rejected, 0 disables
+REPL_MAX_QUEUED_PIECES = int(os.environ.get('REPL_MAX_QUEUED_PIECES', 64))
 
 
 class WebOutputCapture:
-    """Capture output for web display with proper line handling"""
+    """Capture output for web display, coalescing lines into timed frames"""
     def __init__(self, session_id, output_type='stdout'):
         self.session_id = session_id
         self.output_type = output_type
-        self.buffer = ""
         self.line_buffer = ""  # Buffer per accumulate testo sulla stessa riga
+        self.partner = None  # capture of the other stream, flushed first to keep ordering
+        self.lock = threading.RLock()
+        self.frame_lines = []
+        self.frame_bytes = 0
+        self.frame_started = 0.0
+        self.flush_scheduled = False
+        self.recording = None  # [output type, lines] of every frame sent, for the result cache
+        self.start_run()
+        
+    def reset(self, session_id):
+        """Prepare the capture for reuse by another session"""
+        with self.lock:
+            self.session_id = session_id
+            self.line_buffer = ""
+            self.frame_lines = []
+            self.frame_bytes = 0
+            self.recording = None
+            self.start_run()
+            
+    def start_run(self):
+        """Reset the per-run output accounting"""
+        self.sent_bytes = 0
+        self.truncated = False
+        self.tail = collections.deque()  # most recent lines once truncated
+        self.tail_bytes = 0
+        self.dropped_bytes = 0
+        self.in_flight = 0  # frames not yet acknowledged by the client
+        self.acks_enabled = True
+        
+    def buffered_bytes(self):
+        """Approximate size of output held in memory"""
+        return len(self.line_buffer) + self.frame_bytes + self.tail_bytes
         
     def write(self, text):
         if not text:
             return
             
-        # Aggiungi il testo al buffer di riga
-        self.line_buffer += text
-        
-        # Se il testo contiene newline, invia tutto quello che c'è prima del newline
-        if '\n' in text:
-            # Dividi il buffer in righe
-            lines = self.line_buffer.split('\n')
+        with self.lock:
+            # Aggiungi il testo al buffer di riga
+            self.line_buffer += text
             
-            # Invia tutte le righe complete (tutte tranne l'ultima)
-            for line in lines[:-1]:
-                if line or self.line_buffer.endswith('\n'):  # Invia anche righe vuote se esplicite
-                    socketio.emit('output', {
-                        'type': self.output_type,
-                        'text': line,
-                        'timestamp': datetime.now().isoformat()
-                    }, room=self.session_id)
+            # Le righe complete entrano nel frame corrente, l'ultima parte resta nel buffer
+            if '\n' in text:
+                lines = self.line_buffer.split('\n')
+                for line in lines[:-1]:
+                    if line or self.line_buffer.endswith('\n'):  # Invia anche righe vuote se esplicite
+                        self._add_line(line)
+                self.line_buffer = lines[-1]
+                
+            # A line that never ends is split rather than buffered forever
+            if len(self.line_buffer) >= OUTPUT_FRAME_MAX_BYTES:
+                self._add_line(self.line_buffer)
+                self.line_buffer = ""
+                
+            if self.frame_lines:
+                if (self.frame_bytes >= OUTPUT_FRAME_MAX_BYTES or
+                        time.monotonic() - self.frame_started >= OUTPUT_FRAME_WINDOW):
+                    self.emit_frame()
+                elif not self.flush_scheduled:
+                    # Make sure a quiet program still gets its lines out
+                    self.flush_scheduled = True
+                    socketio.start_background_task(self._flush_later)
+                    
+    def _add_line(self, line):
+        size = len(line) + 1
+        if self.truncated or self.sent_bytes + self.frame_bytes + size > OUTPUT_LIMIT_BYTES:
+            self._retain(line, size)
+            return
             
-            # Mantieni l'ultima parte (dopo l'ultimo newline) nel buffer
-            self.line_buffer = lines[-1]
+        if not self.frame_lines:
+            if self.partner is not None:
+                self.partner.emit_frame()
+            self.frame_started = time.monotonic()
+        self.frame_lines.append(line)
+        self.frame_bytes += size
         
-        # Se non c'è newline, il testo rimane nel buffer e verrà inviato
-        # quando arriverà il prossimo newline o alla fine dell'esecuzione
+    def _retain(self, line, size):
+        """Keep only the most recent output once the run is over its limit"""
+        self.truncated = True
+        if size > OUTPUT_TAIL_BYTES:
+            self.dropped_bytes += size - OUTPUT_TAIL_BYTES
+            line = line[-(OUTPUT_TAIL_BYTES - 1):]
+            size = OUTPUT_TAIL_BYTES
+        self.tail.append(line)
+        self.tail_bytes += size
+        while self.tail_bytes > OUTPUT_TAIL_BYTES:
+            dropped = len(self.tail.popleft()) + 1
+            self.tail_bytes -= dropped
+            self.dropped_bytes += dropped
+            
+    def _wait_for_client(self):
+        """Backpressure: hold the writer while the client is behind on frames"""
+        deadline = time.monotonic() + OUTPUT_ACK_TIMEOUT
+        while self.acks_enabled and self.in_flight > OUTPUT_MAX_IN_FLIGHT:
+            if time.monotonic() > deadline:
+                # The client does not acknowledge frames; rely on the output limit
+                self.acks_enabled = False
+                break
+            socketio.sleep(0.005)
+            
+    def _frame_acked(self, *args):
+        self.in_flight = max(0, self.in_flight - 1)
         
+    def _flush_later(self):
+        socketio.sleep(OUTPUT_FRAME_WINDOW)
+        with self.lock:
+            self.flush_scheduled = False
+            self.emit_frame()
+            
+    def emit_frame(self):
+        """Send all pending complete lines as a single output frame"""
+        with self.lock:
+            if not self.frame_lines:
+                return
+            lines = self.frame_lines
+            self.sent_bytes += self.frame_bytes
+            OUTPUT_BYTES.labels(self.output_type).inc(self.frame_bytes)
+            self.frame_lines = []
+            self.frame_bytes = 0
+            self._send_lines(self.output_type, lines)
+            
+    def _send_lines(self, output_type, lines):
+        self._wait_for_client()
+        self.in_flight += 1
+        OUTPUT_FRAMES.labels(output_type).inc()
+        if self.recording is not None:
+            self.recording.append([output_type, lines])
+        send_event(self.session_id, 'output', {
+            'type': output_type,
+            'lines': lines
+        }, callback=self._frame_acked)
+            
     def flush(self):
         # Invia qualsiasi contenuto rimanente nel buffer
-        if self.line_buffer:
-            socketio.emit('output', {
-                'type': self.output_type,
-                'text': self.line_buffer,
-                'timestamp': datetime.now().isoformat()
-            }, room=self.session_id)
-            self.line_buffer = ""
+        with self.lock:
+            if self.line_buffer:
+                self._add_line(self.line_buffer)
+                self.line_buffer = ""
+            self.emit_frame()
             
     def flush_line(self):
         """Forza l'invio della riga corrente (utile per input prompt)"""
-        if self.line_buffer:
-            socketio.emit('output', {
-                'type': self.output_type,
-                'text': self.line_buffer,
-                'timestamp': datetime.now().isoformat()
-            }, room=self.session_id)
-            self.line_buffer = ""
+        self.flush()
+        
+    def finish(self):
+        """Flush at the end of a run, reporting truncated output once"""
+        with self.lock:
+            self.flush()
+            if self.truncated:
+                OUTPUT_DROPPED_BYTES.inc(self.dropped_bytes)
+                self._send_lines('warning', [f"output truncated, {self.dropped_bytes} bytes dropped"])
+                if self.tail:
+                    self._send_lines(self.output_type, list(self.tail))
+            self.start_run()
 
 
 class WebInputHandler:
@@ -135,24 +387,45 @@ class WebInputHandler:
         self.input_queue = queue.Queue()
         self.waiting_for_input = False
         
+    def reset(self, session_id):
+        """Prepare the handler for reuse, dropping any unread input"""
+        self.session_id = session_id
+        self.waiting_for_input = False
+        while True:
+            try:
+                self.input_queue.get_nowait()
+            except queue.Empty:
+                break
+        
     def get_input(self, prompt=''):
         """Get input from web interface"""
         # Send input request to frontend
-        socketio.emit('input_request', {
-            'prompt': prompt,
-            'timestamp': datetime.now().isoformat()
-        }, room=self.session_id)
+        send_event(self.session_id, 'input_request', {
+            'prompt': prompt
+        })
         
         self.waiting_for_input = True
+        started = time.monotonic()
         
         # Wait for input response
         try:
             result = self.input_queue.get(timeout=300)  # 5 minute timeout
-            return result
+            return "" if result is None else result
         except queue.Empty:
             return ""
         finally:
             self.waiting_for_input = False
+            LISTEN_WAITS.inc()
+            LISTEN_WAIT_SECONDS.observe(time.monotonic() - started)
+            
+    def pending_bytes(self):
+        """Size of input queued but not yet read"""
+        return sum(len(text) for text in list(self.input_queue.queue) if text)
+        
+    def cancel(self):
+        """Release a pending input wait because the run was stopped"""
+        if self.waiting_for_input:
+            self.input_queue.put(None)
             
     def provide_input(self, input_text):
         """Provide input from web interface"""
@@ -166,139 +439,936 @@ class NoobieWebInterpreter:
     """Web-adapted Noobie interpreter"""
     def __init__(self, session_id):
         self.session_id = session_id
-        self.interpreter = NoobieInterpreter()
         self.output_capture = WebOutputCapture(session_id)
         self.error_capture = WebOutputCapture(session_id, 'stderr')
         self.input_handler = WebInputHandler(session_id)
+        self.control = ExecutionControl()
+        self.interpreter = NoobieInterpreter(
+            output=self.output_capture,
+            error_output=self.error_capture,
+            input_provider=self.request_input,
+            control=self.control,
+        )
+        # Lines, and programs on the thread backend, run on the server's event loop
+        self.interpreter.cooperative = True
+        self.interpreter.memory_limit = RUN_MEMORY_LIMIT or None
         self.running = False
         self.paused = False
+        self.busy = False  # a worker thread is using this instance
+        self.retired = False  # return to the pool once the current run ends
+        self.suspended = None  # (prompt, state) of a run parked at LISTEN
+        self.suspended_at = 0.0
+        self.run_time = 0.0  # seconds spent executing the current run
+        self.cache_key = None  # result cache key of a deterministic run
+        self.journal = None  # RunJournal of the finished run, kept for the session's next one
+        # execute_line pieces waiting to run, and whether a job is running them
+        self.repl_lock = threading.Lock()
+        self.repl_pieces = collections.deque()
+        self.repl_draining = False
         
         # Collegamento per permettere al input handler di accedere all'output capture
         self.input_handler.output_capture = self.output_capture
+        self.output_capture.partner = self.error_capture
+        self.error_capture.partner = self.output_capture
         
-    def setup_io_redirection(self):
-        """Setup input/output redirection"""
-        # Store original handlers
-        self.original_stdout = sys.stdout
-        self.original_stderr = sys.stderr
-        self.original_input = __builtins__['input'] if isinstance(__builtins__, dict) else __builtins__.input
-        
-        # Redirect to web handlers
-        sys.stdout = self.output_capture
-        sys.stderr = self.error_capture
-        
-        # Custom input function
-        def web_input(prompt=''):
-            # Flush any pending output before showing input prompt
-            self.output_capture.flush_line()
-            return self.input_handler.get_input(prompt)
-            
-        if isinstance(__builtins__, dict):
-            __builtins__['input'] = web_input
-        else:
-            __builtins__.input = web_input
-            
-    def restore_io(self):
-        """Restore original input/output"""
-        sys.stdout = self.original_stdout
-        sys.stderr = self.original_stderr
+    def reset(self, session_id):
+        """Cheaply return to a clean state for a new session or execution"""
+        self.session_id = session_id
+        self.interpreter.reset()
+        self.output_capture.reset(session_id)
+        self.error_capture.reset(session_id)
+        self.input_handler.reset(session_id)
+        self.control.clear()
+        self.running = False
+        self.paused = False
+        self.busy = False
+        self.retired = False
+        self.suspended = None
+        self.cache_key = None
+        self.journal = None
+        self.repl_pieces.clear()
+        self.repl_draining = False
         
-        if isinstance(__builtins__, dict):
-            __builtins__['input'] = self.original_input
-        else:
-            __builtins__.input = self.original_input
-            
-    def execute_line(self, line):
-        """Execute a single line of code"""
-        if not line.strip() or line.strip().startswith('#'):
+    def queue_line(self, line):
+        """Take a line typed into the REPL; return True when a job must be scheduled to run it.
+        
+        Lines inside an IF/WHILE block are only buffered until its ENDO
+        arrives; the complete block then runs as one piece, in order after
+        any piece still running.
+        """
+        with self.repl_lock:
+            piece = self.interpreter.take_statement(line)
+            if piece is None:
+                send_event(self.session_id, 'line_executed', {
+                    'line': line,
+                    'success': True,
+                    'pending': True
+                })
+                return False
+            self.repl_pieces.append((line, piece))
+            if self.repl_draining:
+                return False
+            # A stop applies to the batch it interrupted, not to lines typed after it drained
+            self.control.clear()
+            self.repl_draining = True
             return True
             
-        try:
-            # Setup IO redirection
-            self.setup_io_redirection()
+    def drop_lines(self):
+        """Forget queued REPL pieces, e.g. when their job was rejected"""
+        with self.repl_lock:
+            self.repl_pieces.clear()
+            self.repl_draining = False
             
-            # Execute the line using the process_line method
-            self.interpreter._process_line(line.strip(), 1)
+    def drain_lines(self):
+        """Run queued REPL pieces until none are left, dropping those queued behind a stop"""
+        while True:
+            with self.repl_lock:
+                if not self.repl_pieces:
+                    self.repl_draining = False
+                    return
+                line, piece = self.repl_pieces.popleft()
+                stopped = self.control.cancelled
+            if stopped:
+                send_event(self.session_id, 'line_executed', {
+                    'line': line,
+                    'success': False,
+                    'error': 'execution stopped'
+                })
+                continue
+            self.execute_line(line, piece)
             
-            # IMPORTANTE: Flush l'output per assicurarsi che tutto sia inviato
-            self.output_capture.flush()
-            self.error_capture.flush()
+    def execute_line(self, line, piece):
+        """Run one REPL piece, a statement or a complete block, keeping the session's variables"""
+        error = None
+        try:
+            self.interpreter._run(*piece)
+        except SystemExit:
+            pass
+        except ExecutionStopped:
+            error = 'execution stopped'
+        except Exception as e:
+            ERRORS.labels('line').inc()
+            error = str(e)
+            lines = piece[0]
+            if len(lines) > 1 and getattr(e, 'line_number', None):
+                error += f" (line {e.line_number} of the block)"
             
-            # Send success signal
-            socketio.emit('line_executed', {
+        # IMPORTANTE: Flush l'output per assicurarsi che tutto sia inviato
+        self.output_capture.finish()
+        self.error_capture.finish()
+        
+        if error is None:
+            send_event(self.session_id, 'line_executed', {
                 'line': line,
-                'success': True,
-                'timestamp': datetime.now().isoformat()
-            }, room=self.session_id)
-            
+                'success': True
+            })
             return True
             
-        except Exception as e:
-            # Send error
-            socketio.emit('line_executed', {
-                'line': line,
-                'success': False,
-                'error': str(e),
-                'timestamp': datetime.now().isoformat()
-            }, room=self.session_id)
+        send_event(self.session_id, 'line_executed', {
+            'line': line,
+            'success': False,
+            'error': error
+        })
+        send_event(self.session_id, 'output', {
+            'type': 'error',
+            'text': f"Error: {error}\n"
+        })
+        return False
             
-            socketio.emit('output', {
-                'type': 'error',
-                'text': f"Error: {str(e)}\n",
-                'timestamp': datetime.now().isoformat()
-            }, room=self.session_id)
+    def memory_usage(self):
+        """Approximate bytes held for this session: variables, buffered output and pending input"""
+        variables = sum(sys.getsizeof(name) + sys.getsizeof(var.value)
+                        for name, var in list(self.interpreter.variables.items()))
+        # Program text held for a suspended run, in the interpreter or in a captured state
+        suspended = self.suspended
+        lines = suspended[1]['lines'] if suspended is not None and suspended[1] is not None else self.interpreter.lines
+        lines = list(lines) + self.interpreter.open_block
+        # REPL pieces waiting to run
+        with self.repl_lock:
+            for _, (piece_lines, _) in self.repl_pieces:
+                lines += piece_lines
+        journal = session_journals.get(self.session_id)
+        return (variables + sum(len(line) for line in lines)
+                + (journal.output_size if journal is not None else 0)
+                + self.output_capture.buffered_bytes() + self.error_capture.buffered_bytes()
+                + self.input_handler.pending_bytes())
+        
+    def stop(self):
+        """Stop the current or queued run at its next checkpoint"""
+        self.running = False
+        self.paused = False
+        self.control.stop()
+        self.input_handler.cancel()
+        with self.repl_lock:
+            self.repl_pieces.clear()
+        if self.suspended is not None:
+            # Nothing is executing; end the parked run here
+            self.suspended = None
+            self._end_run()
+        
+    def pause(self):
+        """Park the current run at its next checkpoint"""
+        self.paused = True
+        self.control.pause()
+        
+    def resume(self):
+        self.paused = False
+        self.control.resume()
+        
+    def write_output(self, output_type, text):
+        """Route program output to this session's captures"""
+        capture = self.error_capture if output_type == 'stderr' else self.output_capture
+        capture.write(text)
+        
+    def request_input(self, prompt):
+        """Answer a LISTEN by asking this session's client"""
+        self.error_capture.flush()
+        self.output_capture.flush_line()
+        return self.input_handler.get_input(prompt)
+        
+    def execute_code(self, code, cache_key=None):
+        """Execute full code with real-time execution, recording it under cache_key if set"""
+        self.running = True
+        self.run_time = 0.0
+        self.cache_key = cache_key
+        if cache_key is not None:
+            # Both streams share one recording so their interleaving is kept
+            self.output_capture.recording = self.error_capture.recording = []
+        
+        # Send execution started signal
+        send_event(self.session_id, 'execution_started')
+        self._advance(code=code)
+        
+    def resume_with_input(self, suspended, text):
+        """Continue a run parked at LISTEN, on whichever worker picked up the job"""
+        self._advance(suspended=suspended, text=text)
+        
+    def _advance(self, code=None, suspended=None, text=None):
+        """Run until the program ends or parks at its next LISTEN"""
+        started = time.monotonic()
+        try:
+            if process_workers is not None:
+                # Run out of process; keep the final variables for execute_line
+                try:
+                    if code is not None:
+                        previous = session_journals.get(self.session_id)
+                        variables, suspended, stats, journal = process_workers.run(
+                            code, self.write_output, self.control,
+                            journal=previous.to_dict() if previous is not None else None,
+                            journal_limit=CHECKPOINT_OUTPUT_BYTES or None)
+                    else:
+                        variables, suspended, stats, journal = process_workers.resume(
+                            suspended[1], text, self.write_output, self.control)
+                except NoobieError:
+                    ERRORS.labels('worker').inc()
+                    raise
+                record_run_stats(stats)
+                # Variables the program deleted must go as well
+                self.interpreter.load_variables(variables)
+                self.journal = RunJournal.from_dict(journal) if journal else None
+            else:
+                # The suspended state stays inside this session's interpreter
+                before = self.interpreter.run_stats()
+                try:
+                    if code is not None:
+                        self.interpreter.journal_limit = CHECKPOINT_OUTPUT_BYTES or None
+                        prompt = self.interpreter.start(code, session_journals.get(self.session_id))
+                    else:
+                        prompt = self.interpreter.resume(text)
+                except SystemExit:
+                    # EXIT or a reported program error ends the run normally
+                    prompt = None
+                after = self.interpreter.run_stats()
+                record_run_stats({key: after[key] - before[key] for key in after})
+                suspended = (prompt, None) if prompt is not None else None
+                if suspended is None:
+                    self.journal = self.interpreter.journal
             
-            return False
+        except Exception as e:
+            suspended = None
+            self.cache_key = None
+            ERRORS.labels('execution').inc()
+            send_event(self.session_id, 'output', {
+                'type': 'error',
+                'text': f"Execution error: {str(e)}\n"
+            })
             
         finally:
-            # Restore IO
-            self.restore_io()
+            self.run_time += time.monotonic() - started
+            if suspended is not None and self.running:
+                # Parked at LISTEN: no thread or worker is held until the answer arrives
+                self.suspended = suspended
+                self.suspended_at = time.monotonic()
+                self.error_capture.flush()
+                self.output_capture.flush_line()
+                send_event(self.session_id, 'input_request', {
+                    'prompt': suspended[0]
+                })
+            else:
+                self._end_run()
+                
+    def _end_run(self):
+        EXECUTION_SECONDS.observe(self.run_time)
+        self.running = False
+        # IMPORTANTE: Flush tutto l'output alla fine
+        self.output_capture.finish()
+        self.error_capture.finish()
+        if self.cache_key is not None and not self.control.cancelled:
+            result_cache.put(self.cache_key, {
+                'frames': self.output_capture.recording,
+                'variables': encode_variables(self.interpreter.variables),
+            })
+        self.cache_key = None
+        self.output_capture.recording = self.error_capture.recording = None
+        # The next run of an edited program resumes from this one's checkpoints
+        if self.journal is not None and self.session_id in active_sessions:
+            session_journals[self.session_id] = self.journal
+        self.journal = self.interpreter.journal = None
+        send_event(self.session_id, 'execution_finished')
+        
+    def pageable(self):
+        """True when nothing is executing or queued, so the session can be swapped out"""
+        return (not self.busy and not self.paused and not self.repl_draining and not self.repl_pieces
+                and (not self.running or self.suspended is not None)
+                and not self.input_handler.waiting_for_input and not self.output_capture.in_flight)
+        
+    def snapshot(self):
+        """Serialize the session's state for SessionPager, see NoobieInterpreter.snapshot()"""
+        journal = session_journals.get(self.session_id)
+        suspended = self.suspended
+        return self.interpreter.snapshot({
+            'running': self.running,
+            'suspended': list(suspended) if suspended is not None else None,
+            'suspended_for': time.monotonic() - self.suspended_at if suspended is not None else 0.0,
+            'run_time': self.run_time,
+            'journal': journal.to_dict() if journal is not None else None,
+        })
+        
+    def restore(self, data):
+        """Take over a session from its snapshot(); the instance must be freshly reset"""
+        extra = self.interpreter.restore(data)
+        self.running = extra['running']
+        if extra['suspended'] is not None:
+            self.suspended = tuple(extra['suspended'])
+            self.suspended_at = time.monotonic() - extra['suspended_for']
+        self.run_time = extra['run_time']
+        if extra['journal'] is not None:
+            session_journals[self.session_id] = RunJournal.from_dict(extra['journal'])
+        
+    def replay(self, cached):
+        """Send the events of a cached run again instead of executing it"""
+        send_event(self.session_id, 'execution_started')
+        for output_type, lines in cached['frames']:
+            self.output_capture._send_lines(output_type, lines)
+        self.interpreter.load_variables(decode_variables(cached['variables']))
+        send_event(self.session_id, 'execution_finished')
+
+
+class InterpreterPool:
+    """Pool of pre-built web interpreters checked out per session and execution"""
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle = [NoobieWebInterpreter(None) for _ in range(size)]
+        self.created = size
+        self.reused = 0
+        self.in_use = 0
+        
+    def acquire(self, session_id):
+        """Check out a clean interpreter, building one only if the pool is empty"""
+        with self.lock:
+            interpreter = self.idle.pop() if self.idle else None
+            if interpreter is None:
+                self.created += 1
+                POOL_ACQUIRES.labels('created').inc()
+            else:
+                self.reused += 1
+                POOL_ACQUIRES.labels('reused').inc()
+            self.in_use += 1
             
-    def execute_code(self, code):
-        """Execute full code with real-time execution"""
-        self.running = True
+        if interpreter is None:
+            return NoobieWebInterpreter(session_id)
+        interpreter.reset(session_id)
+        return interpreter
         
-        try:
-            # Setup IO redirection
-            self.setup_io_redirection()
+    def release(self, interpreter):
+        """Return an interpreter; one still executing is returned when its run ends"""
+        with self.lock:
+            if interpreter.busy:
+                interpreter.retired = True
+                return
+            self._put_back(interpreter)
+            
+    def run_finished(self, interpreter):
+        """Called by the worker thread when it stops using an interpreter"""
+        with self.lock:
+            interpreter.busy = False
+            if interpreter.retired:
+                self._put_back(interpreter)
+                
+    def _put_back(self, interpreter):
+        self.in_use -= 1
+        if len(self.idle) < self.size:
+            self.idle.append(interpreter)
             
-            # Send execution started signal
-            socketio.emit('execution_started', {
-                'timestamp': datetime.now().isoformat()
-            }, room=self.session_id)
+    def stats(self):
+        """Pool size metrics"""
+        with self.lock:
+            return {
+                'size': self.size,
+                'idle': len(self.idle),
+                'in_use': self.in_use,
+                'created': self.created,
+                'reused': self.reused,
+            }
+
+
+class ExecutionScheduler:
+    """Fixed-size worker pool with a bounded queue and per-session admission control"""
+    def __init__(self, workers, queue_size, rate, burst):
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.rate = rate  # runs per second refilled into each session's bucket
+        self.burst = burst
+        self.buckets = {}  # session_id -> [tokens, last refill time]
+        self.active = collections.Counter()  # session -> queued or executing jobs
+        self.running = 0
+        self.rejected = 0
+        self.workers = []
+        for _ in range(workers):
+            worker = threading.Thread(target=self._worker, daemon=True)
+            worker.start()
+            self.workers.append(worker)
             
-            # Execute the entire code using the original interpreter
-            self.interpreter.interpret(code)
+    def _take_token(self, session_id):
+        now = time.monotonic()
+        tokens, last = self.buckets.get(session_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self.buckets[session_id] = [tokens, now]
+            return False
+        self.buckets[session_id] = [tokens - 1, now]
+        return True
+        
+    def submit(self, session_id, job, admission=True):
+        """Queue a job; return None when accepted or the reason it was rejected.
+        
+        Continuations of an already admitted run skip the admission checks.
+        """
+        with self.lock:
+            if admission and self.active[session_id]:
+                reason = 'a run is already active for this session'
+            elif admission and not self._take_token(session_id):
+                reason = 'rate limited: too many runs, slow down'
+            else:
+                try:
+                    self.jobs.put_nowait((session_id, job, time.monotonic()))
+                    self.active[session_id] += 1
+                    return None
+                except queue.Full:
+                    reason = 'server busy'
+            self.rejected += 1
+            return reason
             
-            # IMPORTANTE: Flush tutto l'output alla fine
-            self.output_capture.flush()
-            self.error_capture.flush()
+    def position(self):
+        """Number of queued jobs that cannot start on an idle worker right away"""
+        with self.lock:
+            idle_workers = len(self.workers) - self.running
+        return max(0, self.jobs.qsize() - idle_workers)
+        
+    def _worker(self):
+        while True:
+            session_id, job, submitted = self.jobs.get()
+            QUEUE_WAIT_SECONDS.observe(time.monotonic() - submitted)
+            with self.lock:
+                self.running += 1
+            try:
+                job()
+            except (Exception, SystemExit) as e:
+                print(f"Worker error in session {session_id}: {e}")
+            finally:
+                with self.lock:
+                    self.running -= 1
+                    self.active[session_id] -= 1
+                    if not self.active[session_id]:
+                        del self.active[session_id]
+                    
+    def forget(self, session_id):
+        """Drop the rate limit state of a closed session"""
+        with self.lock:
+            self.buckets.pop(session_id, None)
             
-        except Exception as e:
-            socketio.emit('output', {
-                'type': 'error',
-                'text': f"Execution error: {str(e)}\n",
-                'timestamp': datetime.now().isoformat()
-            }, room=self.session_id)
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': len(self.workers),
+                'running': self.running,
+                'queued': self.jobs.qsize(),
+                'queue_size': self.jobs.maxsize,
+                'rejected': self.rejected,
+            }
+
+
+class SessionReaper:
+    """Background sweep evicting sessions that went idle or grew too large"""
+    def __init__(self, interval, idle_timeout, memory_limit):
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        self.memory_limit = memory_limit
+        self.sweeps = 0
+        self.reaped = collections.Counter()  # reason -> sessions reaped
+        
+    def start(self):
+        socketio.start_background_task(self._run)
+        
+    def _run(self):
+        while True:
+            socketio.sleep(self.interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Session reaper error: {e}")
+                
+    def sweep(self):
+        """Reap every session past its idle timeout or memory limit, page out the idle rest"""
+        now = time.monotonic()
+        for session_id, interpreter in list(active_sessions.items()):
+            idle = now - session_activity.get(session_id, now)
+            # A program that is computing is not idle; one parked on input or pause is
+            parked = (not interpreter.running or interpreter.paused or interpreter.suspended is not None
+                      or interpreter.input_handler.waiting_for_input)
+            if parked and idle > self.idle_timeout:
+                self.reap(session_id, 'idle')
+            elif interpreter.memory_usage() > self.memory_limit:
+                self.reap(session_id, 'memory')
+            elif session_pager is not None and idle > session_pager.idle_after and interpreter.pageable() \
+                    and not execution_scheduler.active[session_id]:
+                try:
+                    session_pager.page_out(session_id, interpreter)
+                except OSError as e:
+                    print(f"Could not page out session {session_id}: {e}")
+        paged = list(session_pager.paged) if session_pager is not None else []
+        for session_id in paged:
+            if now - session_activity.get(session_id, now) > self.idle_timeout:
+                self.reap(session_id, 'idle')
+        session_registry.refresh(list(active_sessions) + paged)
+        self.sweeps += 1
+        
+    def reap(self, session_id, reason):
+        """Notify the client, release the session's resources and drop its socket"""
+        message = {
+            'idle': 'Session closed after being idle too long',
+            'memory': 'Session closed for using too much memory',
+        }[reason]
+        send_event(session_id, 'session_reaped', {'reason': reason, 'message': message})
+        sid = session_sids.get(session_id)
+        close_session(session_id)
+        self.reaped[reason] += 1
+        SESSIONS_REAPED.labels(reason).inc()
+        print(f"Session reaped ({reason}): {session_id}")
+        if sid is not None:
+            socketio.server.disconnect(sid, namespace='/')
             
+    def stats(self):
+        return {
+            'sessions': len(active_sessions),
+            'paged': session_pager.stats() if session_pager is not None else None,
+            'sweeps': self.sweeps,
+            'reaped_idle': self.reaped['idle'],
+            'reaped_memory': self.reaped['memory'],
+            'idle_timeout': self.idle_timeout,
+            'memory_limit': self.memory_limit,
+        }
+
+
+class SessionPager:
+    """Swaps idle sessions out to snapshot files and back in on their next event"""
+    def __init__(self, directory, idle_after):
+        self.directory = directory
+        self.idle_after = idle_after
+        self.paged = {}  # session_id -> snapshot size in bytes
+        self.paged_out = 0
+        self.paged_in = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, session_id):
+        return os.path.join(self.directory, session_id + '.snap')
+
+    def page_out(self, session_id, interpreter):
+        """Write the session to disk and give its interpreter back to the pool"""
+        data = interpreter.snapshot()
+        # Write then rename so a crash never leaves half a snapshot behind
+        fd, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, self._path(session_id))
+
+        self.paged[session_id] = len(data)
+        self.paged_out += 1
+        SESSIONS_PAGED.labels('out').inc()
+        active_sessions.pop(session_id, None)
+        session_interpreters.pop(session_id, None)
+        session_journals.pop(session_id, None)
+        session_documents.pop(session_id, None)
+        interpreter_pool.release(interpreter)
+
+    def page_in(self, session_id):
+        """Bring a paged-out session back into active_sessions"""
+        self.paged.pop(session_id)
+        path = self._path(session_id)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
         finally:
-            self.running = False
-            self.restore_io()
-            socketio.emit('execution_finished', {
-                'timestamp': datetime.now().isoformat()
-            }, room=self.session_id)
+            self.discard(session_id)
+
+        interpreter = interpreter_pool.acquire(session_id)
+        try:
+            interpreter.restore(data)
+        except Exception:
+            interpreter_pool.release(interpreter)
+            raise
+        active_sessions[session_id] = interpreter
+        session_interpreters[session_id] = interpreter
+        self.paged_in += 1
+        SESSIONS_PAGED.labels('in').inc()
+
+    def discard(self, session_id):
+        """Forget a session's snapshot, if it has one"""
+        self.paged.pop(session_id, None)
+        try:
+            os.remove(self._path(session_id))
+        except OSError:
+            pass
+
+    def stats(self):
+        return {
+            'paged': len(self.paged),
+            'bytes': sum(self.paged.values()),
+            'paged_out': self.paged_out,
+            'paged_in': self.paged_in,
+            'idle_after': self.idle_after,
+        }
+
+
+interpreter_pool = InterpreterPool(int(os.environ.get('INTERPRETER_POOL_SIZE', 8)))
+execution_scheduler = ExecutionScheduler(
+    workers=int(os.environ.get('EXECUTION_WORKERS', 4)),
+    queue_size=int(os.environ.get('EXECUTION_QUEUE_SIZE', 32)),
+    rate=float(os.environ.get('RUN_RATE_LIMIT', 2)),
+    burst=float(os.environ.get('RUN_RATE_BURST', 5)),
+)
+
+
+# 'process' runs programs in worker processes so CPU-bound code cannot
+# stall the eventlet hub; 'thread' runs them inside the server process
+EXECUTION_BACKEND = os.environ.get('EXECUTION_BACKEND', 'process')
+process_workers = None
+if EXECUTION_BACKEND == 'process' and ProcessWorkerPool is not None:
+    process_workers = ProcessWorkerPool(
+        size=len(execution_scheduler.workers),
+        max_runs=int(os.environ.get('WORKER_MAX_RUNS', 100)),
+        memory_limit=RUN_MEMORY_LIMIT or None,
+    )
+
+
+# Limits of POST /api/run jobs; requests may only lower them
+BATCH_TIMEOUT = float(os.environ.get('BATCH_TIMEOUT', 10))
+BATCH_MAX_STATEMENTS = int(os.environ.get('BATCH_MAX_STATEMENTS', 1000000))
+BATCH_MAX_OUTPUT_BYTES = int(os.environ.get('BATCH_MAX_OUTPUT_BYTES', 64 * 1024))
+BATCH_MAX_JOBS = int(os.environ.get('BATCH_MAX_JOBS', 50))
+BATCH_QUEUE_TIMEOUT = float(os.environ.get('BATCH_QUEUE_TIMEOUT', 30))
+
+# Runs record variable checkpoints so an edited program resumes from its first
+# changed line; CHECKPOINT_OUTPUT_BYTES bounds the output kept to replay, 0 disables
+CHECKPOINT_OUTPUT_BYTES = int(os.environ.get('CHECKPOINT_OUTPUT_BYTES', 256 * 1024)) if RunJournal is not None else 0
+
+# The editor's document is checked as it is typed; larger documents get no
+# diagnostics until they are run, 0 disables the checks
+DIAGNOSTICS_MAX_LINES = int(os.environ.get('DIAGNOSTICS_MAX_LINES', 20000)) if IncrementalValidator is not None else 0
+
+# Results of deterministic programs, shared by all sessions and /api/run;
+# RESULT_CACHE_DIR adds a disk tier, RESULT_CACHE_BYTES=0 disables the cache
+RESULT_CACHE_BYTES = int(os.environ.get('RESULT_CACHE_BYTES', 32 * 1024 * 1024))
+result_cache = None
+if ResultCache is not None and RESULT_CACHE_BYTES > 0:
+    result_cache = ResultCache(
+        RESULT_CACHE_BYTES,
+        directory=os.environ.get('RESULT_CACHE_DIR') or None,
+        disk_entries=int(os.environ.get('RESULT_CACHE_DISK_ENTRIES', 10000)),
+    )
+
+
+# Sessions idle for SESSION_PAGE_AFTER seconds are swapped out to SESSION_PAGE_DIR
+# (a private temporary directory by default) until their next event; 0 disables
+SESSION_PAGE_AFTER = float(os.environ.get('SESSION_PAGE_AFTER', 300))
+session_pager = None
+if SESSION_PAGE_AFTER > 0 and hasattr(NoobieInterpreter, 'snapshot'):
+    session_pager = SessionPager(
+        os.environ.get('SESSION_PAGE_DIR') or tempfile.mkdtemp(prefix='noobie-sessions-'),
+        SESSION_PAGE_AFTER,
+    )
+
+session_reaper = SessionReaper(
+    interval=float(os.environ.get('REAPER_INTERVAL', 30)),
+    idle_timeout=float(os.environ.get('SESSION_IDLE_TIMEOUT', 1800)),
+    memory_limit=int(os.environ.get('SESSION_MEMORY_LIMIT', 8 * 1024 * 1024)),
+)
+session_reaper.start()
+
+# Records which process owns each session; entries expire unless the owning
+# process keeps refreshing them from its reaper sweep
+session_registry = create_registry(
+    os.environ.get('SESSION_REGISTRY_URL'),
+    ttl=int(session_reaper.interval * 3 + 60),
+)
+
+metrics.gauge('noobie_active_sessions', 'Sessions connected to this process',
+              function=lambda: len(active_sessions))
+if session_pager is not None:
+    metrics.gauge('noobie_sessions_paged', 'Idle sessions swapped out to disk',
+                  function=lambda: len(session_pager.paged))
+metrics.gauge('noobie_sessions_waiting_for_input', 'Sessions whose run is parked at LISTEN',
+              function=lambda: sum(1 for interpreter in list(active_sessions.values())
+                                   if interpreter.suspended is not None))
+metrics.gauge('noobie_executions_running', 'Jobs executing on the worker pool',
+              function=lambda: execution_scheduler.running)
+metrics.gauge('noobie_executions_queued', 'Jobs waiting for a free worker',
+              function=lambda: execution_scheduler.jobs.qsize())
+metrics.gauge('noobie_interpreters_in_use', 'Interpreters checked out of the pool',
+              function=lambda: interpreter_pool.in_use)
+if process_workers is not None:
+    metrics.gauge('noobie_process_workers_idle', 'Worker processes free to take a job',
+                  function=lambda: process_workers.idle.qsize())
+if result_cache is not None:
+    metrics.gauge('noobie_result_cache_bytes', 'Size of the in-memory result cache',
+                  function=lambda: result_cache.stats()['bytes'])
+
+
+def touch_session(session_id):
+    """Record client activity for the idle reaper"""
+    session_activity[session_id] = time.monotonic()
+
+
+def close_session(session_id):
+    """Stop a session's run and release everything held for it"""
+    interpreter = active_sessions.pop(session_id, None)
+    if interpreter is not None:
+        interpreter.stop()
+        interpreter_pool.release(interpreter)
+    session_interpreters.pop(session_id, None)
+    execution_scheduler.forget(session_id)
+    session_inputs.pop(session_id, None)
+    session_encodings.pop(session_id, None)
+    session_sids.pop(session_id, None)
+    session_activity.pop(session_id, None)
+    session_journals.pop(session_id, None)
+    session_documents.pop(session_id, None)
+    if session_pager is not None:
+        session_pager.discard(session_id)
+    session_registry.remove(session_id)
+
+
+def load_session(session_id):
+    """Return whether session_id is open here, paging it back in if it was swapped out"""
+    if session_id in active_sessions:
+        return True
+    if session_pager is None or session_id not in session_pager.paged:
+        return False
+    try:
+        session_pager.page_in(session_id)
+    except (OSError, NoobieError) as e:
+        print(f"Could not page in session {session_id}: {e}")
+        close_session(session_id)
+        return False
+    return True
+
+
+def invalid_session_message(session_id):
+    """Explain an event for a session this process does not hold"""
+    owner = session_registry.get(session_id) if session_id else None
+    if owner is not None and owner.get('node') != NODE_ID:
+        # Sticky routing failed: the session lives on another process
+        ERRORS.labels('misrouted').inc()
+        return f"Session is held by server process {owner['node']}; events for a session must reach its process"
+    return 'Invalid session'
+
+
+def lookup_result(key):
+    """Return the cached result for key, counting the lookup"""
+    cached = result_cache.get(key)
+    RESULT_CACHE_LOOKUPS.labels('hit' if cached is not None else 'miss').inc()
+    return cached
+
+
+def schedule_run(session_id, interpreter, job, admission=True):
+    """Submit a run to the worker pool, telling the client if it was queued or rejected"""
+    reason = execution_scheduler.submit(session_id, job, admission)
+    if reason:
+        ERRORS.labels('rejected').inc()
+        interpreter_pool.run_finished(interpreter)
+        emit('execution_rejected', {
+            'reason': reason,
+            'timestamp': datetime.now().isoformat()
+        })
+        return False
+        
+    emit('execution_queued', {
+        'position': execution_scheduler.position(),
+        'timestamp': datetime.now().isoformat()
+    })
+    return True
 
 
 @app.route('/')
 def index():
     """Main page"""
-    return render_template('index.html')
+    return render_template('index.html', socket_transports=SOCKETIO_TRANSPORTS)
+
+
+def normalize_batch_job(spec):
+    """Validate one /api/run job, returning it with limits capped at the server maxima"""
+    if not isinstance(spec, dict):
+        raise ValueError("job must be an object")
+    code = spec.get('code')
+    if not isinstance(code, str):
+        raise ValueError("'code' must be a string")
+    inputs = spec.get('inputs', [])
+    if not isinstance(inputs, list) or not all(isinstance(item, (str, int, float)) for item in inputs):
+        raise ValueError("'inputs' must be a list of strings")
+    seed = spec.get('seed')
+    if seed is not None and (not isinstance(seed, int) or isinstance(seed, bool)):
+        raise ValueError("'seed' must be an integer")
+    requested = spec.get('limits') or {}
+    if not isinstance(requested, dict):
+        raise ValueError("'limits' must be an object")
+
+    maxima = [('timeout', BATCH_TIMEOUT, float),
+              ('max_statements', BATCH_MAX_STATEMENTS, int),
+              ('max_output_bytes', BATCH_MAX_OUTPUT_BYTES, int)]
+    if RUN_MEMORY_LIMIT:
+        maxima.append(('max_memory_bytes', RUN_MEMORY_LIMIT, int))
+    limits = {}
+    for name, maximum, kind in maxima:
+        value = requested.get(name, maximum)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+            raise ValueError(f"limit '{name}' must be a positive number")
+        limits[name] = kind(min(value, maximum))
+    return {'code': code, 'inputs': [str(item) for item in inputs], 'seed': seed, 'limits': limits}
+
+
+def execute_batch_job(job):
+    """Run a normalized job on the configured backend and return its result"""
+    if process_workers is not None:
+        result, stats = process_workers.batch(job)
+    else:
+        result, stats = run_job(job)
+    record_run_stats(stats)
+    EXECUTION_SECONDS.observe(result['duration_ms'] / 1000)
+    return result
+
+
+@app.route('/api/run', methods=['POST'])
+def run_batch():
+    """Run code non-interactively: LISTEN reads from 'inputs', output comes back as JSON.
+
+    The body is one job or {"jobs": [...]} for up to BATCH_MAX_JOBS jobs.
+    """
+    if run_job is None:
+        return jsonify({'error': 'batch execution is not available'}), 503
+    payload = request.get_json(silent=True)
+    many = isinstance(payload, dict) and 'jobs' in payload
+    specs = payload['jobs'] if many else [payload]
+    if not isinstance(specs, list) or not specs:
+        return jsonify({'error': "'jobs' must be a non-empty list"}), 400
+    if len(specs) > BATCH_MAX_JOBS:
+        return jsonify({'error': f"at most {BATCH_MAX_JOBS} jobs per request"}), 400
+    try:
+        jobs = [normalize_batch_job(spec) for spec in specs]
+    except ValueError as e:
+        ERRORS.labels('validation').inc()
+        return jsonify({'error': str(e)}), 400
+
+    # Jobs of one request share a scheduler key; the queue bound still applies
+    batch_id = f"batch:{uuid.uuid4()}"
+    done = queue.Queue()
+    results = [None] * len(jobs)
+
+    def make_job(index, job, key):
+        def work():
+            try:
+                result = execute_batch_job(job)
+                # A timeout depends on the machine, not the program
+                if key is not None and result['status'] != 'timeout':
+                    result_cache.put(key, result)
+                results[index] = dict(result, cached=False)
+            except Exception as e:
+                ERRORS.labels('worker').inc()
+                results[index] = {'status': 'error', 'error': str(e)}
+            finally:
+                done.put(index)
+        return work
+
+    submitted = 0
+    first_run = {}  # cache key -> index of the job that runs it
+    duplicates = []  # (index, index of the identical job that runs)
+    deadline = time.monotonic() + BATCH_QUEUE_TIMEOUT
+    for index, job in enumerate(jobs):
+        key = None
+        if result_cache is not None and is_deterministic(job['code'], fixed_inputs=True,
+                                                         seeded=job['seed'] is not None):
+            key = result_key('batch', job['code'], job['inputs'], job['seed'], job['limits'])
+            if key in first_run:
+                duplicates.append((index, first_run[key]))
+                continue
+            cached = lookup_result(key)
+            if cached is not None:
+                results[index] = dict(cached, cached=True)
+                continue
+            first_run[key] = index
+        while execution_scheduler.submit(batch_id, make_job(index, job, key), admission=False):
+            if time.monotonic() >= deadline:
+                break
+            socketio.sleep(0.05)
+        else:
+            submitted += 1
+            continue
+        ERRORS.labels('rejected').inc()
+        results[index] = {'status': 'rejected', 'error': 'server busy'}
+
+    # Each job ends by its timeout, the process backend killing a stuck worker;
+    # a job the thread backend cannot interrupt must still not hold the request
+    wait = BATCH_QUEUE_TIMEOUT + max(job['limits']['timeout'] for job in jobs) + 5
+    for _ in range(submitted):
+        try:
+            done.get(timeout=wait)
+        except queue.Empty:
+            ERRORS.labels('timeout').inc()
+            break
+    duplicated = {index for index, _ in duplicates}
+    for index, result in enumerate(results):
+        if result is None and index not in duplicated:
+            results[index] = {'status': 'timeout', 'error': 'no result before the request deadline'}
+    for index, original in duplicates:
+        results[index] = dict(results[original], cached=results[original]['status'] != 'rejected')
+    return jsonify({'results': results} if many else results[0])
 
 
 @app.route('/api/health')
 def health_check():
     """Health check endpoint"""
-    return jsonify({'status': 'healthy', 'timestamp': datetime.now().isoformat()})
+    return jsonify({
+        'status': 'healthy',
+        'interpreter_pool': interpreter_pool.stats(),
+        'executions': execution_scheduler.stats(),
+        'backend': EXECUTION_BACKEND if process_workers is not None else 'thread',
+        'process_workers': process_workers.stats() if process_workers is not None else None,
+        'sessions': session_reaper.stats(),
+        'node': NODE_ID,
+        'registry': session_registry.stats(),
+        'result_cache': result_cache.stats() if result_cache is not None else None,
+        'timestamp': datetime.now().isoformat()
+    })
 
 
 @socketio.on('connect')
@@ -307,10 +1377,25 @@ def handle_connect():
     session_id = str(uuid.uuid4())
     session['session_id'] = session_id
     
-    # Create new interpreter for this session
-    interpreter = NoobieWebInterpreter(session_id)
+    # Check out an interpreter for this session
+    interpreter = interpreter_pool.acquire(session_id)
     active_sessions[session_id] = interpreter
     session_interpreters[session_id] = interpreter
+    session_sids[session_id] = request.sid
+    touch_session(session_id)
+    CONNECTIONS.inc()
+    
+    # Clients opt into binary frames with ?encoding=compact
+    encoding = 'compact' if request.args.get('encoding') == 'compact' else 'json'
+    if encoding == 'compact':
+        session_encodings[session_id] = encoding
+    
+    session_registry.register(session_id, {
+        'node': NODE_ID,
+        'sid': request.sid,
+        'encoding': encoding,
+        'connected_at': datetime.now().isoformat(),
+    })
     
     # Join room
     from flask_socketio import join_room
@@ -318,6 +1403,8 @@ def handle_connect():
     
     emit('connected', {
         'session_id': session_id,
+        'node': NODE_ID,
+        'encoding': encoding,
         'timestamp': datetime.now().isoformat()
     })
     
@@ -329,15 +1416,8 @@ def handle_disconnect():
     """Handle client disconnection"""
     session_id = session.get('session_id')
     if session_id:
-        # Stop any running code
-        if session_id in active_sessions:
-            active_sessions[session_id].running = False
-            
-        # Clean up
-        active_sessions.pop(session_id, None)
-        session_interpreters.pop(session_id, None)
-        session_threads.pop(session_id, None)
-        session_inputs.pop(session_id, None)
+        # Stop any running code and clean up
+        close_session(session_id)
         
         print(f"Client disconnected: {session_id}")
 
@@ -346,77 +1426,183 @@ def handle_disconnect():
 def handle_execute_code(data):
     """Handle code execution request"""
     session_id = session.get('session_id')
-    if not session_id or session_id not in active_sessions:
-        emit('error', {'message': 'Invalid session'})
+    if not session_id or not load_session(session_id):
+        emit('error', {'message': invalid_session_message(session_id)})
         return
+    touch_session(session_id)
         
     code = data.get('code', '').strip()
     if not code:
         emit('error', {'message': 'No code provided'})
         return
         
-    interpreter = active_sessions[session_id]
-    
-    # Stop any running code
-    if interpreter.running:
-        interpreter.running = False
-        time.sleep(0.1)
+    # Reject malformed programs before spending a thread on them
+    errors = validate(code)
+    if errors:
+        ERRORS.labels('validation').inc()
+        for error in errors:
+            send_event(session_id, 'output', {
+                'type': 'error',
+                'text': format_error(str(error), error.line_number) + '\n'
+            })
+        return
         
-    # Create new interpreter for fresh execution
-    interpreter = NoobieWebInterpreter(session_id)
-    active_sessions[session_id] = interpreter
+    # Programs without RANDOM or LISTEN print the same thing every time
+    cache_key = None
+    if result_cache is not None and is_deterministic(code):
+        # A program may only fail under a lower memory limit
+        cache_key = result_key('session', code, options={'memory_limit': RUN_MEMORY_LIMIT})
+        cached = None if execution_scheduler.active[session_id] else lookup_result(cache_key)
+        if cached is not None:
+            # Replay without a worker; the fresh interpreter only receives the variables
+            previous = active_sessions[session_id]
+            interpreter = interpreter_pool.acquire(session_id)
+            active_sessions[session_id] = interpreter
+            session_interpreters[session_id] = interpreter
+            interpreter_pool.release(previous)
+            interpreter.replay(cached)
+            return
+        
+    # Check out a clean interpreter for fresh execution
+    previous = active_sessions[session_id]
+    interpreter = interpreter_pool.acquire(session_id)
+    interpreter.busy = True
     
-    # Execute in separate thread
+    # Execute on the worker pool
     def execute_thread():
         try:
-            interpreter.execute_code(code)
+            interpreter.execute_code(code, cache_key)
         except Exception as e:
-            socketio.emit('output', {
+            send_event(session_id, 'output', {
                 'type': 'error',
-                'text': f"Thread error: {str(e)}\n",
-                'timestamp': datetime.now().isoformat()
-            }, room=session_id)
+                'text': f"Thread error: {str(e)}\n"
+            })
+        finally:
+            interpreter_pool.run_finished(interpreter)
             
-    thread = threading.Thread(target=execute_thread, daemon=True)
-    session_threads[session_id] = thread
-    thread.start()
+    if not schedule_run(session_id, interpreter, execute_thread):
+        interpreter_pool.release(interpreter)
+        return
+        
+    active_sessions[session_id] = interpreter
+    session_interpreters[session_id] = interpreter
+    interpreter_pool.release(previous)
 
 
 @socketio.on('execute_line')
 def handle_execute_line(data):
     """Handle single line execution"""
     session_id = session.get('session_id')
-    if not session_id or session_id not in active_sessions:
-        emit('error', {'message': 'Invalid session'})
+    if not session_id or not load_session(session_id):
+        emit('error', {'message': invalid_session_message(session_id)})
         return
+    touch_session(session_id)
         
     line = data.get('line', '').strip()
     if not line:
         return
         
     interpreter = active_sessions[session_id]
+    # A program run owns the interpreter, also while it waits at LISTEN
+    if interpreter.running or (execution_scheduler.active[session_id] and not interpreter.repl_draining):
+        ERRORS.labels('rejected').inc()
+        emit('execution_rejected', {
+            'reason': 'a run is already active for this session',
+            'timestamp': datetime.now().isoformat()
+        })
+        return
+    if REPL_MAX_QUEUED_PIECES and len(interpreter.repl_pieces) >= REPL_MAX_QUEUED_PIECES:
+        ERRORS.labels('rejected').inc()
+        emit('execution_rejected', {
+            'reason': 'too many lines waiting to run',
+            'timestamp': datetime.now().isoformat()
+        })
+        return
+        
+    # Block lines are only buffered; complete pieces join the job already running them
+    if not interpreter.queue_line(line):
+        return
+    interpreter.busy = True
     
-    # Execute in separate thread for non-blocking operation
+    # Execute on the worker pool for non-blocking operation
     def execute_line_thread():
         try:
-            interpreter.execute_line(line)
+            interpreter.drain_lines()
         except Exception as e:
-            socketio.emit('output', {
+            interpreter.drop_lines()
+            send_event(session_id, 'output', {
                 'type': 'error',
-                'text': f"Line execution error: {str(e)}\n",
-                'timestamp': datetime.now().isoformat()
-            }, room=session_id)
+                'text': f"Line execution error: {str(e)}\n"
+            })
+        finally:
+            interpreter_pool.run_finished(interpreter)
             
-    thread = threading.Thread(target=execute_line_thread, daemon=True)
-    thread.start()
+    # One job per session runs the pieces in order, so typing is not rate limited;
+    # REPL_MAX_QUEUED_PIECES bounds what may wait for it instead
+    if not schedule_run(session_id, interpreter, execute_line_thread, admission=False):
+        interpreter.drop_lines()
+
+
+@socketio.on('analyze_code')
+def handle_analyze_code(data):
+    """Check the editor's document and reply with its diagnostics.
+
+    The client sends {'version', 'code'} for the whole document, then
+    {'version', 'base', 'start', 'end', 'lines'} for each edit replacing lines
+    [start, end) of version base. Only the edited lines are analysed again; an
+    edit that does not apply to the document held here is answered with
+    'resync' so the client sends the whole document. Each diagnostic has a
+    severity: 'error' stops the program from running, 'warning' may not.
+    """
+    session_id = session.get('session_id')
+    if not session_id or not load_session(session_id):
+        emit('error', {'message': invalid_session_message(session_id)})
+        return
+    touch_session(session_id)
+    if DIAGNOSTICS_MAX_LINES <= 0:
+        return
+        
+    version = data.get('version')
+    try:
+        if 'code' in data:
+            code = str(data['code'])
+            document = None
+            if code.count('\n') < DIAGNOSTICS_MAX_LINES:
+                document = IncrementalValidator(code)
+        else:
+            base, document = session_documents.get(session_id, (None, None))
+            if document is None or base is None or data.get('base') != base:
+                raise NoobieError("edit does not apply to the document")
+            document.apply_edit(int(data['start']), int(data['end']), [str(line) for line in data['lines']])
+            if len(document) > DIAGNOSTICS_MAX_LINES:
+                document = None
+    except (NoobieError, KeyError, TypeError, ValueError):
+        session_documents.pop(session_id, None)
+        emit('diagnostics', {'version': version, 'resync': True})
+        return
+        
+    if document is None:
+        session_documents.pop(session_id, None)
+        emit('diagnostics', {'version': version, 'diagnostics': [], 'too_large': True})
+        return
+    session_documents[session_id] = (version, document)
+    warnings = []
+    errors = document.diagnostics(warnings)
+    emit('diagnostics', {
+        'version': version,
+        'diagnostics': [{'line': finding.line_number, 'message': str(finding), 'severity': severity}
+                        for severity, findings in (('error', errors), ('warning', warnings))
+                        for finding in findings],
+    })
 
 
 @socketio.on('stop_execution')
 def handle_stop_execution():
     """Handle stop execution request"""
     session_id = session.get('session_id')
-    if session_id and session_id in active_sessions:
-        active_sessions[session_id].running = False
+    if session_id and load_session(session_id):
+        touch_session(session_id)
+        active_sessions[session_id].stop()
         emit('execution_stopped', {
             'timestamp': datetime.now().isoformat()
         })
@@ -426,8 +1612,9 @@ def handle_stop_execution():
 def handle_pause_execution():
     """Handle pause execution request"""
     session_id = session.get('session_id')
-    if session_id and session_id in active_sessions:
-        active_sessions[session_id].paused = True
+    if session_id and load_session(session_id):
+        touch_session(session_id)
+        active_sessions[session_id].pause()
         emit('execution_paused', {
             'timestamp': datetime.now().isoformat()
         })
@@ -437,8 +1624,9 @@ def handle_pause_execution():
 def handle_resume_execution():
     """Handle resume execution request"""
     session_id = session.get('session_id')
-    if session_id and session_id in active_sessions:
-        active_sessions[session_id].paused = False
+    if session_id and load_session(session_id):
+        touch_session(session_id)
+        active_sessions[session_id].resume()
         emit('execution_resumed', {
             'timestamp': datetime.now().isoformat()
         })
@@ -448,41 +1636,68 @@ def handle_resume_execution():
 def handle_provide_input(data):
     """Handle input from user"""
     session_id = session.get('session_id')
-    if not session_id or session_id not in active_sessions:
-        emit('error', {'message': 'Invalid session'})
+    if not session_id or not load_session(session_id):
+        emit('error', {'message': invalid_session_message(session_id)})
         return
+    touch_session(session_id)
         
     input_text = data.get('input', '')
     interpreter = active_sessions[session_id]
     
-    # Provide input to interpreter
-    if interpreter.input_handler.provide_input(input_text):
-        emit('input_provided', {
-            'input': input_text,
-            'timestamp': datetime.now().isoformat()
-        })
-        
-        # Also send to output for display
-        socketio.emit('output', {
-            'type': 'input_echo',
-            'text': input_text + '\n',
-            'timestamp': datetime.now().isoformat()
-        }, room=session_id)
-    else:
+    # Provide input to a line waiting in execute_line
+    suspended = interpreter.suspended
+    if suspended is None and not interpreter.input_handler.provide_input(input_text):
         emit('error', {'message': 'Not waiting for input'})
+        return
+        
+    emit('input_provided', {
+        'input': input_text,
+        'timestamp': datetime.now().isoformat()
+    })
+    
+    # Also send to output for display
+    send_event(session_id, 'output', {
+        'type': 'input_echo',
+        'text': input_text + '\n'
+    })
+    
+    if suspended is not None:
+        # A run parked at LISTEN continues on the next free worker
+        LISTEN_WAITS.inc()
+        LISTEN_WAIT_SECONDS.observe(time.monotonic() - interpreter.suspended_at)
+        interpreter.suspended = None
+        interpreter.busy = True
+        
+        def resume_thread():
+            try:
+                interpreter.resume_with_input(suspended, input_text)
+            finally:
+                interpreter_pool.run_finished(interpreter)
+                
+        # The run was admitted, and charged a token, when it started; each parked
+        # LISTEN takes one answer, so resuming adds no job the bucket has not paid
+        # for. The scheduler's bounded queue still applies.
+        if not schedule_run(session_id, interpreter, resume_thread, admission=False):
+            # Keep the run parked and ask again
+            interpreter.suspended = suspended
+            send_event(session_id, 'input_request', {'prompt': suspended[0]})
 
 
 @socketio.on('reset_interpreter')
 def handle_reset_interpreter():
     """Reset the interpreter"""
     session_id = session.get('session_id')
-    if session_id and session_id in active_sessions:
+    if session_id and load_session(session_id):
+        touch_session(session_id)
         # Stop current execution
-        active_sessions[session_id].running = False
+        previous = active_sessions[session_id]
+        previous.stop()
         
-        # Create new interpreter
-        interpreter = NoobieWebInterpreter(session_id)
+        # Swap in a clean interpreter from the pool
+        interpreter = interpreter_pool.acquire(session_id)
         active_sessions[session_id] = interpreter
+        session_interpreters[session_id] = interpreter
+        interpreter_pool.release(previous)
         
         emit('interpreter_reset', {
             'timestamp': datetime.now().isoformat()
@@ -490,6 +1705,12 @@ def handle_reset_interpreter():
 
 
 # Error handlers
+@app.route('/api/metrics')
+def metrics_endpoint():
+    """Prometheus text exposition of the server metrics"""
+    return Response(metrics.render(), mimetype=None, content_type=METRICS_CONTENT_TYPE)
+
+
 @app.errorhandler(404)
 def not_found_error(error):
     return render_template('404.html'), 404
@@ -505,11 +1726,17 @@ def cleanup_sessions():
     """Cleanup all active sessions"""
     for session_id in list(active_sessions.keys()):
         if session_id in active_sessions:
-            active_sessions[session_id].running = False
+            active_sessions[session_id].stop()
+        session_registry.remove(session_id)
+    if session_pager is not None:
+        for session_id in list(session_pager.paged):
+            session_pager.discard(session_id)
+            session_registry.remove(session_id)
     
     active_sessions.clear()
     session_interpreters.clear()
-    session_threads.clear()
+    if process_workers is not None:
+        process_workers.shutdown()
     session_inputs.clear()
 
 
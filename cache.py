@@ -0,0 +1,167 @@
+"""Content-addressed cache of program results.
+
+A deterministic program (no RANDOM unless seeded, LISTEN only with fixed
+inputs) always produces the same result, so it is keyed by a hash of the
+normalized code, its inputs, seed and options, and the interpreter version.
+Entries live in a size-bounded in-memory LRU, optionally backed by a
+directory of JSON files shared by restarts and processes.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import collections
+from typing import Any, Dict, Optional
+
+from noobie02 import INTERPRETER_VERSION, commands_used
+
+
+def normalize_code(code: str) -> str:
+    """The program as the interpreter sees it: stripped lines, no trailing blank lines"""
+    return '\n'.join(line.strip() for line in code.splitlines()).rstrip('\n')
+
+
+def result_key(kind: str, code: str, inputs=(), seed=None, options=None) -> str:
+    """Hash of everything that determines a run's result; kind separates result formats"""
+    material = [INTERPRETER_VERSION, kind, normalize_code(code), list(inputs), seed, options]
+    encoded = json.dumps(material, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """LRU of JSON-serializable results bounded by their encoded size.
+
+    With directory set, entries are also written there and a memory miss
+    falls back to disk; the disk tier keeps at most disk_entries files.
+    Entries larger than max_entry_bytes are not cached at all.
+    """
+    def __init__(self, max_bytes: int, directory: Optional[str] = None,
+                 disk_entries: int = 10000, max_entry_bytes: Optional[int] = None):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes if max_entry_bytes is not None else max_bytes // 16
+        self.directory = directory
+        self.disk_entries = disk_entries
+        self.lock = threading.Lock()
+        self.entries: 'collections.OrderedDict[str, bytes]' = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_count = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.disk_count = len(self._disk_files())
+
+    def get(self, key: str) -> Optional[Any]:
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return json.loads(data)
+        data = self._read_disk(key)
+        with self.lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, data)
+        return json.loads(data)
+
+    def put(self, key: str, value: Any):
+        data = json.dumps(value, separators=(',', ':')).encode('utf-8')
+        if len(data) > self.max_entry_bytes:
+            return
+        with self.lock:
+            self._remember(key, data)
+        self._write_disk(key, data)
+
+    def _remember(self, key, data):
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.bytes -= len(previous)
+        self.entries[key] = data
+        self.bytes += len(data)
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= len(evicted)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def _disk_files(self):
+        return [os.path.join(root, name)
+                for root, _, names in os.walk(self.directory)
+                for name in names if name.endswith('.json')]
+
+    def _read_disk(self, key):
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write_disk(self, key, data):
+        if not self.directory:
+            return
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename so readers in other processes never see half a file
+            fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temporary, path)
+        except OSError:
+            return
+        with self.lock:
+            self.disk_count += 1
+            prune = self.disk_count > self.disk_entries
+        if prune:
+            self._prune_disk()
+
+    def _prune_disk(self):
+        """Drop the least recently written tenth of the disk tier"""
+        files = []
+        for path in self._disk_files():
+            try:
+                files.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+        files.sort()
+        excess = len(files) - self.disk_entries + self.disk_entries // 10
+        for _, path in files[:max(excess, 0)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self.lock:
+            self.disk_count = len(files) - max(excess, 0)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'disk_entries': self.disk_count if self.directory else None,
+            }
+
+
+def is_deterministic(code: str, fixed_inputs: bool = False, seeded: bool = False) -> bool:
+    """True when the program's result depends only on its code, inputs and seed"""
+    used = commands_used(code)
+    if 'random' in used and not seeded:
+        return False
+    if 'listen' in used and not fixed_inputs:
+        return False
+    return True
@@ -1,10 +1,13 @@
 import re
+import ast
 import sys
+import math
 import random
 import traceback
 from enum import Enum
+from functools import lru_cache
 from dataclasses import dataclass
-from typing import Dict, Any, Union, Optional, Set
+from typing import Dict, Any, List, Union, Optional, Set, Callable
 
 class DataType(Enum):
     """Enumeration for supported data types"""
@@ -31,6 +34,14 @@ class Variable:
     value: Any
     const: bool = False
 
+def encode_variables(variables: Dict[str, Variable]) -> Dict[str, list]:
+    """Encode a variable table as JSON-friendly lists"""
+    return {name: [var.type, var.value, var.const] for name, var in variables.items()}
+
+def decode_variables(data: Dict[str, list]) -> Dict[str, Variable]:
+    """Rebuild a variable table produced by encode_variables"""
+    return {name: Variable(var_type, value, const) for name, (var_type, value, const) in data.items()}
+
 # Constants
 BOOLEAN_VALUES = {"true", "false", "null"}
 EXPRESSION_REPLACEMENTS = {
@@ -64,22 +75,81 @@ def preprocess_expression(expression: str) -> str:
         expression = expression.replace(old, new)
     return expression
 
-def evaluate_expression(expression: str, variables: Dict[str, Variable]) -> Union[str, int, float]:
+# Name the size guard is bound to inside guarded expressions
+SIZE_GUARD = '__noobie_sized'
+
+class _SizeGuard(ast.NodeTransformer):
+    """Route the operators whose result can dwarf their operands through SIZE_GUARD"""
+    OPERATORS = {ast.Pow: '**', ast.Mult: '*', ast.LShift: '<<'}
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        symbol = self.OPERATORS.get(type(node.op))
+        if symbol is None:
+            return node
+        call = ast.Call(func=ast.Name(SIZE_GUARD, ast.Load()),
+                        args=[ast.Constant(symbol), node.left, node.right], keywords=[])
+        return ast.copy_location(call, node)
+
+@lru_cache(maxsize=1024)
+def _guarded_code(expression: str):
+    """Compile expression with its **, * and << operations guarded"""
+    tree = _SizeGuard().visit(ast.parse(expression.strip(), mode='eval'))
+    return compile(ast.fix_missing_locations(tree), '<expression>', 'eval')
+
+def estimated_size(symbol: str, left: Any, right: Any) -> int:
+    """Estimate the bytes left <symbol> right would take, without computing it"""
+    if symbol == '*' and isinstance(right, (str, list, tuple)):
+        left, right = right, left
+    if not isinstance(right, int):
+        return 0
+    if isinstance(left, (str, list, tuple)):
+        # Repetition: the payload of one copy, times the count
+        return max(right, 0) * (sys.getsizeof(left) - sys.getsizeof(left[:0]))
+    if not isinstance(left, int):
+        return 0
+    if symbol == '**':
+        if right <= 0 or abs(left) < 2:
+            return 0
+        return int(right * math.log2(abs(left))) // 8
+    if symbol == '<<':
+        return (left.bit_length() + max(right, 0)) // 8
+    return (left.bit_length() + right.bit_length()) // 8
+
+def _sized_operation(size_check: Callable[[int], None], symbol: str, left: Any, right: Any) -> Any:
+    size_check(estimated_size(symbol, left, right))
+    if symbol == '**':
+        return left ** right
+    if symbol == '*':
+        return left * right
+    return left << right
+
+def _evaluate(expression: str, local_scope: Dict[str, Any], size_check: Optional[Callable[[int], None]]) -> Any:
+    """eval() without builtins; size_check, when given, sees the estimated size
+    of every **, * and << result before it is computed and may raise"""
+    if size_check is None:
+        return eval(expression, {"__builtins__": {}}, local_scope)
+    local_scope[SIZE_GUARD] = lambda symbol, left, right: _sized_operation(size_check, symbol, left, right)
+    return eval(_guarded_code(expression), {"__builtins__": {}}, local_scope)
+
+def evaluate_expression(expression: str, variables: Dict[str, Variable],
+                        size_check: Optional[Callable[[int], None]] = None) -> Union[str, int, float]:
     """Safely evaluate an expression with improved error handling"""
     try:
         expression = preprocess_expression(expression)
         
         # Create safe evaluation environment
-        safe_dict = {"__builtins__": {}}
         local_scope = {name: var.value for name, var in variables.items()}
         
         # Prova a valutare l'espressione - quello che conta è se può essere valutata correttamente
-        result = eval(expression, safe_dict, local_scope)
+        result = _evaluate(expression, local_scope, size_check)
         
         if isinstance(result, bool):
             return "true" if result else "false"
         return auto_round(result) if isinstance(result, float) else result
         
+    except NoobieError:
+        raise
     except Exception as e:
         raise NoobieError(f"calculation Error: {e}")
 
@@ -114,6 +184,53 @@ def replace_variables(line: str, variables: Dict[str, Variable]) -> str:
     
     return re.sub(r'(@|\?)([a-zA-Z_]\w*)', substitute, line)
 
+# A token runs up to whitespace outside quotes and braces; a # there starts a comment
+TOKEN_PATTERN = re.compile(r'''(?:"[^"]*"?|'[^']*'?|\{[^}]*\}?|[^\s"'{#]+)+|#''')
+REFERENCE_PATTERN = re.compile(r'[@?][a-zA-Z_]\w*')
+
+class Token(str):
+    """A piece of a line as split by tokenize(), tagged with its kind:
+    'string' (quoted), 'expr' ({...}), 'ref' (@name or ?name) or 'word'
+    """
+    kind: str
+
+    def __new__(cls, text: str, kind: str):
+        token = super().__new__(cls, text)
+        token.kind = kind
+        return token
+
+def _token_kind(text: str) -> str:
+    first = text[0]
+    if first in '"\'' and (len(text) == 1 or text.find(first, 1) in (-1, len(text) - 1)):
+        return 'string'
+    if first == '{' and text.find('}') in (-1, len(text) - 1):
+        return 'expr'
+    if first in '@?' and REFERENCE_PATTERN.fullmatch(text):
+        return 'ref'
+    return 'word'
+
+def tokenize(line: str) -> List[Token]:
+    """Split a line into tokens in one pass, dropping its # comment.
+
+    Whitespace separates tokens except inside quotes and braces, so a
+    quoted string or {expression} is a single token.
+    """
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(line):
+        text = match.group()
+        if text == '#':
+            break
+        tokens.append(Token(text, _token_kind(text)))
+    return tokens
+
+def strip_comment(line: str) -> str:
+    """Return the line without its # comment; a # inside quotes or braces is kept"""
+    if '#' in line:
+        for match in TOKEN_PATTERN.finditer(line):
+            if match.group() == '#':
+                return line[:match.start()].strip()
+    return line.strip()
+
 def read_code_from_file(filename: str) -> str:
     """Read code from file with better error handling"""
     try:
@@ -126,12 +243,34 @@ def read_code_from_file(filename: str) -> str:
     except Exception as e:
         raise NoobieError(f"file reading error: {e}")
 
-def handle_error(message: str, line_number: Optional[int] = None):
-    """Improved error handling"""
+def read_lines_from_file(filename: str):
+    """Yield code lines from file one at a time without loading the whole file"""
+    try:
+        with open(filename, 'r', encoding='utf-8', buffering=1024 * 1024) as file:
+            for line in file:
+                yield line
+    except FileNotFoundError:
+        raise NoobieError(f"file '{filename}' not found")
+    except PermissionError:
+        raise NoobieError(f"permission denied reading file '{filename}'")
+    except Exception as e:
+        raise NoobieError(f"file reading error: {e}")
+
+def format_error(message: str, line_number: Optional[int] = None) -> str:
+    """Format an error message the way the interpreter reports it"""
     if line_number:
-        print(f"LINE {line_number} -> ERROR: {message}", file=sys.stderr)
-    else:
-        print(f"ERROR: {message}", file=sys.stderr)
+        return f"LINE {line_number} -> ERROR: {message}"
+    return f"ERROR: {message}"
+
+def format_warning(message: str, line_number: Optional[int] = None) -> str:
+    """Format a warning the way format_error formats errors"""
+    if line_number:
+        return f"LINE {line_number} -> WARNING: {message}"
+    return f"WARNING: {message}"
+
+def handle_error(message: str, line_number: Optional[int] = None, stream=None):
+    """Improved error handling; stream defaults to the current sys.stderr"""
+    print(format_error(message, line_number), file=stream or sys.stderr)
     
     #if sys.exc_info()[0] is not None:
     #    traceback.print_exc()
@@ -174,8 +313,10 @@ def is_valid_expression(expression: str) -> bool:
     
     return has_operator
 
-def initialize_variable(var_type: str, raw_value: Optional[str] = None) -> Any:
-    """Initialize a variable based on its type with improved validation"""
+def initialize_variable(var_type: str, raw_value: Optional[str] = None,
+                        size_check: Optional[Callable[[int], None]] = None) -> Any:
+    """Initialize a variable based on its type with improved validation;
+    size_check guards numeric expressions as in evaluate_expression"""
     var_type = var_type.upper()
     
     if var_type not in [t.value for t in DataType]:
@@ -202,8 +343,10 @@ def initialize_variable(var_type: str, raw_value: Optional[str] = None) -> Any:
         # Handle mathematical expressions for numeric types
         if var_type in ["INT", "FLOAT"] and is_valid_expression(raw_value):
             try:
-                result = eval(raw_value, {"__builtins__": {}})
+                result = _evaluate(raw_value, {}, size_check)
                 return int(result) if var_type == "INT" else float(result)
+            except NoobieError:
+                raise
             except:
                 # If eval fails, try to parse as regular value
                 pass
@@ -287,8 +430,8 @@ def convert_value(current: Any, old_type: str, new_type: str) -> Any:
     except Exception as e:
         raise NoobieError(f"conversion error: {e}")
 
-def randomize(min_val: int, max_val: int, var_type: str) -> Any:
-    """Generate a random value with improved validation"""
+def randomize(min_val: int, max_val: int, var_type: str, rng: random.Random = random) -> Any:
+    """Generate a random value with improved validation, drawing from rng"""
     var_type = var_type.upper()
     
     if var_type not in [t.value for t in DataType]:
@@ -298,23 +441,23 @@ def randomize(min_val: int, max_val: int, var_type: str) -> Any:
         raise NoobieError("min value cannot be greater than max value")
     
     if var_type == "INT":
-        return random.randint(min_val, max_val)
+        return rng.randint(min_val, max_val)
     elif var_type == "FLOAT":
-        return random.uniform(min_val, max_val)
+        return rng.uniform(min_val, max_val)
     elif var_type == "CHAR":
         if not (0 <= min_val <= max_val <= 127):
             raise NoobieError("CHAR range must be between 0 and 127")
-        return chr(random.randint(min_val, max_val))
+        return chr(rng.randint(min_val, max_val))
     elif var_type == "BOOL":
         if min_val == 1 and max_val == 2:
-            return random.choice([True, False])
+            return rng.choice([True, False])
         elif min_val == 1 and max_val == 3:
-            return random.choice([True, False, None])
+            return rng.choice([True, False, None])
         raise NoobieError("invalid BOOL range (use 1-2 or 1-3)")
     elif var_type == "STR":
         # More comprehensive character set
         chars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!@#$%^&*()_+-=[]{}|;:'\",.<>/?`~"
-        length = random.randint(min_val, max_val)
-        return ''.join(random.choice(chars) for _ in range(length))
+        length = rng.randint(min_val, max_val)
+        return ''.join(rng.choice(chars) for _ in range(length))
     
     raise NoobieError(f"unsupported type for randomization: {var_type}")
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""Load generator for the Noobie web server.
+
+Starts app.py inside this process and drives simulated sessions through the
+Flask-SocketIO test client, so it runs offline on a single machine. Each
+session connects and runs a mix of programs (CPU loops, output floods,
+LISTEN with scripted input). The report covers connect latency,
+time-to-first-output and end-to-end run latency, plus output that was
+dropped or delivered to the wrong session.
+
+    python loadtest.py --sessions 50 --runs 4 --mix loop,flood,listen
+
+The server settings (EXECUTION_WORKERS, EXECUTION_QUEUE_SIZE, ...) come
+from the environment as usual. The simulated clients share the server's
+event loop, so numbers from the thread backend include their overhead. The exit status is 1 when a run failed or
+output was lost or misrouted.
+"""
+
+import io
+import os
+import re
+import sys
+import json
+import math
+import time
+import queue
+import argparse
+import contextlib
+import collections
+
+TOKEN = re.compile(r'\bs(\d+)r(\d+)\b')
+
+
+def loop_program(token, size):
+    """CPU-bound nested loop, one line of output at the end"""
+    code = (f'CREATE INT i 0\nCREATE INT t 0\nWHILE @i < {size} DO\n'
+            f'  CREATE INT j 0\n  WHILE @j < 100 DO\n    INCREMENT j\n    INCREMENT t\n  ENDO\n'
+            f'  INCREMENT i\nENDO\nSAY "{token} t=@t" end\n')
+    return code, [], [f"{token} t={size * 100}"]
+
+
+def flood_program(token, size):
+    """Many short lines of output"""
+    lines = size * 10
+    code = f'CREATE INT i 0\nWHILE @i < {lines} DO\n  SAY "{token} line @i" end\n  INCREMENT i\nENDO\n'
+    return code, [], [f"{token} line {i}" for i in range(lines)]
+
+
+def listen_program(token, size):
+    """Three LISTENs answered by the session, then their sum"""
+    inputs = [str(size + i) for i in range(3)]
+    code = (f'CREATE INT n 0\nCREATE INT s 0\nWHILE @n < 3 DO\n  LISTEN INT v "{token} value? "\n'
+            f'  CHANGE s @s + @v\n  INCREMENT n\nENDO\nSAY "{token} sum=@s" end\n')
+    return code, inputs, [f"{token} sum={sum(int(value) for value in inputs)}"]
+
+
+PROGRAMS = {
+    'loop': loop_program,
+    'flood': flood_program,
+    'listen': listen_program,
+}
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of values, None when there are none"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(1, math.ceil(fraction * len(ordered))) - 1]
+
+
+def summarize(values):
+    """Latency summary in milliseconds"""
+    def ms(value):
+        return round(value * 1000, 2) if value is not None else None
+    return {
+        'count': len(values),
+        'p50': ms(percentile(values, 0.50)),
+        'p95': ms(percentile(values, 0.95)),
+        'p99': ms(percentile(values, 0.99)),
+        'max': ms(max(values) if values else None),
+    }
+
+
+class LoadTest:
+    """Runs the simulated sessions against an imported app module and collects results"""
+    def __init__(self, server, args):
+        self.server = server
+        self.args = args
+        self.mix = args.mix.split(',')
+        self.connect_latency = []
+        self.first_output = []
+        self.run_latency = collections.defaultdict(list)
+        self.counts = collections.Counter()
+        self.failures = []
+
+    def _client(self):
+        """Connect a test client whose output frames are acknowledged when read"""
+        from flask_socketio.test_client import SocketIOTestClient
+        from socketio import packet
+
+        query = 'encoding=compact' if self.args.compact else None
+        client = self.server.socketio.test_client(self.server.app, query_string=query)
+
+        # The test client drops ack ids; keep them so the session can ack
+        # frames like a browser does and output backpressure behaves as in production
+        server = self.server.socketio.server
+        deliver = server._send_packet
+        if not getattr(deliver, 'keeps_acks', False):
+            def send_packet(eio_sid, pkt):
+                deliver(eio_sid, pkt)
+                receiver = SocketIOTestClient.clients.get(eio_sid)
+                if pkt.id is not None and receiver is not None and receiver.queue:
+                    receiver.queue[-1]['ack'] = pkt.id
+            send_packet.keeps_acks = True
+            server._send_packet = send_packet
+
+        def ack(ack_id):
+            server._handle_eio_message(client.eio_sid, packet.Packet(packet.ACK, data=[], id=ack_id).encode())
+        client.ack = ack
+        return client
+
+    def _receive(self, client):
+        """Drain the client's queue as (event, data) pairs"""
+        from wire import decode_event
+
+        messages, client.queue = client.queue, []
+        for message in messages:
+            if 'ack' in message:
+                client.ack(message['ack'])
+            name, args = message['name'], message['args']
+            data = args[0] if args else {}
+            if name == 'frame':
+                name, data = decode_event(data)
+            yield name, data
+
+    def session(self, index):
+        socketio = self.server.socketio
+        socketio.sleep(self.args.ramp * index / max(self.args.sessions, 1))
+
+        started = time.perf_counter()
+        client = self._client()
+        if not any(name == 'connected' for name, _ in self._receive(client)):
+            self.counts['connect_failed'] += 1
+            return
+        self.connect_latency.append(time.perf_counter() - started)
+
+        for run in range(self.args.runs):
+            kind = self.mix[(index + run) % len(self.mix)]
+            token = f"s{index}r{run}"
+            code, inputs, expected = PROGRAMS[kind](token, self.args.size)
+            self._run(client, kind, token, code, list(inputs), expected)
+            socketio.sleep(self.args.think)
+        client.disconnect()
+
+    def _run(self, client, kind, token, code, inputs, expected):
+        socketio = self.server.socketio
+        self.counts['runs'] += 1
+        received = []
+        first_output = None
+        status = 'timeout'
+        submitted = time.perf_counter()
+        client.emit('execute_code', {'code': code})
+
+        deadline = submitted + self.args.timeout
+        while time.perf_counter() < deadline and status == 'timeout':
+            for name, data in self._receive(client):
+                if name == 'output':
+                    if first_output is None:
+                        first_output = time.perf_counter() - submitted
+                    if data.get('type') == 'stdout':
+                        received.extend(data.get('lines') or [])
+                    elif data.get('type') in ('error', 'stderr'):
+                        self.failures.append(f"{token}: {data.get('lines') or data.get('text')}")
+                elif name == 'input_request':
+                    if inputs:
+                        client.emit('provide_input', {'input': inputs.pop(0)})
+                elif name == 'execution_rejected':
+                    status = 'rejected'
+                elif name == 'execution_finished':
+                    status = 'finished'
+            if status == 'timeout':
+                socketio.sleep(0.005)
+
+        self.counts[status] += 1
+        if status != 'finished':
+            return
+        self.run_latency[kind].append(time.perf_counter() - submitted)
+        if first_output is not None:
+            self.first_output.append(first_output)
+
+        # Every line names its session and run, so foreign lines are misrouted
+        mine = []
+        for line in received:
+            match = TOKEN.search(line)
+            if match and match.group(0) != token:
+                self.counts['misrouted_lines'] += 1
+            else:
+                mine.append(line)
+        missing = collections.Counter(expected) - collections.Counter(mine)
+        self.counts['expected_lines'] += len(expected)
+        self.counts['dropped_lines'] += sum(missing.values())
+
+    def run(self):
+        started = time.perf_counter()
+        done = queue.Queue()
+
+        def simulate(index):
+            try:
+                self.session(index)
+            except Exception as e:
+                self.failures.append(f"session {index}: {e!r}")
+            finally:
+                done.put(index)
+
+        for index in range(self.args.sessions):
+            self.server.socketio.start_background_task(simulate, index)
+        for _ in range(self.args.sessions):
+            done.get()
+        self.elapsed = time.perf_counter() - started
+
+    def report(self):
+        all_runs = [value for values in self.run_latency.values() for value in values]
+        return {
+            'sessions': self.args.sessions,
+            'backend': self.server.EXECUTION_BACKEND if self.server.process_workers is not None else 'thread',
+            'elapsed_s': round(self.elapsed, 2),
+            'runs_per_s': round(self.counts['finished'] / self.elapsed, 2) if self.elapsed else None,
+            'runs': {key: self.counts[key] for key in ('runs', 'finished', 'rejected', 'timeout', 'connect_failed')},
+            'connect_ms': summarize(self.connect_latency),
+            'first_output_ms': summarize(self.first_output),
+            'run_ms': summarize(all_runs),
+            'run_ms_by_program': {kind: summarize(values) for kind, values in sorted(self.run_latency.items())},
+            'output': {key: self.counts[key] for key in ('expected_lines', 'dropped_lines', 'misrouted_lines')},
+            'program_errors': self.failures[:10],
+        }
+
+    def failed(self):
+        return bool(self.counts['timeout'] or self.counts['connect_failed'] or self.failures
+                    or self.counts['dropped_lines'] or self.counts['misrouted_lines'])
+
+
+def print_report(report):
+    print(f"{report['sessions']} sessions on the {report['backend']} backend, "
+          f"{report['elapsed_s']} s, {report['runs_per_s']} runs/s")
+    print("runs:", ', '.join(f"{key} {value}" for key, value in report['runs'].items()))
+    rows = [('connect', report['connect_ms']), ('first output', report['first_output_ms']),
+            ('run (all)', report['run_ms'])]
+    rows += [(f"run ({kind})", summary) for kind, summary in report['run_ms_by_program'].items()]
+    print(f"{'latency ms':<16}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for label, summary in rows:
+        print(f"{label:<16}{summary['count']:>8}" +
+              ''.join(f"{'-' if summary[key] is None else summary[key]:>10}" for key in ('p50', 'p95', 'p99', 'max')))
+    output = report['output']
+    print(f"output: {output['expected_lines']} lines expected, {output['dropped_lines']} dropped, "
+          f"{output['misrouted_lines']} misrouted")
+    for error in report['program_errors']:
+        print("error:", error)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the Noobie Socket.IO server in-process")
+    parser.add_argument('--sessions', type=int, default=20, help="concurrent simulated sessions")
+    parser.add_argument('--runs', type=int, default=3, help="programs run by each session")
+    parser.add_argument('--mix', default='loop,flood,listen',
+                        help=f"comma-separated programs, from {', '.join(PROGRAMS)}")
+    parser.add_argument('--size', type=int, default=50,
+                        help="work per program: loop iterations x100, flood lines /10, LISTEN base value")
+    parser.add_argument('--ramp', type=float, default=1.0, help="seconds over which sessions connect")
+    parser.add_argument('--think', type=float, default=0.1, help="pause between a session's runs")
+    parser.add_argument('--timeout', type=float, default=60.0, help="seconds before a run counts as lost")
+    parser.add_argument('--backend', choices=('process', 'thread'), help="overrides EXECUTION_BACKEND")
+    parser.add_argument('--compact', action='store_true', help="use the compact binary encoding")
+    parser.add_argument('--result-cache', action='store_true',
+                        help="keep the result cache on; by default every run executes")
+    parser.add_argument('--incremental', action='store_true',
+                        help="keep checkpoint resumes on; by default every run starts from line 1")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args()
+    unknown = set(args.mix.split(',')) - set(PROGRAMS)
+    if unknown:
+        parser.error(f"unknown programs: {', '.join(sorted(unknown))}")
+
+    # The server reads its settings when imported
+    if args.backend:
+        os.environ['EXECUTION_BACKEND'] = args.backend
+    if not args.result_cache:
+        os.environ['RESULT_CACHE_BYTES'] = '0'
+    if not args.incremental:
+        os.environ['CHECKPOINT_OUTPUT_BYTES'] = '0'
+    os.environ.setdefault('REAPER_INTERVAL', '3600')
+    os.environ.pop('SOCKETIO_MESSAGE_QUEUE', None)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as server
+
+    test = LoadTest(server, args)
+    try:
+        # The server logs every connection on stdout
+        with contextlib.redirect_stdout(io.StringIO()):
+            test.run()
+    finally:
+        if server.process_workers is not None:
+            server.process_workers.shutdown()
+    report = test.report()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    sys.exit(1 if test.failed() else 0)
+
+
+if __name__ == '__main__':
+    main()
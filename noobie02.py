@@ -1,15 +1,516 @@
 import sys
 import re
+import json
+import time
+import zlib
+import random
+import keyword
+import threading
 from func import *
-from typing import Dict, List, Optional, Callable, Tuple
+from collections import ChainMap, OrderedDict
+from dataclasses import dataclass, asdict, field
+from typing import Any, Dict, List, Optional, Callable, Tuple, NamedTuple, Iterable
+
+class ArgumentRule(NamedTuple):
+    """Allowed number of parts (command included) for a command"""
+    min_parts: int
+    max_parts: Optional[int]
+    message: str
+    excess_message: Optional[str] = None
+
+# Argument rules shared by the command handlers and the static validator
+ARGUMENT_RULES: Dict[str, ArgumentRule] = {
+    'say': ArgumentRule(2, None, "SAY command requires a message"),
+    'create': ArgumentRule(3, None, "CREATE command requires at least 2 arguments"),
+    'listen': ArgumentRule(3, None, "LISTEN command requires at least type and prompt"),
+    'change': ArgumentRule(3, None, "CHANGE command requires variable name and new value"),
+    'convert': ArgumentRule(3, 3, "CONVERT command requires variable name and new type"),
+    'random': ArgumentRule(4, 5, "RANDOM command requires type, min, and max values",
+                           "RANDOM command has too many arguments"),
+    'round': ArgumentRule(3, 3, "ROUND command requires variable name and precision"),
+    'del': ArgumentRule(2, 2, "DEL command requires exactly one variable name"),
+    'reset': ArgumentRule(2, 2, "RESET command requires exactly one variable name"),
+    'increment': ArgumentRule(2, 2, "INCREMENT command requires exactly one variable name"),
+    'decrement': ArgumentRule(2, 2, "DECREMENT command requires exactly one variable name"),
+    'swap': ArgumentRule(3, 3, "SWAP command requires exactly two variable names"),
+    'uppercase': ArgumentRule(2, 2, "UPPERCASE command requires exactly one variable name"),
+    'lowercase': ArgumentRule(2, 2, "LOWERCASE command requires exactly one variable name"),
+    'reverse': ArgumentRule(2, 2, "REVERSE command requires exactly one variable name"),
+    'call': ArgumentRule(2, None, "CALL command requires a function name and its arguments"),
+    'return': ArgumentRule(1, None, "RETURN command takes an optional value"),
+}
+
+# Operators that make an unknown line be evaluated as a bare expression
+EXPRESSION_OPERATORS = ['+', '-', '*', '/', '//', '%', '**', '==', '!=', '<', '>',
+                        'AND', 'OR', 'NOT', 'XOR', 'and', 'or', 'not', 'xor']
+
+# Quoted strings, kept as they are, and @/? references outside them
+QUOTED_OR_REFERENCE = re.compile(r'"[^"]*"?|\'[^\']*\'?|[@?]\w+')
+# Pieces of a mixed message: quoted text or a bare variable name
+MESSAGE_PART = re.compile(r'"([^"]*)"?|\'([^\']*)\'?|([^\s"\']+)')
+
+def check_arguments(parts: List[str]):
+    """Raise a NoobieError if parts do not satisfy the command's argument rule"""
+    rule = ARGUMENT_RULES.get(parts[0].lower())
+    if rule is None:
+        return
+    if len(parts) < rule.min_parts:
+        raise NoobieError(rule.message)
+    if rule.max_parts is not None and len(parts) > rule.max_parts:
+        raise NoobieError(rule.excess_message or rule.message)
+
+# Lines opening a block closed by ENDO, once lowercased
+BLOCK_OPENERS = ('if ', 'while ', 'function ')
+
+IDENTIFIER = re.compile(r'[a-zA-Z_]\w*')
+# FUNCTION name(a, b) DO and CALL name(1, @x) [INTO var]
+SIGNATURE_PATTERN = re.compile(r'([a-zA-Z_]\w*)\s*\((.*)\)', re.S)
+CALL_PATTERN = re.compile(r'([a-zA-Z_]\w*)\s*\((.*)\)(?:\s+into\s+(\S+))?', re.I | re.S)
+
+def parse_signature(text: str) -> Tuple[str, List[str]]:
+    """Split a FUNCTION signature 'name(a, b)' into its lowercase name and parameters"""
+    match = SIGNATURE_PATTERN.fullmatch(text.strip())
+    if not match:
+        raise NoobieError(f"invalid FUNCTION signature '{text}', expected name(parameters)")
+    params = [param.strip().lower() for param in match.group(2).split(',')] if match.group(2).strip() else []
+    for param in params:
+        if not IDENTIFIER.fullmatch(param):
+            raise NoobieError(f"invalid parameter name: '{param}'")
+        if param == 'end':
+            raise NoobieError("cannot use 'end' as variable name (reserved for newline)")
+    if len(set(params)) != len(params):
+        raise NoobieError("duplicate parameter name in FUNCTION signature")
+    return match.group(1).lower(), params
+
+def split_arguments(text: str) -> List[str]:
+    """Split CALL arguments on the commas outside quotes, braces and parentheses"""
+    arguments = []
+    current = []
+    depth = 0
+    quote = None
+    for char in text:
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char in '({':
+            depth += 1
+        elif char in ')}':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            arguments.append(''.join(current).strip())
+            current = []
+            continue
+        current.append(char)
+    arguments.append(''.join(current).strip())
+    if arguments == ['']:
+        return []
+    if '' in arguments:
+        raise NoobieError("empty argument in CALL")
+    return arguments
+
+def parse_call(text: str) -> Tuple[str, List[str], Optional[str]]:
+    """Split 'name(arguments) [INTO var]' into the lowercase name, the argument texts and the target"""
+    match = CALL_PATTERN.fullmatch(text.strip())
+    if not match:
+        raise NoobieError("invalid CALL, expected CALL name(arguments) [INTO variable]")
+    into = match.group(3)
+    if into is not None:
+        if not IDENTIFIER.fullmatch(into):
+            raise NoobieError(f"invalid variable name for INTO: '{into}'")
+        into = into.lower()
+        if into == 'end':
+            raise NoobieError("cannot use 'end' as variable name (reserved for newline)")
+    return match.group(1).lower(), split_arguments(match.group(2)), into
+
+MAX_WHILE_ITERATIONS = 10000
+# Nested CALLs allowed before a run is considered a runaway recursion
+MAX_CALL_DEPTH = 1000
+# Results of pure functions remembered per interpreter, least recently used dropped first
+MEMO_CACHE_SIZE = 1024
+
+# Bump whenever a change alters what a program prints; cached results are keyed on it
+INTERPRETER_VERSION = '0.3.0'
+
+# snapshot() output starts with the magic and a format byte; bump the format
+# whenever the snapshot layout changes
+SNAPSHOT_MAGIC = b'NBSNAP'
+SNAPSHOT_FORMAT = 2
+
+@dataclass
+class BlockFrame:
+    """A (start, end) span of the shared line array being executed"""
+    start: int
+    end: int
+    pc: int
+    header: Optional[int] = None  # index of the WHILE header for loop bodies
+    iterations: int = 0
+
+# (lines, line_offset, block cache, statement cache) that spans are executed in
+Context = Tuple[List[str], int, Dict[int, Tuple[str, Optional[int], int]], Dict[int, Tuple[str, List[Token]]]]
+
+@dataclass
+class Function:
+    """A FUNCTION definition: its parameters and the body span of the lines it was defined in"""
+    params: List[str]
+    start: int
+    end: int
+    context: Context
+    pure_body: bool  # see function_effects()
+    callees: set
+    pure: Optional[bool] = None  # pure_body holds for every function it can reach; worked out on first CALL
+
+@dataclass
+class CallFrame:
+    """A CALL in progress; its body runs in frames[depth:]"""
+    function: str
+    depth: int
+    into: Optional[str]
+    line_number: int
+    locals: Dict[str, Variable]
+    caller: Context  # restored on return
+    memo_key: Optional[str] = None  # set for pure functions, whose result is remembered
+    sizes: Dict[str, int] = field(default_factory=dict)  # tracked sizes of its locals
+
+class ExecutionStopped(NoobieError):
+    """Raised at a checkpoint once a stop has been requested"""
+
+class StatementLimitExceeded(NoobieError):
+    """Raised when a run executes more statements than its statement_limit"""
+
+class MemoryLimitExceeded(NoobieError):
+    """Raised when a run's variable values and buffered output outgrow its memory_limit"""
+
+class InputRequired(NoobieError):
+    """Raised by LISTEN in a suspendable run that has no input to consume yet"""
+    def __init__(self, prompt: str):
+        super().__init__("input required")
+        self.prompt = prompt
+
+class ExecutionControl:
+    """Stop/pause token shared between a running interpreter and its controller"""
+    def __init__(self):
+        self.interrupted = False  # cheap flag: a stop or pause is pending
+        self.cancelled = False
+        self.relay: Optional[Callable[[str], None]] = None  # forwards requests to another process
+        self._resume = threading.Event()
+        self._resume.set()
+    
+    @property
+    def paused(self) -> bool:
+        return not self._resume.is_set()
+    
+    def stop(self):
+        self.cancelled = True
+        self.interrupted = True
+        self._resume.set()
+        self._forward('stop')
+    
+    def pause(self):
+        self._resume.clear()
+        self.interrupted = True
+        self._forward('pause')
+    
+    def resume(self):
+        self._resume.set()
+        self.interrupted = self.cancelled
+        self._forward('resume')
+    
+    def clear(self):
+        """Forget earlier requests before a new run"""
+        self.cancelled = False
+        self.interrupted = False
+        self._resume.set()
+    
+    def checkpoint(self, line_number: Optional[int] = None):
+        """Block while paused and raise ExecutionStopped once stopped"""
+        self._resume.wait()
+        if self.cancelled:
+            raise ExecutionStopped("execution stopped", line_number)
+    
+    def _forward(self, op: str):
+        relay = self.relay
+        if relay is not None:
+            relay(op)
+
+# Commands whose effect a later run cannot reproduce from the code alone
+NONDETERMINISTIC_COMMANDS = {'random', 'listen'}
+
+class RunJournal:
+    """Variable checkpoints taken at a run's top-level statement boundaries.
+
+    A later run of edited code resumes from the last checkpoint before its
+    first changed line and replays the output written up to there. Each
+    checkpoint keeps only the variables changed since the previous one, and
+    the header lines of the functions defined when they changed.
+    Recording stops at the first RANDOM or LISTEN, and once the output
+    kept for replay would exceed max_output characters.
+    """
+    def __init__(self, lines: List[str], max_output: int):
+        self.lines = lines
+        self.max_output = max_output
+        # [index, statements, in_comment_block, output length, changed, deleted, functions or None]
+        self.checkpoints: List[list] = []
+        self.output: List[str] = []
+        self.output_size = 0
+        self.recording = True
+        self._values: Dict[str, list] = {}
+        self._functions: Dict[str, int] = {}
+
+    def record(self, index: int, interpreter: 'NoobieInterpreter'):
+        """Checkpoint the interpreter's state before top-level statement index"""
+        if not self.recording or (self.checkpoints and self.checkpoints[-1][0] == index):
+            return
+        values = encode_variables(interpreter.variables)
+        changed = {name: value for name, value in values.items() if self._values.get(name) != value}
+        deleted = [name for name in self._values if name not in values]
+        self._values = values
+        functions = {name: function.start - 1 for name, function in interpreter.functions.items()}
+        if functions == self._functions:
+            functions = None
+        else:
+            self._functions = functions
+        statements = interpreter.statements_skipped + interpreter.statements
+        self.checkpoints.append([index, statements, interpreter.in_comment_block, self.output_size,
+                                 changed, deleted, functions])
+
+    def write(self, text: str):
+        if not self.recording:
+            return
+        self.output.append(text)
+        self.output_size += len(text)
+        if self.output_size > self.max_output:
+            self.stop()
+
+    def stop(self):
+        """Record nothing more; output past the last checkpoint is never replayed"""
+        if not self.recording:
+            return
+        self.recording = False
+        kept = self.checkpoints[-1][3] if self.checkpoints else 0
+        self.output = [''.join(self.output)[:kept]]
+        self.output_size = kept
+
+    def continue_from(self, previous: 'RunJournal') -> Optional[Tuple[int, int, bool, Dict[str, list], Dict[str, int], str]]:
+        """Adopt previous's checkpoints up to the first line where our code differs.
+
+        Returns (index, statements, in_comment_block, variables, functions,
+        output) of the checkpoint to resume from, functions mapping each
+        defined function to its header line, or None when nothing can be skipped.
+        """
+        count = min(len(previous.lines), len(self.lines))
+        changed_at = next((i for i in range(count) if previous.lines[i] != self.lines[i]), count)
+        position = len(previous.checkpoints)
+        while position and previous.checkpoints[position - 1][0] > changed_at:
+            position -= 1
+        if not position or previous.checkpoints[position - 1][0] == 0:
+            return None
+
+        checkpoints = previous.checkpoints[:position]
+        values: Dict[str, list] = {}
+        functions: Dict[str, int] = {}
+        for _, _, _, _, changed, deleted, defined in checkpoints:
+            for name in deleted:
+                values.pop(name, None)
+            values.update(changed)
+            if defined is not None:
+                functions = defined
+        index, statements, in_comment_block, output_size = checkpoints[-1][:4]
+        output = ''.join(previous.output)[:output_size]
+
+        self.checkpoints = list(checkpoints)
+        self.output = [output]
+        self.output_size = output_size
+        self._values = values
+        self._functions = functions
+        return index, statements, in_comment_block, dict(values), dict(functions), output
+
+    def to_dict(self) -> Dict[str, Any]:
+        """JSON-friendly form for from_dict(), possibly in another process"""
+        return {
+            'lines': self.lines,
+            'max_output': self.max_output,
+            'checkpoints': self.checkpoints,
+            'output': ''.join(self.output),
+            'recording': self.recording,
+            'values': self._values,
+            'functions': self._functions,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'RunJournal':
+        journal = cls(list(data['lines']), data['max_output'])
+        journal.checkpoints = data['checkpoints']
+        journal.output = [data['output']]
+        journal.output_size = len(data['output'])
+        journal.recording = data['recording']
+        journal._values = data['values']
+        journal._functions = data.get('functions', {})
+        return journal
 
 class NoobieInterpreter:
     """Main interpreter class for the Noobie language"""
-    def __init__(self):
+    def __init__(self, output=None, error_output=None, input_provider: Optional[Callable[[str], str]] = None,
+                 control: Optional[ExecutionControl] = None):
+        # IO sinks; None falls back to the current sys.stdout, sys.stderr and input()
+        self.output = output
+        self.error_output = error_output
+        self.input_provider = input_provider
+        # Owned by the caller, so reset() leaves pending stop/pause requests alone
+        self.control = control or ExecutionControl()
         self.in_comment_block = False
         self.variables: Dict[str, Variable] = {}
+        # Top-level variables; while a CALL runs, self.variables layers its locals over them
+        self.global_variables = self.variables
+        self.functions: Dict[str, Function] = {}
+        self.calls: List[CallFrame] = []
+        # memo key -> [type, value] returned (or None), see _handle_call()
+        self.memo: 'OrderedDict[str, Optional[list]]' = OrderedDict()
+        self.lines: List[str] = []
+        self.line_offset = 0
+        self.frames: List[BlockFrame] = []
+        self._blocks: Dict[int, Tuple[str, Optional[int], int]] = {}
+        # index -> (line without its comment, tokens), lexed once per run
+        self._statements: Dict[int, Tuple[str, List[Token]]] = {}
+        # Suspendable runs (start/resume) park at LISTEN instead of blocking on input
+        self.suspendable = False
+        self.pending_input: Optional[str] = None
+        # Block being entered line by line, see take_statement()
+        self.open_block: List[str] = []
+        self.open_block_start = 0
+        self.open_block_depth = 0
+        # Cheap run counters, see run_stats()
+        self.statements = 0
+        self.errors = 0
+        self.block_cache_hits = 0
+        self.block_cache_misses = 0
+        self.memo_hits = 0
+        self.last_error: Optional[NoobieError] = None  # error that ended the last run
+        self.statement_limit: Optional[int] = None
+        # Bytes of variable values and buffered output a run may hold; sizes are
+        # tracked on each write while it is set, see _account()
+        self.memory_limit: Optional[int] = None
+        self.value_bytes = 0
+        self.value_sizes: Dict[str, int] = {}  # global variable -> tracked size
+        self.deadline: Optional[float] = None  # time.monotonic() at which the run is stopped
+        self.cooperative = False  # yield to other green threads now and then, for in-server runs
+        self.rng = random.Random()  # seed it for reproducible RANDOM results
+        # With journal_limit set, start() records a RunJournal keeping up to that much output
+        self.journal_limit: Optional[int] = None
+        self.journal: Optional[RunJournal] = None
+        self.statements_skipped = 0  # statements an earlier run executed for this one
         self.command_handlers = self._initialize_command_handlers()
     
+    def reset(self):
+        """Return the interpreter to a clean state, keeping its command handlers"""
+        self._leave_calls()
+        self.in_comment_block = False
+        self.variables.clear()
+        self.functions = {}
+        self.memo.clear()
+        self.lines = []
+        self.line_offset = 0
+        self.frames = []
+        self._blocks = {}
+        self._statements = {}
+        self.suspendable = False
+        self.pending_input = None
+        self.open_block = []
+        self.open_block_depth = 0
+        self.statements = 0
+        self.errors = 0
+        self.block_cache_hits = 0
+        self.block_cache_misses = 0
+        self.memo_hits = 0
+        self.value_bytes = 0
+        self.value_sizes = {}
+        self.last_error = None
+        self.rng.seed()
+        self.journal = None
+        self.statements_skipped = 0
+    
+    def _write(self, text: str):
+        """Write program output to this interpreter's output sink"""
+        (self.output or sys.stdout).write(text)
+        if self.journal is not None:
+            self.journal.write(text)
+        if self.memory_limit is not None:
+            self._check_memory()
+    
+    def _read_input(self, prompt: str) -> str:
+        """Ask this interpreter's input provider for a line of input"""
+        if self.pending_input is not None:
+            text, self.pending_input = self.pending_input, None
+            return text
+        if self.suspendable:
+            raise InputRequired(prompt)
+        text = self.input_provider(prompt) if self.input_provider is not None else input(prompt)
+        # A stop issued while waiting for input ends the run here
+        if self.control.interrupted:
+            self.control.checkpoint()
+        return text
+    
+    def _account(self, name: str):
+        """Track the size of variable name's value after a write to it"""
+        if self.memory_limit is None:
+            return
+        sizes = self._sizes_for(name)
+        variable = self.variables[name]
+        size = sys.getsizeof(variable.value)
+        grown = size - sizes.get(name, 0)
+        sizes[name] = size
+        self.value_bytes += grown
+        if grown > 0:
+            try:
+                self._check_memory()
+            except MemoryLimitExceeded:
+                # The value that broke the limit is not kept
+                variable.value = initialize_variable(variable.type, None)
+                self._account(name)
+                raise
+    
+    def _forget(self, name: str):
+        """Stop tracking variable name, before it is deleted"""
+        if self.memory_limit is not None:
+            self.value_bytes -= self._sizes_for(name).pop(name, 0)
+    
+    def _sizes_for(self, name: str) -> Dict[str, int]:
+        if self.calls and name in self.calls[-1].locals:
+            return self.calls[-1].sizes
+        return self.value_sizes
+    
+    def _recount(self):
+        """Measure every variable again, after variables were loaded as a whole"""
+        self.value_sizes = {name: sys.getsizeof(var.value) for name, var in self.global_variables.items()}
+        self.value_bytes = sum(self.value_sizes.values())
+        for call in self.calls:
+            call.sizes = {name: sys.getsizeof(var.value) for name, var in call.locals.items()}
+            self.value_bytes += sum(call.sizes.values())
+    
+    def _memory_held(self) -> int:
+        """Bytes of tracked values and buffered output the run holds"""
+        held = self.value_bytes
+        if self.journal is not None:
+            held += self.journal.output_size
+        # Output sinks that keep output in memory report how much
+        for sink in (self.output, self.error_output):
+            measure = getattr(sink, 'buffered_bytes', None)
+            if measure is not None:
+                held += measure()
+        return held
+    
+    def _check_memory(self, adding: int = 0):
+        """Raise MemoryLimitExceeded once values and buffered output, plus adding
+        bytes about to be built, exceed memory_limit"""
+        if self._memory_held() + adding > self.memory_limit:
+            raise MemoryLimitExceeded(f"memory limit exceeded ({self.memory_limit} bytes)")
+    
+    def _size_check(self) -> Optional[Callable[[int], None]]:
+        """The guard expressions estimate their large results against, before
+        building them, while a memory_limit is set"""
+        return self._check_memory if self.memory_limit is not None else None
+    
     def _initialize_command_handlers(self) -> Dict[str, Callable]:
         """Initialize command handlers for better maintainability"""
         return {
@@ -31,12 +532,14 @@ class NoobieInterpreter:
             'decrement': self._handle_decrement,
             'uppercase': self._handle_uppercase,
             'lowercase': self._handle_lowercase,
+            'call': self._handle_call,
+            'return': self._handle_return,
         }
     
     def _evaluate_expression_with_parentheses(self, expression: str) -> Any:
         """Evaluate expression with better error handling"""
         try:
-            result = evaluate_expression(expression, self.variables)
+            result = evaluate_expression(expression, self.variables, self._size_check())
             # Convert None to "null" for display
             if result is None:
                 return "null"
@@ -90,41 +593,17 @@ class NoobieInterpreter:
     
     def _reconstruct_from_original_line(self, parts: List[str], start_index: int) -> str:
         """Reconstruct string from original line, preserving only spaces inside quotes"""
-        # Join the parts back with spaces, then parse more carefully
-        original = ' '.join(parts[start_index:])
-        result = ""
-        i = 0
-        
-        while i < len(original):
-            if original[i] in ['"', "'"]:
-                # Found start of quoted string
-                quote_char = original[i]
-                i += 1  # Skip opening quote
-                # Find matching closing quote and preserve all content inside including spaces
-                quote_content = ""
-                while i < len(original) and original[i] != quote_char:
-                    quote_content += original[i]
-                    i += 1
-                if i < len(original):  # Skip closing quote
-                    i += 1
-                result += quote_content
-            elif original[i].isspace():
-                # Skip spaces between parts (don't preserve them)
-                i += 1
+        pieces = []
+        for match in MESSAGE_PART.finditer(' '.join(parts[start_index:])):
+            quoted = match.group(1) if match.group(1) is not None else match.group(2)
+            if quoted is not None:
+                pieces.append(quoted)
+            # Handle special END variable (case insensitive)
+            elif match.group(3).lower() == "end":
+                pieces.append("@end")
             else:
-                # Found start of variable name
-                var_name = ""
-                while i < len(original) and not original[i].isspace() and original[i] not in ['"', "'"]:
-                    var_name += original[i]
-                    i += 1
-                
-                # Handle special END variable (case insensitive)
-                if var_name.lower() == "end":
-                    result += "@end"
-                else:
-                    result += f"@{var_name}"
-        
-        return result
+                pieces.append(f"@{match.group(3)}")
+        return ''.join(pieces)
     
     def _extract_expression(self, message: str) -> str:
         """Extract and execute expressions in curly braces"""
@@ -163,20 +642,28 @@ class NoobieInterpreter:
             else:
                 return bool(result)
                 
+        except MemoryLimitExceeded:
+            raise
         except Exception as e:
             raise NoobieError(f"error evaluating condition '{condition}': {e}")
     
+    @staticmethod
+    def _block_depth_change(line: str) -> int:
+        """Return +1 for a line opening an IF/WHILE/FUNCTION block, -1 for ENDO, 0 otherwise"""
+        line = strip_comment(line).lower()
+        if line.startswith(BLOCK_OPENERS):
+            return 1
+        if line == 'endo':
+            return -1
+        return 0
+    
     def _find_matching_endo(self, lines: List[str], start_index: int, block_type: str = "if") -> int:
-        """Find the matching ENDO for an IF or WHILE statement"""
+        """Find the matching ENDO for an IF, WHILE or FUNCTION statement"""
         block_count = 1
         for i in range(start_index + 1, len(lines)):
-            line = lines[i].strip().lower()
-            if line.startswith('if ') or line.startswith('while '):
-                block_count += 1
-            elif line == 'endo':
-                block_count -= 1
-                if block_count == 0:
-                    return i
+            block_count += self._block_depth_change(lines[i])
+            if block_count == 0:
+                return i
         
         raise NoobieError(f"missing ENDO for {block_type.upper()} statement")
     
@@ -184,8 +671,8 @@ class NoobieInterpreter:
         """Find ELSE at the same nesting level within an IF block"""
         block_count = 0
         for i in range(start_index + 1, end_index):
-            line = lines[i].strip().lower()
-            if line.startswith('if ') or line.startswith('while '):
+            line = strip_comment(lines[i]).lower()
+            if line.startswith(BLOCK_OPENERS):
                 block_count += 1
             elif line == 'endo':
                 block_count -= 1
@@ -202,45 +689,51 @@ class NoobieInterpreter:
         """Handle WHILE command - this is called when we encounter WHILE in single-line mode"""
         raise NoobieError("WHILE command should be handled in multiline context")
     
-    def _execute_if_else_block(self, condition: str, if_lines: List[str], else_lines: Optional[List[str]] = None):
-        """Execute an IF/ELSE block based on condition"""
-        if self._evaluate_condition(condition):
-            # Execute IF block
-            if if_lines:
-                block_code = '\n'.join(if_lines)
-                temp_interpreter = NoobieInterpreter()
-                temp_interpreter.variables = self.variables.copy()  # Share variables
-                temp_interpreter.interpret(block_code)
-                # Update our variables with any changes
-                self.variables.update(temp_interpreter.variables)
+    def _block_at(self, index: int, header_parts: List[Token], block_type: str) -> Tuple[str, Optional[int], int]:
+        """Return (condition, else index, endo index) for the block header at index"""
+        block = self._blocks.get(index)
+        if block is not None:
+            self.block_cache_hits += 1
         else:
-            # Execute ELSE block if it exists
-            if else_lines:
-                block_code = '\n'.join(else_lines)
-                temp_interpreter = NoobieInterpreter()
-                temp_interpreter.variables = self.variables.copy()  # Share variables
-                temp_interpreter.interpret(block_code)
-                # Update our variables with any changes
-                self.variables.update(temp_interpreter.variables)
-    
-    def _execute_while_block(self, condition: str, while_lines: List[str], max_iterations: int = 10000):
-        """Execute a WHILE block repeatedly while condition is true"""
-        iteration_count = 0
-        
-        while self._evaluate_condition(condition):
-            # Safety check to prevent infinite loops
-            iteration_count += 1
-            if iteration_count > max_iterations:
-                raise NoobieError(f"WHILE loop exceeded maximum iterations ({max_iterations}). Possible infinite loop.")
+            self.block_cache_misses += 1
+            line_number = index + 1 + self.line_offset
+            if len(header_parts) < 3 or header_parts[-1].lower() != 'do':
+                raise NoobieError(f"{block_type.upper()} statement must end with DO", line_number)
             
-            # Execute WHILE block
-            if while_lines:
-                block_code = '\n'.join(while_lines)
-                temp_interpreter = NoobieInterpreter()
-                temp_interpreter.variables = self.variables.copy()  # Share variables
-                temp_interpreter.interpret(block_code)
-                # Update our variables with any changes
-                self.variables.update(temp_interpreter.variables)
+            # Extract condition (everything between IF/WHILE and DO)
+            condition = ' '.join(header_parts[1:-1])
+            
+            try:
+                endo_index = self._find_matching_endo(self.lines, index, block_type)
+            except NoobieError as e:
+                e.line_number = line_number
+                raise
+            
+            else_index = self._find_else_in_block(self.lines, index, endo_index) if block_type == 'if' else None
+            block = self._blocks[index] = (condition, else_index, endo_index)
+        return block
+    
+    def _check_block_condition(self, condition: str, header_index: int) -> bool:
+        """Evaluate a block condition, reporting errors on the header line"""
+        try:
+            return self._evaluate_condition(condition)
+        except NoobieError as e:
+            if e.line_number is None:
+                e.line_number = header_index + 1 + self.line_offset
+            raise
+    
+    def _repeat_while(self, frame: BlockFrame) -> bool:
+        """Loop back-edge of a WHILE frame: decide whether to run the body again"""
+        condition = self._blocks[frame.header][0]
+        if not self._check_block_condition(condition, frame.header):
+            return False
+        
+        # Safety check to prevent infinite loops
+        frame.iterations += 1
+        if frame.iterations > MAX_WHILE_ITERATIONS:
+            raise NoobieError(f"WHILE loop exceeded maximum iterations ({MAX_WHILE_ITERATIONS}). Possible infinite loop.",
+                              frame.header + 1 + self.line_offset)
+        return True
     
     def _handle_exit(self, parts: List[str], line_number: int):
         """Handle EXIT command"""
@@ -251,21 +744,20 @@ class NoobieInterpreter:
             message = self._parse_mixed_string_command(parts, 1)
             message = replace_variables(message, self.variables)
             message = self._extract_expression(message)
-            print(message, end='')  # Rimuove l'andata a capo automatica
+            self._write(message)  # Rimuove l'andata a capo automatica
             sys.exit(0)
         else:
             raise NoobieError("EXIT command requires at most one argument")
     
     def _handle_say(self, parts: List[str], line_number: int):
         """Handle SAY command"""
-        if len(parts) < 2:
-            raise NoobieError("SAY command requires a message")
+        check_arguments(parts)
         
         # Parse message (supporting both traditional and decomposed strings)
         message = self._parse_mixed_string_command(parts, 1)
         message = replace_variables(message, self.variables)
         message = self._extract_expression(message)
-        print(message, end='')  # Rimuove l'andata a capo automatica
+        self._write(message)  # Rimuove l'andata a capo automatica
     
     def _validate_bool_value(self, value_str: str) -> bool:
         """Validate and convert BOOL value, accepting only true, false, null (case insensitive)"""
@@ -281,8 +773,7 @@ class NoobieInterpreter:
     
     def _handle_create(self, parts: List[str], line_number: int):
         """Handle CREATE command with improved parsing for expressions in braces and variable references"""
-        if len(parts) < 3:
-            raise NoobieError("CREATE command requires at least 2 arguments")
+        check_arguments(parts)
         
         # Check if CONST is specified
         is_const = parts[1].lower() == 'const'
@@ -340,6 +831,8 @@ class NoobieInterpreter:
                     else:
                         value = evaluated_value
                         
+                except MemoryLimitExceeded:
+                    raise
                 except Exception as e:
                     raise NoobieError(f"error evaluating expression in CREATE command: {e}")
             else:
@@ -351,18 +844,18 @@ class NoobieInterpreter:
                     value = self._validate_bool_value(value_with_vars_replaced)
                 else:
                     # Handle regular value assignment
-                    value = initialize_variable(var_type, value_with_vars_replaced)
+                    value = initialize_variable(var_type, value_with_vars_replaced, self._size_check())
         else:
             # No value provided, use default
             value = initialize_variable(var_type, None)
         
         # Create the variable
         self.variables[var_name] = Variable(var_type, value, is_const)
+        self._account(var_name)
     
     def _handle_listen(self, parts: List[str], line_number: int):
         """Handle LISTEN command with new syntax: LISTEN <type> [<variable_name>] "prompt" """
-        if len(parts) < 3:
-            raise NoobieError("LISTEN command requires at least type and prompt")
+        check_arguments(parts)
         
         var_type = parts[1].upper()
         
@@ -371,7 +864,7 @@ class NoobieInterpreter:
             raise NoobieError(f"unsupported type: {var_type}")
         
         # Simple logic: if the third part starts with a quote, no variable name was provided
-        if parts[2].startswith('"') or parts[2].startswith("'"):
+        if parts[2].kind == 'string':
             # listen <type> "prompt..."
             var_name = "listened"
             prompt = self._parse_mixed_string_command(parts, 2)
@@ -392,24 +885,26 @@ class NoobieInterpreter:
         prompt = self._extract_expression(prompt)
         
         # Get user input (senza andata a capo automatica nel prompt)
-        user_input = input(prompt)
+        user_input = self._read_input(prompt)
         
         # Initialize the value with the correct type
         try:
             if var_type == "BOOL":
                 value = self._validate_bool_value(user_input)
             else:
-                value = initialize_variable(var_type, user_input)
+                value = initialize_variable(var_type, user_input, self._size_check())
+        except MemoryLimitExceeded:
+            raise
         except NoobieError as e:
             raise NoobieError(f"error converting input to {var_type}: {e}")
         
         # Store the variable
         self.variables[var_name] = Variable(var_type, value)
+        self._account(var_name)
     
     def _handle_change(self, parts: List[str], line_number: int):
         """Handle CHANGE command with support for variable references"""
-        if len(parts) < 3:
-            raise NoobieError("CHANGE command requires variable name and new value")
+        check_arguments(parts)
         
         var_name = parts[1].lower()
         new_value_raw = ' '.join(parts[2:])
@@ -434,14 +929,14 @@ class NoobieInterpreter:
             if var_type == "BOOL":
                 new_value = self._validate_bool_value(new_value_with_vars_replaced)
             else:
-                new_value = initialize_variable(var_type, new_value_with_vars_replaced)
+                new_value = initialize_variable(var_type, new_value_with_vars_replaced, self._size_check())
         
         self.variables[var_name].value = new_value
+        self._account(var_name)
     
     def _handle_convert(self, parts: List[str], line_number: int):
         """Handle CONVERT command with support for ?variable syntax to get variable type"""
-        if len(parts) != 3:
-            raise NoobieError("CONVERT command requires variable name and new type")
+        check_arguments(parts)
         
         var_name, new_type_param = parts[1].lower(), parts[2]
         
@@ -461,14 +956,15 @@ class NoobieInterpreter:
         else:
             new_type = new_type_param.upper()
         
+        # Converted in place, so a function converts the variable it sees
         old_var = self.variables[var_name]
-        new_value = convert_value(old_var.value, old_var.type, new_type)
-        self.variables[var_name] = Variable(new_type, new_value, old_var.const)
+        old_var.value = convert_value(old_var.value, old_var.type, new_type)
+        old_var.type = new_type
+        self._account(var_name)
     
     def _handle_random(self, parts: List[str], line_number: int):
         """Handle RANDOM command with support for variable references"""
-        if len(parts) < 4:
-            raise NoobieError("RANDOM command requires type, min, and max values")
+        check_arguments(parts)
         
         var_type = parts[1].upper()
         
@@ -509,25 +1005,23 @@ class NoobieInterpreter:
                 raise NoobieError(f"invalid max value for RANDOM: '{max_val_str}'")
         
         # Generate random value
-        result = randomize(min_val, max_val, var_type)
+        result = randomize(min_val, max_val, var_type, self.rng)
         
         # Handle output or variable assignment
         if len(parts) == 4:
-            print(result)
-        elif len(parts) == 5:
+            self._write(f"{result}\n")
+        else:
             var_name = parts[4].lower()
             if var_name == "end":
                 raise NoobieError("cannot use 'end' as variable name (reserved for newline)")
             if var_name in self.variables and self.variables[var_name].const:
                 raise NoobieError(f"cannot modify constant variable: '{var_name}'")
             self.variables[var_name] = Variable(var_type, result)
-        else:
-            raise NoobieError("RANDOM command has too many arguments")
+            self._account(var_name)
     
     def _handle_round(self, parts: List[str], line_number: int):
         """Handle ROUND command with support for variable references"""
-        if len(parts) != 3:
-            raise NoobieError("ROUND command requires variable name and precision")
+        check_arguments(parts)
         
         var_name = parts[1].lower()
         
@@ -565,22 +1059,26 @@ class NoobieInterpreter:
         # Apply rounding
         value = self.variables[var_name].value
         self.variables[var_name].value = round(value, precision)
+        self._account(var_name)
     
     def _handle_del(self, parts: List[str], line_number: int):
         """Handle DEL command"""
-        if len(parts) != 2:
-            raise NoobieError("DEL command requires exactly one variable name")
+        check_arguments(parts)
         
         var_name = parts[1].lower()
         if var_name not in self.variables:
             raise NoobieError(f"variable '{var_name}' not declared")
         
+        # Only a function's own variables can be deleted while it runs
+        if isinstance(self.variables, ChainMap) and var_name not in self.variables.maps[0]:
+            raise NoobieError(f"cannot delete global variable '{var_name}' inside a function")
+        
+        self._forget(var_name)
         del self.variables[var_name]
     
     def _handle_reset(self, parts: List[str], line_number: int):
         """Handle RESET command"""
-        if len(parts) != 2:
-            raise NoobieError("RESET command requires exactly one variable name")
+        check_arguments(parts)
         
         var_name = parts[1].lower()
         if var_name not in self.variables:
@@ -588,11 +1086,11 @@ class NoobieInterpreter:
         
         var_type = self.variables[var_name].type
         self.variables[var_name].value = initialize_variable(var_type, None)
+        self._account(var_name)
     
     def _handle_increment(self, parts: List[str], line_number: int):
         """Handle INCREMENT command"""
-        if len(parts) != 2:
-            raise NoobieError("INCREMENT command requires exactly one variable name")
+        check_arguments(parts)
         
         var_name = parts[1].lower()
         if var_name not in self.variables:
@@ -602,11 +1100,11 @@ class NoobieInterpreter:
             raise NoobieError("INCREMENT requires INT or FLOAT variable")
         
         self.variables[var_name].value += 1
+        self._account(var_name)
     
     def _handle_decrement(self, parts: List[str], line_number: int):
         """Handle DECREMENT command"""
-        if len(parts) != 2:
-            raise NoobieError("DECREMENT command requires exactly one variable name")
+        check_arguments(parts)
         
         var_name = parts[1].lower()
         if var_name not in self.variables:
@@ -616,11 +1114,11 @@ class NoobieInterpreter:
             raise NoobieError("DECREMENT requires INT or FLOAT variable")
         
         self.variables[var_name].value -= 1
+        self._account(var_name)
     
     def _handle_swap(self, parts: List[str], line_number: int):
         """Handle SWAP command"""
-        if len(parts) != 3:
-            raise NoobieError("SWAP command requires exactly two variable names")
+        check_arguments(parts)
         
         var1, var2 = parts[1].lower(), parts[2].lower()
         
@@ -632,11 +1130,12 @@ class NoobieInterpreter:
         
         self.variables[var1].value, self.variables[var2].value = \
             self.variables[var2].value, self.variables[var1].value
+        self._account(var1)
+        self._account(var2)
     
     def _handle_string_operation(self, parts: List[str], line_number: int, operation: str):
         """Generic handler for string operations"""
-        if len(parts) != 2:
-            raise NoobieError(f"{operation} command requires exactly one variable name")
+        check_arguments(parts)
         
         var_name = parts[1].lower()
         if var_name not in self.variables:
@@ -659,6 +1158,7 @@ class NoobieInterpreter:
             result = value[::-1]
         
         self.variables[var_name].value = result
+        self._account(var_name)
     
     def _handle_uppercase(self, parts: List[str], line_number: int):
         """Handle UPPERCASE command"""
@@ -672,258 +1172,959 @@ class NoobieInterpreter:
         """Handle REVERSE command"""
         self._handle_string_operation(parts, line_number, 'REVERSE')
     
-    def _process_line(self, line: str, line_number: int):
-        """Process a single line of code"""
-        # Handle comment blocks
-        if line.startswith('##'):
-            if not self.in_comment_block:
-                self.in_comment_block = True
-                return
-            else:
-                self.in_comment_block = False
+    def _handle_call(self, parts: List[str], line_number: int):
+        """Handle CALL name(arguments) [INTO variable]"""
+        check_arguments(parts)
+        
+        name, arguments, into = parse_call(' '.join(parts[1:]))
+        function = self.functions.get(name)
+        if function is None:
+            raise NoobieError(f"function '{name}' not defined")
+        if len(arguments) != len(function.params):
+            raise NoobieError(f"function '{name}' takes {len(function.params)} argument(s), got {len(arguments)}")
+        if into is not None and into in self.variables and self.variables[into].const:
+            raise NoobieError(f"cannot modify constant variable: '{into}'")
+        values = [self._argument_value(argument) for argument in arguments]
+        
+        # A pure function's result depends on its arguments only
+        memo_key = None
+        if self._is_pure(name):
+            memo_key = json.dumps([name, [[value.type, value.value] for value in values]])
+            if memo_key in self.memo:
+                self.memo.move_to_end(memo_key)
+                self.memo_hits += 1
+                result = self.memo[memo_key]
+                self._assign_result(name, into, Variable(*result) if result is not None else None)
                 return
         
-        if self.in_comment_block:
-            return
-        
-        # Remove single-line comments and strip whitespace
-        line = line.split('#', 1)[0].strip()
-        if not line:
+        if len(self.calls) >= MAX_CALL_DEPTH:
+            raise NoobieError(f"maximum call depth exceeded ({MAX_CALL_DEPTH})")
+        call = CallFrame(name, len(self.frames), into, line_number, dict(zip(function.params, values)),
+                         self._context(), memo_key)
+        self.calls.append(call)
+        self.variables = self._scope()
+        self._enter(function.context)
+        self.frames.append(BlockFrame(function.start, function.end, function.start))
+        for param in function.params:
+            self._account(param)
+    
+    def _handle_return(self, parts: List[str], line_number: int):
+        """Handle RETURN [value], leaving the function being called"""
+        if not self.calls:
+            raise NoobieError("RETURN outside a function")
+        result = self._argument_value(' '.join(parts[1:])) if len(parts) > 1 else None
+        del self.frames[self.calls[-1].depth:]
+        self._return_from_call(result)
+    
+    def _return_from_call(self, result: Optional[Variable]):
+        """Finish the innermost call, whose frames are gone, with result (None for no value)"""
+        call = self.calls.pop()
+        self.value_bytes -= sum(call.sizes.values())
+        self._enter(call.caller)
+        self.variables = self._scope()
+        if call.memo_key is not None:
+            self.memo[call.memo_key] = [result.type, result.value] if result is not None else None
+            if len(self.memo) > MEMO_CACHE_SIZE:
+                self.memo.popitem(last=False)
+        try:
+            self._assign_result(call.function, call.into, result)
+        except NoobieError as e:
+            if e.line_number is None:
+                e.line_number = call.line_number
+            raise
+    
+    def _assign_result(self, name: str, into: Optional[str], result: Optional[Variable]):
+        if into is None:
             return
-        
-        # Store the original line for processing
-        original_line = line
-        
-        # Parse command - preserve original case for parsing
-        parts = original_line.split()
-        if not parts:
+        if result is None:
+            raise NoobieError(f"function '{name}' returned no value")
+        self.variables[into] = Variable(result.type, result.value)
+        self._account(into)
+    
+    def _argument_value(self, text: str) -> Variable:
+        """Evaluate a CALL argument or RETURN value in the current scope"""
+        if text.startswith('@') and text[1:] in self.variables:
+            var = self.variables[text[1:]]
+            return Variable(var.type, var.value)
+        if len(text) > 1 and text[0] in '"\'' and text.endswith(text[0]):
+            value = replace_variables(text[1:-1], self.variables)
+            return Variable('STR', self._extract_expression(value))
+        if text.startswith('{') and text.endswith('}'):
+            value = self._evaluate_expression_with_parentheses(text[1:-1])
+        else:
+            value = self._evaluate_expression_with_parentheses(replace_variables(text, self.variables))
+        
+        if isinstance(value, bool) or value in ('true', 'false'):
+            return Variable('BOOL', value in (True, 'true'))
+        if isinstance(value, int):
+            return Variable('INT', value)
+        if isinstance(value, float):
+            return Variable('FLOAT', value)
+        return Variable('STR', str(value))
+    
+    def _is_pure(self, name: str) -> bool:
+        """Whether calls of name may be memoized: its body and every function it can reach are pure"""
+        function = self.functions[name]
+        if function.pure is None:
+            reachable = set()
+            pending = [name]
+            pure = True
+            while pending:
+                current = pending.pop()
+                if current in reachable:
+                    continue
+                reachable.add(current)
+                callee = self.functions.get(current)
+                if callee is None or not callee.pure_body:
+                    pure = False
+                    break
+                pending.extend(callee.callees)
+            if pure:
+                for current in reachable:
+                    self.functions[current].pure = True
+            else:
+                function.pure = False
+        return function.pure
+    
+    def _define_function(self, index: int, tokens: List[Token]) -> int:
+        """Register the FUNCTION whose header is at index and return its ENDO index"""
+        signature, _, endo_index = self._block_at(index, tokens, 'function')
+        try:
+            name, params = parse_signature(signature)
+        except NoobieError as e:
+            e.line_number = index + 1 + self.line_offset
+            raise
+        self.functions[name] = self._function(params, index + 1, endo_index, self._context())
+        # Purity and remembered results may depend on the earlier definition
+        for function in self.functions.values():
+            function.pure = None
+        self.memo.clear()
+        return endo_index
+    
+    @staticmethod
+    def _function(params: List[str], start: int, end: int, context: Context) -> Function:
+        pure_body, callees = function_effects(context[0], start, end, params)
+        return Function(params, start, end, context, pure_body, callees)
+    
+    def _context(self) -> Context:
+        return self.lines, self.line_offset, self._blocks, self._statements
+    
+    def _enter(self, context: Context):
+        self.lines, self.line_offset, self._blocks, self._statements = context
+    
+    def _scope(self) -> Dict[str, Variable]:
+        """Variables visible to the innermost call; pure functions only see their own"""
+        if not self.calls:
+            return self.global_variables
+        call = self.calls[-1]
+        if call.memo_key is not None:
+            return call.locals
+        return ChainMap(call.locals, self.global_variables)
+    
+    def _leave_calls(self):
+        """Abandon the calls of a run that ended inside a function"""
+        if self.calls:
+            self._enter(self.calls[0].caller)
+            self.value_bytes -= sum(sum(call.sizes.values()) for call in self.calls)
+            self.calls = []
+        self.variables = self.global_variables
+    
+    def _process_line(self, line: str, line_number: int, tokens: Optional[List[Token]] = None):
+        """Process a single line of code; tokens is its tokenize() result, when already known"""
+        if tokens is None:
+            # Handle comment blocks
+            if line.startswith('##'):
+                self.in_comment_block = not self.in_comment_block
+                return
+            
+            if self.in_comment_block:
+                return
+            
+            # Remove single-line comments and strip whitespace
+            line = strip_comment(line)
+            tokens = tokenize(line)
+        if not tokens:
             return
         
         # Convert only the command to lowercase, preserve case for arguments
-        command = parts[0].lower()
-        
-        # Create new parts list with lowercase command but original case arguments
-        processed_parts = [command] + parts[1:]
-        
-        # For variable replacement, we need to be careful about preserving string content
-        # Only replace variables in the line, not in quoted strings
-        line_for_variable_replacement = self._replace_variables_preserve_strings(original_line)
+        command = tokens[0].lower()
+        parts = [command] + tokens[1:]
         
         # Handle commands using command handlers
         if command in self.command_handlers:
             try:
-                self.command_handlers[command](processed_parts, line_number)
+                self.command_handlers[command](parts, line_number)
             except NoobieError:
                 raise
             except Exception as e:
                 raise NoobieError(f"Error in {command.upper()} command: {e}")
+            return
         
-        # Handle arithmetic expressions
-        elif any(op in line_for_variable_replacement for op in ['+', '-', '*', '/', '//', '%', '**', '==', '!=', '<', '>', 
-                                    'AND', 'OR', 'NOT', 'XOR', 'and', 'or', 'not', 'xor']):
-            try:
-                result = self._evaluate_expression_with_parentheses(line_for_variable_replacement)
-                # Handle None result by printing "null"
-                if result is None:
-                    print("null")
-                else:
-                    print(result)
-            except NoobieError:
-                raise
+        # Handle arithmetic expressions; only they need references replaced
+        # outside quoted strings up front
+        expression = self._replace_variables_preserve_strings(line)
+        if any(op in expression for op in EXPRESSION_OPERATORS):
+            result = self._evaluate_expression_with_parentheses(expression)
+            # Handle None result by printing "null"
+            if result is None:
+                self._write("null\n")
+            else:
+                self._write(f"{result}\n")
         else:
             raise NoobieError(f"Unknown command: {command}")
         
     def _replace_variables_preserve_strings(self, line: str) -> str:
         """Replace variables but preserve content inside quoted strings"""
-        result = ""
-        i = 0
-        
-        while i < len(line):
-            if line[i] in ['"', "'"]:
-                # Found start of quoted string - preserve everything inside
-                quote_char = line[i]
-                result += line[i]  # Add opening quote
-                i += 1
-                
-                # Copy everything until closing quote
-                while i < len(line) and line[i] != quote_char:
-                    result += line[i]
-                    i += 1
-                
-                if i < len(line):
-                    result += line[i]  # Add closing quote
-                    i += 1
-            else:
-                # Not in quotes, process normally for variable replacement
-                char_added = False
-                # Check if this could be start of a variable reference
-                if line[i] in ['@', '?']:
-                    # Find the variable name
-                    var_start = i
-                    i += 1
-                    while i < len(line) and (line[i].isalnum() or line[i] == '_'):
-                        i += 1
-                    var_part = line[var_start:i]
-                    
-                    # Apply variable replacement to this part only
-                    replaced = replace_variables(var_part, self.variables)
-                    result += replaced
-                    char_added = True
-                
-                if not char_added:
-                    result += line[i]
-                    i += 1
-        
-        return result
+        def substitute(match):
+            text = match.group()
+            return text if text[0] in '"\'' else replace_variables(text, self.variables)
+        return QUOTED_OR_REFERENCE.sub(substitute, line)
     
     def interpret(self, code: str):
         """Main interpretation method with IF/ELSE and WHILE support"""
         try:
-            lines = code.splitlines()
-            i = 0
+            self._run([line.strip() for line in code.splitlines()])
+        except ExecutionStopped:
+            pass
+        except Exception as e:
+            self._report_error(e)
+    
+    def interpret_stream(self, lines: Iterable[str]):
+        """Execute lines as they arrive, buffering only the currently open block"""
+        try:
+            for index, raw_line in enumerate(lines):
+                piece = self.take_statement(raw_line, index)
+                if piece is not None:
+                    self._run(*piece)
             
-            while i < len(lines):
-                line = lines[i].strip()
-                line_number = i + 1
-                
-                # Skip empty lines
-                if not line:
-                    i += 1
-                    continue
-                
-                # Handle comment blocks
-                if line.startswith('##'):
-                    if not self.in_comment_block:
-                        self.in_comment_block = True
-                    else:
-                        self.in_comment_block = False
-                    i += 1
-                    continue
-                
-                if self.in_comment_block:
-                    i += 1
-                    continue
-                
-                # Remove single-line comments
-                line = line.split('#', 1)[0].strip()
-                if not line:
-                    i += 1
-                    continue
-                
-                # Check for IF statement
-                if line.lower().startswith('if '):
-                    # Extract condition
-                    if_parts = line.split()
-                    if len(if_parts) < 3 or if_parts[-1].lower() != 'do':
-                        raise NoobieError("IF statement must end with DO", line_number)
-                    
-                    # Extract condition (everything between IF and DO)
-                    condition = ' '.join(if_parts[1:-1])
-                    
-                    # Find matching ENDO
-                    try:
-                        endo_index = self._find_matching_endo(lines, i, "if")
-                    except NoobieError as e:
-                        e.line_number = line_number
-                        raise
-                    
-                    # Find ELSE within this block (if exists)
-                    else_index = self._find_else_in_block(lines, i, endo_index)
-                    
-                    # Extract IF block lines
-                    if_end_index = else_index if else_index else endo_index
-                    if_lines = []
-                    for j in range(i + 1, if_end_index):
-                        block_line = lines[j].strip()
-                        if block_line:  # Skip empty lines in block
-                            if_lines.append(block_line)
-                    
-                    # Extract ELSE block lines (if exists)
-                    else_lines = []
-                    if else_index:
-                        for j in range(else_index + 1, endo_index):
-                            block_line = lines[j].strip()
-                            if block_line:  # Skip empty lines in block
-                                else_lines.append(block_line)
-                    
-                    # Execute IF/ELSE block
-                    try:
-                        self._execute_if_else_block(condition, if_lines, else_lines if else_lines else None)
-                    except NoobieError as e:
-                        if e.line_number is None:
-                            e.line_number = line_number
-                        raise
-                    
-                    # Skip to after ENDO
-                    i = endo_index + 1
-                
-                # Check for WHILE statement
-                elif line.lower().startswith('while '):
-                    # Extract condition
-                    while_parts = line.split()
-                    if len(while_parts) < 3 or while_parts[-1].lower() != 'do':
-                        raise NoobieError("WHILE statement must end with DO", line_number)
-                    
-                    # Extract condition (everything between WHILE and DO)
-                    condition = ' '.join(while_parts[1:-1])
-                    
-                    # Find matching ENDO
-                    try:
-                        endo_index = self._find_matching_endo(lines, i, "while")
-                    except NoobieError as e:
-                        e.line_number = line_number
-                        raise
-                    
-                    # Extract WHILE block lines
-                    while_lines = []
-                    for j in range(i + 1, endo_index):
-                        block_line = lines[j].strip()
-                        if block_line:  # Skip empty lines in block
-                            while_lines.append(block_line)
-                    
-                    # Execute WHILE block
-                    try:
-                        self._execute_while_block(condition, while_lines)
-                    except NoobieError as e:
-                        if e.line_number is None:
-                            e.line_number = line_number
-                        raise
-                    
-                    # Skip to after ENDO
-                    i = endo_index + 1
-                
-                # Skip ELSE and ENDO lines (they're handled by IF/WHILE processing)
-                elif line.lower() in ['else', 'endo']:
-                    # These should only appear within IF/WHILE blocks
-                    if line.lower() == 'else':
-                        raise NoobieError("ELSE without matching IF", line_number)
-                    elif line.lower() == 'endo':
-                        raise NoobieError("ENDO without matching IF or WHILE", line_number)
-                    i += 1
-                
-                # Process other lines normally
-                else:
-                    try:
-                        self._process_line(line, line_number)
-                    except NoobieError as e:
-                        e.line_number = line_number
-                        raise
-                    i += 1
-                    
-        except NoobieError as e:
-            handle_error(str(e), e.line_number)
+            # An unterminated block reports its missing ENDO
+            piece = self.take_open_block()
+            if piece is not None:
+                self._run(*piece)
+        except ExecutionStopped:
+            pass
         except Exception as e:
-            handle_error(f"Unexpected error: {e}")
+            self._report_error(e)
+    
+    def take_statement(self, line: str, index: int = 0) -> Optional[Tuple[List[str], int]]:
+        """Collect code entered line by line into pieces ready for _run().
+        
+        A straight-line statement comes back at once as (lines, line_offset);
+        a block header starts buffering until its ENDO closes it. Returns None
+        while a block is still open. index is the line's position in the
+        program, so errors report the right line.
+        """
+        line = line.strip()
+        if self.open_block:
+            self.open_block.append(line)
+            self.open_block_depth += self._block_depth_change(line)
+            return None if self.open_block_depth else self.take_open_block()
+        
+        header = strip_comment(line)
+        if not self.in_comment_block and not line.startswith('##') and self._block_depth_change(header) == 1:
+            self.open_block = [line]
+            self.open_block_start = index
+            self.open_block_depth = 1
+            return None
+        return [line], index
+    
+    def take_open_block(self) -> Optional[Tuple[List[str], int]]:
+        """Return the buffered block, closed or not, and stop buffering"""
+        if not self.open_block:
+            return None
+        piece = (self.open_block, self.open_block_start)
+        self.open_block = []
+        self.open_block_depth = 0
+        return piece
+    
+    def start(self, code: str, previous: Optional[RunJournal] = None) -> Optional[str]:
+        """Begin a run that suspends at LISTEN; return the pending prompt, or None once it ended.
+        
+        With journal_limit set the run records self.journal. Given the journal
+        of an earlier run, it skips the part of the program that run already
+        executed with the same code, unless RANDOM or LISTEN ran there.
+        """
+        self._load([line.strip() for line in code.splitlines()])
+        self.journal = None
+        if self.journal_limit:
+            self.journal = RunJournal(self.lines, self.journal_limit)
+            if previous is not None:
+                self._continue_from(previous)
+        if self.memory_limit is not None:
+            self._recount()
+        return self._advance()
+    
+    def _continue_from(self, previous: RunJournal):
+        checkpoint = self.journal.continue_from(previous)
+        if checkpoint is None:
+            return
+        index, statements, in_comment_block, variables, functions, output = checkpoint
+        self.frames[0].pc = index
+        self.statements_skipped = statements
+        self.in_comment_block = in_comment_block
+        self.variables.clear()
+        self.variables.update(decode_variables(variables))
+        # Definitions before the checkpoint are unchanged, so they are read again from the code
+        for header in functions.values():
+            self._define_function(header, tokenize(strip_comment(self.lines[header])))
+        # The skipped part's output, as the earlier run wrote it
+        if output:
+            (self.output or sys.stdout).write(output)
+    
+    def resume(self, text: str) -> Optional[str]:
+        """Continue a suspended run, answering its pending LISTEN with text"""
+        self.pending_input = text
+        return self._advance()
+    
+    def _advance(self) -> Optional[str]:
+        self.suspendable = True
+        prompt = None
+        try:
+            while self.frames:
+                self._step()
+        except InputRequired as e:
+            prompt = e.prompt
+        except ExecutionStopped:
+            self.frames = []
+        except Exception as e:
+            self.frames = []
+            self._report_error(e)
+        finally:
+            self.suspendable = False
+            # However the run ended, EXIT included, its journal is complete
+            if prompt is None:
+                self._leave_calls()
+                if self.journal is not None:
+                    self.journal.stop()
+        return prompt
+    
+    def _report_error(self, error: Exception):
+        """Count an error that ends the run and report it on the error sink"""
+        self.errors += 1
+        self.last_error = error if isinstance(error, NoobieError) else NoobieError(f"Unexpected error: {error}")
+        if isinstance(error, NoobieError):
+            handle_error(str(error), error.line_number, self.error_output)
+        else:
+            handle_error(f"Unexpected error: {error}", stream=self.error_output)
+    
+    def run_stats(self) -> Dict[str, int]:
+        """Counters for the current run, reported to the server's metrics"""
+        return {
+            'statements': self.statements,
+            'statements_skipped': self.statements_skipped,
+            'errors': self.errors,
+            'block_cache_hits': self.block_cache_hits,
+            'block_cache_misses': self.block_cache_misses,
+            'memo_hits': self.memo_hits,
+        }
+    
+    def load_variables(self, variables: Dict[str, Variable]):
+        """Replace the global variables, e.g. with those of a run finished in a worker"""
+        self.global_variables.clear()
+        self.global_variables.update(variables)
+        if self.memory_limit is not None:
+            self._recount()
+    
+    def get_state(self) -> Dict[str, Any]:
+        """Capture a suspended run as a JSON-friendly dict for set_state().
+        
+        'lines' and 'blocks' are the code being executed; functions and calls
+        defined in other code refer to it by its position in 'sources', or
+        with None to the code being executed.
+        """
+        sources: List[Context] = []
+        
+        def source(context: Context) -> Optional[int]:
+            if context[0] is self.lines:
+                return None
+            for position, known in enumerate(sources):
+                if known[0] is context[0]:
+                    return position
+            sources.append(context)
+            return len(sources) - 1
+        
+        functions = {name: [function.params, function.start, function.end, source(function.context)]
+                     for name, function in self.functions.items()}
+        calls = [[call.function, call.depth, call.into, call.line_number, encode_variables(call.locals),
+                  source(call.caller), call.memo_key] for call in self.calls]
+        return {
+            'lines': self.lines,
+            'line_offset': self.line_offset,
+            'frames': [asdict(frame) for frame in self.frames],
+            'blocks': [[index, *block] for index, block in self._blocks.items()],
+            'variables': encode_variables(self.global_variables),
+            'in_comment_block': self.in_comment_block,
+            'journal': self.journal.to_dict() if self.journal is not None else None,
+            'statements_skipped': self.statements_skipped,
+            'functions': functions,
+            'calls': calls,
+            'sources': [[lines, line_offset, [[index, *block] for index, block in blocks.items()]]
+                        for lines, line_offset, blocks, _ in sources],
+        }
+    
+    def set_state(self, state: Dict[str, Any]):
+        """Restore a run captured by get_state(), possibly in another process"""
+        self._leave_calls()
+        self.lines = list(state['lines'])
+        self.line_offset = state['line_offset']
+        self.frames = [BlockFrame(**frame) for frame in state['frames']]
+        self._blocks = {index: (condition, else_index, endo_index)
+                        for index, condition, else_index, endo_index in state['blocks']}
+        self._statements = {}
+        self.variables.clear()
+        self.variables.update(decode_variables(state['variables']))
+        self.in_comment_block = state['in_comment_block']
+        
+        current = self._context()
+        sources = [(list(lines), line_offset, {index: (condition, else_index, endo_index)
+                                               for index, condition, else_index, endo_index in blocks}, {})
+                   for lines, line_offset, blocks in state.get('sources', [])]
+        self.functions = {name: self._function(params, start, end, current if source is None else sources[source])
+                          for name, (params, start, end, source) in state.get('functions', {}).items()}
+        self.calls = [CallFrame(name, depth, into, line_number, decode_variables(local),
+                                current if source is None else sources[source], memo_key)
+                      for name, depth, into, line_number, local, source, memo_key in state.get('calls', [])]
+        self.variables = self._scope()
+        self.memo.clear()
+        if self.memory_limit is not None:
+            self._recount()
+        self.journal = RunJournal.from_dict(state['journal']) if state.get('journal') else None
+        self.statements_skipped = state.get('statements_skipped', 0)
+    
+    def snapshot(self, extra: Optional[Dict[str, Any]] = None) -> bytes:
+        """Serialize the interpreter's state as compact, versioned bytes for restore().
+        
+        Covers what get_state() does plus the block being entered line by
+        line; the RANDOM generator is not included and restore() reseeds it.
+        extra is any JSON-friendly data to keep alongside, returned by restore().
+        """
+        state = self.get_state()
+        state['open_block'] = [self.open_block, self.open_block_start, self.open_block_depth]
+        state['pending_input'] = self.pending_input
+        payload = json.dumps({'state': state, 'extra': extra}, separators=(',', ':'))
+        return SNAPSHOT_MAGIC + bytes([SNAPSHOT_FORMAT]) + zlib.compress(payload.encode('utf-8'))
+    
+    def restore(self, data: bytes) -> Optional[Dict[str, Any]]:
+        """Replace the interpreter's state with a snapshot(); return its extra data"""
+        header = len(SNAPSHOT_MAGIC)
+        if data[:header] != SNAPSHOT_MAGIC or len(data) <= header:
+            raise NoobieError("not an interpreter snapshot")
+        if data[header] != SNAPSHOT_FORMAT:
+            raise NoobieError(f"unsupported snapshot format {data[header]}")
+        try:
+            payload = json.loads(zlib.decompress(data[header + 1:]))
+        except (zlib.error, ValueError) as e:
+            raise NoobieError(f"corrupt snapshot: {e}")
+        
+        state = payload['state']
+        self.reset()
+        self.set_state(state)
+        self.open_block, self.open_block_start, self.open_block_depth = state['open_block']
+        self.pending_input = state['pending_input']
+        return payload['extra']
+    
+    def _load(self, lines: List[str], line_offset: int = 0):
+        self._leave_calls()
+        self.lines = lines
+        self.line_offset = line_offset
+        self._blocks = {}
+        self._statements = {}
+        self.frames = [BlockFrame(0, len(lines), 0)]
+    
+    def _run(self, lines: List[str], line_offset: int = 0):
+        """Execute stripped lines; line numbers are reported relative to line_offset"""
+        self._load(lines, line_offset)
+        try:
+            while self.frames:
+                self._step()
+        finally:
+            self._leave_calls()
+    
+    def _step(self):
+        """Execute the next statement of the innermost block span"""
+        frame = self.frames[-1]
+        
+        # Stop/pause checkpoint; every statement and WHILE back-edge passes here
+        if self.control.interrupted:
+            self.control.checkpoint(frame.pc + 1 + self.line_offset)
+        
+        # End of span: loop back for WHILE bodies, otherwise leave the block
+        if frame.pc >= frame.end:
+            if frame.header is not None and self._repeat_while(frame):
+                frame.pc = frame.start
+            else:
+                if self.journal is not None and len(self.frames) == 1:
+                    self.journal.record(frame.end, self)
+                self.frames.pop()
+                # Running off the end of a function body returns no value
+                if self.calls and len(self.frames) == self.calls[-1].depth:
+                    self._return_from_call(None)
+            return
+        
+        index = frame.pc
+        if self.journal is not None and len(self.frames) == 1:
+            self.journal.record(index, self)
+        frame.pc += 1
+        line = self.lines[index]
+        line_number = index + 1 + self.line_offset
+        
+        # Skip empty lines
+        if not line:
+            return
+        
+        # Handle comment blocks
+        if line.startswith('##'):
+            self.in_comment_block = not self.in_comment_block
+            return
+        
+        if self.in_comment_block:
+            return
+        
+        # Remove single-line comments and split the line, once per run
+        statement = self._statements.get(index)
+        if statement is None:
+            stripped = strip_comment(line)
+            statement = self._statements[index] = (stripped, tokenize(stripped))
+        line, tokens = statement
+        if not tokens:
+            return
+        
+        self.statements += 1
+        if self.statement_limit is not None and self.statements > self.statement_limit:
+            raise StatementLimitExceeded(f"statement limit exceeded ({self.statement_limit})", line_number)
+        # Reading the clock is not free, so the deadline is checked every 1024 statements
+        if not self.statements & 1023:
+            if self.deadline is not None and time.monotonic() >= self.deadline:
+                self.control.stop()
+                self.control.checkpoint(line_number)
+            if self.cooperative:
+                # A monkey-patched sleep lets the event loop serve other sessions
+                time.sleep(0)
+        lower = line.lower()
+        
+        # IF/ELSE: run the matching span in place, then continue after ENDO
+        if lower.startswith('if '):
+            condition, else_index, endo_index = self._block_at(index, tokens, 'if')
+            frame.pc = endo_index + 1
+            if self._check_block_condition(condition, index):
+                if_end = else_index if else_index is not None else endo_index
+                self.frames.append(BlockFrame(index + 1, if_end, index + 1))
+            elif else_index is not None:
+                self.frames.append(BlockFrame(else_index + 1, endo_index, else_index + 1))
+        
+        # WHILE: the body span is re-entered from _repeat_while
+        elif lower.startswith('while '):
+            condition, _, endo_index = self._block_at(index, tokens, 'while')
+            frame.pc = endo_index + 1
+            if self._check_block_condition(condition, index):
+                self.frames.append(BlockFrame(index + 1, endo_index, index + 1, header=index, iterations=1))
+        
+        # FUNCTION: define it now and continue after its body
+        elif lower.startswith('function '):
+            frame.pc = self._define_function(index, tokens) + 1
+        
+        # ELSE and ENDO are consumed by IF/WHILE processing
+        elif lower == 'else':
+            raise NoobieError("ELSE without matching IF", line_number)
+        elif lower == 'endo':
+            raise NoobieError("ENDO without matching IF or WHILE", line_number)
+        
+        # Process other lines normally
+        else:
+            if self.journal is not None and self.journal.recording and lower.split(None, 1)[0] in NONDETERMINISTIC_COMMANDS:
+                # A later run cannot reproduce what follows from the checkpoints
+                self.journal.stop()
+            try:
+                self._process_line(line, line_number, tokens)
+            except InputRequired:
+                # Run the LISTEN again once its input arrives
+                frame.pc = index
+                raise
+            except NoobieError as e:
+                e.line_number = line_number
+                raise
+
+# Commands whose first argument must name an already declared variable
+VARIABLE_COMMANDS = {'change', 'convert', 'round', 'del', 'reset', 'increment',
+                     'decrement', 'swap', 'uppercase', 'lowercase', 'reverse'}
+
+# Commands that keep a function from being memoized: they read input, write
+# output, draw random numbers or define functions
+IMPURE_COMMANDS = {'say', 'listen', 'random', 'exit', 'function'}
+QUOTED = re.compile(r'"[^"]*"?|\'[^\']*\'?')
+EXPRESSION_NAME = re.compile(r'(?<![\w.])[a-zA-Z_]\w*')
+# Words of an expression that do not name a variable
+EXPRESSION_WORDS = {word.lower() for word in keyword.kwlist} | {'true', 'false', 'null', 'xor', 'end'}
+
+def _expression_names(text: str) -> set:
+    """Names an evaluated expression may read: references and bare names outside quotes"""
+    names = {match.group()[1:].lower() for match in REFERENCE_PATTERN.finditer(text)}
+    for match in EXPRESSION_NAME.finditer(QUOTED.sub(' ', text)):
+        names.add(match.group().lower())
+    return names - EXPRESSION_WORDS
+
+def function_effects(lines: List[str], start: int, end: int, params: List[str]) -> Tuple[bool, set]:
+    """Statically check the function body lines[start:end] for memoization.
+    
+    Returns (pure, callees): pure when the body prints nothing, reads no
+    input or random numbers and only reads and writes its parameters and the
+    variables it creates; callees are the functions it calls, which must be
+    pure as well. A pure function runs without access to global variables.
+    """
+    local = set(params)
+    used: set = set()
+    written: set = set()
+    callees: set = set()
+    in_comment_block = False
+    for raw_line in lines[start:end]:
+        line = raw_line.strip()
+        if line.startswith('##'):
+            in_comment_block = not in_comment_block
+            continue
+        if in_comment_block:
+            continue
+        line = strip_comment(line)
+        if not line:
+            continue
+        
+        parts = tokenize(line)
+        command = parts[0].lower()
+        if command in IMPURE_COMMANDS or (command not in ARGUMENT_RULES and command not in ('if', 'while', 'else', 'endo')):
+            return False, callees
+        used |= {match.group()[1:].lower() for match in REFERENCE_PATTERN.finditer(line)}
+        for part in parts:
+            if part.kind == 'expr':
+                used |= _expression_names(part.strip('{}'))
+        
+        if command in ('if', 'while'):
+            used |= _expression_names(' '.join(parts[1:-1]))
+        elif command == 'return':
+            used |= _expression_names(' '.join(parts[1:]))
+        elif command == 'create':
+            offset = 2 if len(parts) > 1 and parts[1].lower() == 'const' else 1
+            if len(parts) > offset + 1:
+                local.add(parts[offset + 1].lower())
+        elif command == 'call':
+            try:
+                name, arguments, into = parse_call(' '.join(parts[1:]))
+            except NoobieError:
+                return False, callees
+            callees.add(name)
+            for argument in arguments:
+                used |= _expression_names(argument)
+            if into is not None:
+                local.add(into)
+        elif command in VARIABLE_COMMANDS:
+            written.update(part.lower() for part in parts[1:3 if command == 'swap' else 2])
+    return used <= local and written <= local, callees
+
+def _validate_type(type_name: str, checks: list):
+    """Record an error if type_name is not a supported data type"""
+    if type_name.upper() not in [t.value for t in DataType]:
+        checks.append(('error', f"unsupported type: {type_name.upper()}"))
+
+def _validate_declared(var_name: str, checks: list):
+    """Record that var_name must have been declared on an earlier line"""
+    checks.append(('use', var_name.lower()))
+
+def _validate_declaration(var_name: str, checks: list):
+    """Record a new variable name, rejecting the reserved END name"""
+    if var_name.lower() == "end":
+        checks.append(('error', "cannot use 'end' as variable name (reserved for newline)"))
+    else:
+        checks.append(('declare', var_name.lower()))
+
+def _statement_checks(line: str) -> list:
+    """Statically check a single statement.
+
+    Returns an ordered list of ('error', message), ('use', name) and
+    ('declare', name) entries, so the result does not depend on the lines
+    around it; _apply_checks resolves the names against the declarations.
+    """
+    checks: list = []
+    parts = tokenize(line)
+    command = parts[0].lower()
+    
+    if command not in ARGUMENT_RULES and command != 'exit':
+        # Lines with references may only become expressions once substituted
+        if not any(op in line for op in EXPRESSION_OPERATORS) and '@' not in line and '?' not in line:
+            checks.append(('error', f"Unknown command: {command}"))
+        return checks
+    
+    try:
+        check_arguments(parts)
+    except NoobieError as e:
+        return [('error', str(e))]
+    
+    if command == 'create':
+        offset = 2 if parts[1].lower() == 'const' else 1
+        if len(parts) < offset + 2:
+            checks.append(('error', f"CREATE {'CONST ' if offset == 2 else ''}command requires type and variable name"))
+        else:
+            _validate_type(parts[offset], checks)
+            _validate_declaration(parts[offset + 1], checks)
+    elif command == 'listen':
+        _validate_type(parts[1], checks)
+        if parts[2].kind == 'string':
+            checks.append(('declare', "listened"))
+        else:
+            _validate_declaration(parts[2], checks)
+    elif command == 'random':
+        _validate_type(parts[1], checks)
+        for bound in parts[2:4]:
+            if bound.startswith('@'):
+                _validate_declared(bound[1:], checks)
+            else:
+                try:
+                    int(bound)
+                except ValueError:
+                    checks.append(('error', f"invalid value for RANDOM: '{bound}'"))
+        if len(parts) == 5:
+            _validate_declaration(parts[4], checks)
+    elif command == 'call':
+        try:
+            _, arguments, into = parse_call(' '.join(parts[1:]))
+        except NoobieError as e:
+            return [('error', str(e))]
+        for argument in arguments:
+            if argument.startswith('@') and IDENTIFIER.fullmatch(argument[1:]):
+                _validate_declared(argument[1:], checks)
+        if into is not None:
+            checks.append(('declare', into))
+    elif command in VARIABLE_COMMANDS:
+        _validate_declared(parts[1], checks)
+        if command == 'swap':
+            _validate_declared(parts[2], checks)
+        elif command == 'convert':
+            if parts[2].startswith('?'):
+                _validate_declared(parts[2][1:], checks)
+            else:
+                _validate_type(parts[2], checks)
+    
+    return checks
+
+def _apply_checks(checks: list, declared: set) -> Tuple[List[str], List[str]]:
+    """Resolve a statement's checks against the declared names.
+
+    Returns (errors, warnings). Declarations are matched in text order, which
+    ignores control flow, so an undeclared name is only a warning: a loop may
+    well create the variable before the branch using it runs.
+    """
+    errors: List[str] = []
+    warnings: List[str] = []
+    for kind, value in checks:
+        if kind == 'error':
+            errors.append(value)
+        elif kind == 'use':
+            if value not in declared:
+                warnings.append(f"variable '{value}' may not be declared")
+        else:
+            declared.add(value)
+    return errors, warnings
+
+def _line_facts(raw_line: str) -> tuple:
+    """Classify one source line for validation, independently of the lines around it.
+
+    Returns (kind, detail): ('toggle', None) for a ## line, ('blank', None),
+    ('open', (block type, header checks)), ('else', None), ('endo', None)
+    or ('statement', checks from _statement_checks).
+    """
+    line = raw_line.strip()
+    if line.startswith('##'):
+        return ('toggle', None)
+    line = strip_comment(line)
+    if not line:
+        return ('blank', None)
+    
+    lower = line.lower()
+    if lower.startswith(BLOCK_OPENERS):
+        block_type = lower.split()[0]
+        header_parts = tokenize(line)
+        checks = []
+        if len(header_parts) < 3 or header_parts[-1].lower() != 'do':
+            checks.append(('error', f"{block_type.upper()} statement must end with DO"))
+        elif block_type == 'function':
+            # Parameters are declared for the body
+            try:
+                _, params = parse_signature(' '.join(header_parts[1:-1]))
+            except NoobieError as e:
+                checks.append(('error', str(e)))
+            else:
+                checks.extend(('declare', param) for param in params)
+        return ('open', (block_type, checks))
+    if lower == 'else':
+        return ('else', None)
+    if lower == 'endo':
+        return ('endo', None)
+    return ('statement', _statement_checks(line))
+
+def _check_program(facts: list, warnings: Optional[List[NoobieError]] = None) -> List[NoobieError]:
+    """Check block structure and declarations over per-line facts from _line_facts.
+    
+    Returns the errors; findings that depend on control flow are appended to
+    warnings, if given.
+    """
+    errors: List[NoobieError] = []
+    found: List[NoobieError] = []
+    declared: set = set()
+    # (block type, line number, has ELSE, names declared outside a FUNCTION or None)
+    open_blocks: List[Tuple[str, int, bool, Optional[set]]] = []
+    in_comment_block = False
+    
+    for index, (kind, detail) in enumerate(facts):
+        line_number = index + 1
+        
+        if kind == 'toggle':
+            in_comment_block = not in_comment_block
+            continue
+        if in_comment_block or kind == 'blank':
+            continue
+        
+        if kind == 'open':
+            block_type, checks = detail
+            outer = None
+            if block_type == 'function':
+                # Parameters and the variables the body creates are local to it
+                outer, declared = declared, set(declared)
+            _report(_apply_checks(checks, declared), line_number, errors, found)
+            open_blocks.append((block_type, line_number, False, outer))
+        elif kind == 'else':
+            if not open_blocks or open_blocks[-1][0] != 'if' or open_blocks[-1][2]:
+                errors.append(NoobieError("ELSE without matching IF", line_number))
+            else:
+                block_type, block_line, _, outer = open_blocks[-1]
+                open_blocks[-1] = (block_type, block_line, True, outer)
+        elif kind == 'endo':
+            if not open_blocks:
+                errors.append(NoobieError("ENDO without matching IF or WHILE", line_number))
+            else:
+                outer = open_blocks.pop()[3]
+                if outer is not None:
+                    declared = outer
+        else:
+            _report(_apply_checks(detail, declared), line_number, errors, found)
+    
+    for block_type, block_line, _, _ in open_blocks:
+        errors.append(NoobieError(f"missing ENDO for {block_type.upper()} statement", block_line))
+    
+    errors.sort(key=lambda e: e.line_number or 0)
+    if warnings is not None:
+        warnings.extend(found)
+    return errors
+
+def _report(findings: Tuple[List[str], List[str]], line_number: int, errors: list, warnings: list):
+    """Add a line's (errors, warnings) messages from _apply_checks to the program's lists"""
+    line_errors, line_warnings = findings
+    errors.extend(NoobieError(message, line_number) for message in line_errors)
+    warnings.extend(NoobieError(message, line_number) for message in line_warnings)
+
+def validate(code: str, warnings: Optional[List[NoobieError]] = None) -> List[NoobieError]:
+    """Statically check a program and return every error found, with line numbers.
+    
+    Errors are certain to stop the program: unbalanced blocks, unknown commands,
+    wrong arguments. Possible uses of undeclared variables are only appended
+    to warnings, if given, as the check cannot follow loops and branches.
+    """
+    return _check_program([_line_facts(line) for line in code.splitlines()], warnings)
+
+class IncrementalValidator:
+    """Validator for a document that changes a few lines at a time.
+
+    Each line's facts are computed once, when the line is set; diagnostics()
+    then only walks the cached facts to match blocks and declarations, so an
+    edit costs the lexing of the lines it touches plus one cheap pass.
+    Lines are split on newlines only, as an editor counts them.
+    """
+    def __init__(self, code: str = ''):
+        self.facts: list = []
+        self.set_text(code)
+
+    def __len__(self):
+        return len(self.facts)
+
+    def set_text(self, code: str):
+        self.facts = [_line_facts(line) for line in code.split('\n')]
+
+    def apply_edit(self, start: int, end: int, lines: List[str]):
+        """Replace lines [start, end) (0-based) with lines"""
+        if not 0 <= start <= end <= len(self.facts):
+            raise NoobieError(f"edit range {start}-{end} outside a document of {len(self.facts)} lines")
+        self.facts[start:end] = [_line_facts(line) for line in lines]
+
+    def diagnostics(self, warnings: Optional[List[NoobieError]] = None) -> List[NoobieError]:
+        """Return the document's errors, appending its warnings to warnings as validate() does"""
+        return _check_program(self.facts, warnings)
+
+def commands_used(code: str) -> set:
+    """Return the lowercase command names appearing in a program, outside comments"""
+    commands = set()
+    in_comment_block = False
+    for raw_line in code.splitlines():
+        line = raw_line.strip()
+        if line.startswith('##'):
+            in_comment_block = not in_comment_block
+            continue
+        if in_comment_block:
+            continue
+        line = strip_comment(line)
+        if line:
+            commands.add(line.split()[0].lower())
+    return commands
+
+def repl():
+    """Interactive session: statements run as entered, blocks once their ENDO arrives"""
+    interpreter = NoobieInterpreter()
+    while True:
+        try:
+            line = input('...... ' if interpreter.open_block else 'noobie> ')
+        except EOFError:
+            print()
+            break
+        except KeyboardInterrupt:
+            # Abandon the block being entered
+            print()
+            interpreter.take_open_block()
+            continue
+        
+        piece = interpreter.take_statement(line)
+        if piece is None:
+            continue
+        try:
+            interpreter._run(*piece)
+        except NoobieError as e:
+            print(format_error(str(e), e.line_number), file=sys.stderr)
+        except SystemExit:
+            break
+        except KeyboardInterrupt:
+            print()
 
 def main():
     """Main function"""
-    if len(sys.argv) < 2:
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    flags = {arg for arg in sys.argv[1:] if arg.startswith('--')}
+    
+    if '--repl' in flags:
+        repl()
+        return
+    
+    if not args:
         handle_error("Specify a .noob file")
     
-    filename = sys.argv[1]
+    filename = args[0]
     
     try:
+        if '--stream' in flags:
+            NoobieInterpreter().interpret_stream(read_lines_from_file(filename))
+            return
         code = read_code_from_file(filename)
+        if '--check' in flags:
+            warnings: List[NoobieError] = []
+            errors = validate(code, warnings)
+            findings = [(e.line_number or 0, format_error(str(e), e.line_number)) for e in errors]
+            findings += [(w.line_number or 0, format_warning(str(w), w.line_number)) for w in warnings]
+            for _, message in sorted(findings, key=lambda finding: finding[0]):
+                print(message, file=sys.stderr)
+            sys.exit(1 if errors else 0)
         interpreter = NoobieInterpreter()
         interpreter.interpret(code)
     except NoobieError as e:
@@ -0,0 +1,224 @@
+"""Session registry shared by every server process.
+
+Interpreters, captures and sockets stay in the process that owns the
+session; with sticky routing every event for a session reaches that
+process. The registry only records which process owns which session, so
+counts are correct across a multi-process deployment and a process
+receiving an event for a session it does not hold can tell which process
+does.
+"""
+
+import time
+import threading
+from typing import Any, Dict, Iterable, Optional
+
+
+class SessionRegistry:
+    """Interface of a session registry"""
+    backend = 'none'
+
+    def register(self, session_id: str, info: Dict[str, str]):
+        raise NotImplementedError
+
+    def get(self, session_id: str) -> Optional[Dict[str, str]]:
+        raise NotImplementedError
+
+    def remove(self, session_id: str):
+        raise NotImplementedError
+
+    def refresh(self, session_ids: Iterable[str]):
+        """Mark sessions as still alive"""
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, Any]:
+        return {'backend': self.backend, 'sessions': self.count()}
+
+
+class MemorySessionRegistry(SessionRegistry):
+    """Registry for a single server process"""
+    backend = 'memory'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions: Dict[str, Dict[str, str]] = {}
+
+    def register(self, session_id, info):
+        with self.lock:
+            self.sessions[session_id] = dict(info)
+
+    def get(self, session_id):
+        with self.lock:
+            info = self.sessions.get(session_id)
+            return dict(info) if info is not None else None
+
+    def remove(self, session_id):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+    def count(self):
+        with self.lock:
+            return len(self.sessions)
+
+
+class RedisSessionRegistry(SessionRegistry):
+    """Registry kept in Redis, shared by all processes using the same server.
+
+    Each session is a hash that expires after ttl seconds unless refreshed,
+    so sessions of a process that died without cleaning up disappear on
+    their own. The index is a sorted set scored by each session's expiry
+    time, so stale entries are pruned with one range delete instead of a
+    lookup per session. client needs hset/hgetall/expire/delete, the sorted
+    set commands zadd/zrem/zremrangebyscore/zcount and pipeline(), with
+    decode_responses enabled.
+    """
+    backend = 'redis'
+
+    def __init__(self, client, ttl: int, prefix: str = 'noobie'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.index = f"{prefix}:sessions"
+
+    def _key(self, session_id):
+        return f"{self.prefix}:session:{session_id}"
+
+    def register(self, session_id, info):
+        key = self._key(session_id)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.hset(key, mapping=info)
+        pipe.expire(key, self.ttl)
+        pipe.zadd(self.index, {session_id: time.time() + self.ttl})
+        pipe.execute()
+
+    def get(self, session_id):
+        info = self.client.hgetall(self._key(session_id))
+        return info or None
+
+    def remove(self, session_id):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.delete(self._key(session_id))
+        pipe.zrem(self.index, session_id)
+        pipe.execute()
+
+    def refresh(self, session_ids):
+        """Extend this process's sessions and prune expired index entries.
+
+        The cost grows with the sessions of this process only, and the whole
+        sweep is one round trip.
+        """
+        now = time.time()
+        session_ids = list(session_ids)
+        pipe = self.client.pipeline(transaction=False)
+        for session_id in session_ids:
+            pipe.expire(self._key(session_id), self.ttl)
+        if session_ids:
+            pipe.zadd(self.index, {session_id: now + self.ttl for session_id in session_ids})
+        # Entries of sessions that expired with their process
+        pipe.zremrangebyscore(self.index, '-inf', now)
+        pipe.execute()
+
+    def count(self):
+        return self.client.zcount(self.index, time.time(), '+inf')
+
+
+class LocalRedis:
+    """In-process stand-in for the subset of the Redis client used above"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data: Dict[str, Any] = {}
+        self.expires: Dict[str, float] = {}
+
+    def _live(self, name):
+        deadline = self.expires.get(name)
+        if deadline is not None and deadline <= time.monotonic():
+            self.data.pop(name, None)
+            self.expires.pop(name, None)
+        return self.data.get(name)
+
+    def hset(self, name, key=None, value=None, mapping=None):
+        with self.lock:
+            values = self._live(name)
+            if values is None:
+                values = self.data[name] = {}
+            if key is not None:
+                values[key] = str(value)
+            for field, item in (mapping or {}).items():
+                values[field] = str(item)
+
+    def hgetall(self, name):
+        with self.lock:
+            return dict(self._live(name) or {})
+
+    def expire(self, name, seconds):
+        with self.lock:
+            if self._live(name) is None:
+                return False
+            self.expires[name] = time.monotonic() + seconds
+            return True
+
+    def delete(self, *names):
+        with self.lock:
+            removed = 0
+            for name in names:
+                if self._live(name) is not None:
+                    removed += 1
+                self.data.pop(name, None)
+                self.expires.pop(name, None)
+            return removed
+
+    def zadd(self, name, mapping):
+        with self.lock:
+            scores = self._live(name)
+            if scores is None:
+                scores = self.data[name] = {}
+            added = sum(member not in scores for member in mapping)
+            scores.update((member, float(score)) for member, score in mapping.items())
+            return added
+
+    def zrem(self, name, *members):
+        with self.lock:
+            scores = self._live(name) or {}
+            return sum(scores.pop(member, None) is not None for member in members)
+
+    def zremrangebyscore(self, name, low, high):
+        with self.lock:
+            scores = self._live(name) or {}
+            expired = [member for member, score in scores.items() if float(low) <= score <= float(high)]
+            for member in expired:
+                del scores[member]
+            return len(expired)
+
+    def zcount(self, name, low, high):
+        with self.lock:
+            return sum(float(low) <= score <= float(high) for score in (self._live(name) or {}).values())
+
+    def pipeline(self, transaction=True):
+        return LocalPipeline(self)
+
+
+class LocalPipeline:
+    """Queues LocalRedis commands until execute(), like a Redis pipeline"""
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, command):
+        def queue(*args, **kwargs):
+            self.commands.append((getattr(self.client, command), args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [method(*args, **kwargs) for method, args, kwargs in commands]
+
+def create_registry(url: Optional[str], ttl: int) -> SessionRegistry:
+    """Build the registry named by url: unset for memory, local:// or redis://..."""
+    if not url:
+        return MemorySessionRegistry()
+    if url == 'local://':
+        return RedisSessionRegistry(LocalRedis(), ttl)
+    import redis
+    return RedisSessionRegistry(redis.Redis.from_url(url, decode_responses=True), ttl)
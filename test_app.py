@@ -0,0 +1,482 @@
+"""Tests for the web app's socket handlers, run in-process on the thread backend"""
+
+import os
+import re
+import time
+
+os.environ.setdefault('EXECUTION_BACKEND', 'thread')
+
+import pytest
+
+import app as noobie_app
+from registry import MemorySessionRegistry
+from wire import decode_event
+from workers import ProcessWorkerPool
+from test_validate import FLOW_DEPENDENT
+
+
+@pytest.fixture
+def client():
+    client = noobie_app.socketio.test_client(noobie_app.app)
+    client.get_received()
+    yield client
+    client.disconnect()
+
+
+@pytest.fixture
+def compact_client():
+    client = noobie_app.socketio.test_client(noobie_app.app, query_string='encoding=compact')
+    client.get_received()
+    yield client
+    client.disconnect()
+
+
+@pytest.fixture(params=['thread', 'process'])
+def backend(request, monkeypatch):
+    """Run programs on the thread backend, or on a one-worker process pool"""
+    pool = ProcessWorkerPool(1) if request.param == 'process' else None
+    monkeypatch.setattr(noobie_app, 'process_workers', pool)
+    yield request.param
+    if pool is not None:
+        pool.shutdown()
+
+
+def events(client, until='execution_finished', timeout=5.0):
+    """Collect (event, data) pairs until the event named until, decoding compact frames"""
+    received = []
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        noobie_app.socketio.sleep(0.01)
+        for message in client.get_received():
+            data = message['args'][0] if message['args'] else {}
+            if message['name'] == 'frame':
+                received.append(decode_event(data))
+            else:
+                received.append((message['name'], data))
+        if any(name == until for name, _ in received):
+            break
+    return received
+
+
+def output_text(received, output_type):
+    return ''.join(''.join(data.get('lines') or [data.get('text', '')])
+                   for name, data in received if name == 'output' and data.get('type') == output_type)
+
+
+def test_flow_dependent_program_runs(client):
+    client.emit('execute_code', {'code': FLOW_DEPENDENT})
+    received = events(client)
+    assert 'x=10' in output_text(received, 'stdout')
+    assert output_text(received, 'error') == ''
+
+
+def test_malformed_program_is_rejected(client):
+    client.emit('execute_code', {'code': 'SAY "a" end\nFOO 1\n'})
+    received = events(client, until='output', timeout=1.0)
+    assert output_text(received, 'error') == 'LINE 2 -> ERROR: Unknown command: foo\n'
+    assert 'execution_started' not in [name for name, _ in received]
+
+
+def test_rejection_uses_compact_frames(compact_client):
+    compact_client.emit('execute_code', {'code': 'FOO 1\n'})
+    noobie_app.socketio.sleep(0.05)
+    messages = compact_client.get_received()
+    assert [message['name'] for message in messages] == ['frame']
+    name, data = decode_event(messages[0]['args'][0])
+    assert (name, data['type'], data['lines']) == ('output', 'error', ['LINE 1 -> ERROR: Unknown command: foo\n'])
+
+
+def line_succeeds(client, line):
+    client.emit('execute_line', {'line': line})
+    return [data['success'] for name, data in events(client, until='line_executed') if name == 'line_executed']
+
+
+def test_deleted_variables_leave_the_session(backend, client):
+    client.emit('execute_code', {'code': 'CREATE INT a 1\nLISTEN INT b "b? "\nDEL a\n'})
+    events(client, until='input_request')
+    client.emit('provide_input', {'input': '5'})
+    events(client)
+    assert line_succeeds(client, 'INCREMENT b') == [True]
+    assert line_succeeds(client, 'INCREMENT a') == [False]
+
+
+def test_session_held_elsewhere_is_reported(monkeypatch):
+    registry = MemorySessionRegistry()
+    registry.register('elsewhere', {'node': 'other-host:1'})
+    monkeypatch.setattr(noobie_app, 'session_registry', registry)
+    assert 'other-host:1' in noobie_app.invalid_session_message('elsewhere')
+    assert noobie_app.invalid_session_message('unknown') == 'Invalid session'
+    assert noobie_app.invalid_session_message(None) == 'Invalid session'
+
+
+def test_stop_drops_lines_queued_behind_it(client):
+    for line in ['CREATE INT k 0', 'WHILE @k < 100000 DO', 'INCREMENT k', 'ENDO']:
+        client.emit('execute_line', {'line': line})
+    client.emit('stop_execution')
+    client.emit('execute_line', {'line': 'CREATE INT z 1'})
+    received = events(client, until='nothing', timeout=0.5)
+    results = {data['line']: data for name, data in received if name == 'line_executed' and not data.get('pending')}
+    assert results['CREATE INT z 1']['success'] is False
+    assert results['CREATE INT z 1']['error'] == 'execution stopped'
+    # Lines typed once the stopped batch has drained run again
+    assert line_succeeds(client, 'CREATE INT z 2') == [True]
+
+
+def api_run(payload):
+    response = noobie_app.app.test_client().post('/api/run', json=payload)
+    return response.status_code, response.get_json()
+
+
+NESTED_LOOP = 'CREATE INT k 0\nWHILE @k < 9999 DO\nCREATE INT j 0\nWHILE @j < 9999 DO\nINCREMENT j\nENDO\nDEL j\nINCREMENT k\nENDO\n'
+
+
+@pytest.mark.parametrize('job, status', [
+    ({'code': 'LISTEN INT a "a? "\nSAY "a=@a" end\n', 'inputs': [4]}, 'ok'),
+    ({'code': NESTED_LOOP, 'limits': {'timeout': 0.2}}, 'timeout'),
+    ({'code': NESTED_LOOP, 'limits': {'max_statements': 500}}, 'limit_exceeded'),
+    ({'code': 'LISTEN INT a "a? "\nLISTEN INT b "b? "\n', 'inputs': [1]}, 'input_exhausted'),
+    ({'code': 'CHANGE nope 1\n'}, 'error'),
+    ({'code': 'CREATE STR s "x"\nWHILE 1 == 1 DO\nCHANGE s {s + s}\nENDO\n',
+      'limits': {'max_memory_bytes': 100000}}, 'memory_exceeded'),
+])
+def test_api_run_status(job, status):
+    code, result = api_run(job)
+    assert code == 200
+    assert result['status'] == status
+    if status == 'ok':
+        assert result['stdout'] == 'a? a=4\n'
+    elif status in ('limit_exceeded', 'memory_exceeded'):
+        assert result['error_line'] is not None
+
+
+@pytest.mark.parametrize('payload', [
+    None,
+    {'code': 1},
+    {'code': 'SAY "a" end', 'inputs': 'a'},
+    {'code': 'SAY "a" end', 'limits': {'timeout': -1}},
+    {'jobs': []},
+])
+def test_api_run_rejects_malformed_jobs(payload):
+    code, result = api_run(payload)
+    assert code == 400
+    assert result['error']
+
+
+def test_api_run_many_jobs():
+    code, body = api_run({'jobs': [{'code': 'SAY "one" end'}, {'code': 'SAY "two" end'}]})
+    assert code == 200
+    assert [result['stdout'] for result in body['results']] == ['one\n', 'two\n']
+
+
+def test_editor_diagnostics_have_a_severity(client):
+    client.emit('analyze_code', {'version': 1, 'code': FLOW_DEPENDENT + 'FOO\n'})
+    (name, data), = [(name, data) for name, data in events(client, until='diagnostics', timeout=1.0)
+                     if name == 'diagnostics']
+    assert data['version'] == 1
+    assert [(d['line'], d['severity']) for d in data['diagnostics']] == [(11, 'error'), (4, 'warning')]
+
+
+def test_api_run_kills_a_worker_stuck_in_one_statement(monkeypatch):
+    pool = ProcessWorkerPool(1)
+    monkeypatch.setattr(noobie_app, 'process_workers', pool)
+    try:
+        started = time.monotonic()
+        code, result = api_run({'code': 'CREATE INT x {7**6000000 % 10}\n', 'limits': {'timeout': 0.3}})
+        assert (code, result['status']) == (200, 'timeout')
+        assert time.monotonic() - started < 3
+        assert pool.stats()['killed'] == 1
+        # The replacement worker takes the next job
+        assert api_run({'code': 'SAY "next" end\n'})[1]['stdout'] == 'next\n'
+    finally:
+        pool.shutdown()
+
+
+def test_repl_queue_is_bounded(client, monkeypatch):
+    monkeypatch.setattr(noobie_app, 'REPL_MAX_QUEUED_PIECES', 2)
+    # Nothing runs until the test yields, so the first two pieces fill the queue
+    for line in ['CREATE INT k 0', 'WHILE @k < 3 DO', 'INCREMENT k', 'ENDO', 'CREATE INT a 1', 'CREATE INT b 2']:
+        client.emit('execute_line', {'line': line})
+    received = events(client, until='nothing', timeout=0.5)
+    rejected = [data['reason'] for name, data in received if name == 'execution_rejected']
+    assert rejected == ['too many lines waiting to run'] * 2
+    executed = [data['line'] for name, data in received
+                if name == 'line_executed' and data['success'] and not data.get('pending')]
+    assert executed == ['CREATE INT k 0', 'ENDO']
+    # Once drained, the queue takes lines again
+    assert line_succeeds(client, 'CREATE INT a 1') == [True]
+
+
+def test_queued_repl_pieces_count_towards_session_memory():
+    interpreter = noobie_app.NoobieWebInterpreter('memory-test')
+    before = interpreter.memory_usage()
+    interpreter.repl_pieces.append(('SAY "x" end', (['SAY "x" end'], 0)))
+    assert interpreter.memory_usage() == before + len('SAY "x" end')
+
+
+def test_listen_answer_resumes_with_an_empty_token_bucket(backend, client, monkeypatch):
+    client.emit('execute_code', {'code': 'LISTEN INT a "a? "\nSAY "a=@a" end\n'})
+    events(client, until='input_request')
+    monkeypatch.setattr(noobie_app.execution_scheduler, 'rate', 0)
+    for bucket in noobie_app.execution_scheduler.buckets.values():
+        bucket[0] = 0
+    client.emit('provide_input', {'input': '3'})
+    received = events(client)
+    assert 'execution_rejected' not in [name for name, _ in received]
+    assert 'a=3' in output_text(received, 'stdout')
+
+
+def test_pooled_interpreter_is_clean_when_reused():
+    pool = noobie_app.InterpreterPool(1)
+    first = pool.acquire('first')
+    first.interpreter.interpret('CREATE INT a 1\nFUNCTION f(n) DO\nRETURN @n\nENDO\nSAY "x" end\n')
+    first.repl_pieces.append(('INCREMENT a', (['INCREMENT a'], 0)))
+    first.control.stop()
+    first.suspended = ('a? ', None)
+    first.busy = True
+    # An interpreter still running goes back to the pool only when its run ends
+    pool.release(first)
+    assert pool.stats()['idle'] == 0
+    pool.run_finished(first)
+    assert pool.stats()['idle'] == 1
+
+    second = pool.acquire('second')
+    assert second is first
+    assert pool.stats()['reused'] == 2 and pool.stats()['created'] == 1
+    assert second.session_id == second.output_capture.session_id == 'second'
+    assert second.interpreter.variables == {} and second.interpreter.functions == {}
+    assert not second.repl_pieces and second.suspended is None
+    assert not second.control.cancelled
+    assert second.output_capture.sent_bytes == 0
+
+
+def test_scheduler_queue_limit_and_admission():
+    # No workers: jobs stay queued
+    scheduler = noobie_app.ExecutionScheduler(0, queue_size=2, rate=0, burst=5)
+    job = lambda: None
+    assert scheduler.submit('a', job) is None
+    assert scheduler.submit('a', job) == 'a run is already active for this session'
+    # Continuations of an admitted run skip admission but not the queue limit
+    assert scheduler.submit('a', job, admission=False) is None
+    assert scheduler.submit('b', job) == 'server busy'
+    assert scheduler.submit('a', job, admission=False) == 'server busy'
+    stats = scheduler.stats()
+    assert (stats['queued'], stats['rejected']) == (2, 3)
+    assert scheduler.position() == 2
+
+
+def test_scheduler_token_bucket():
+    scheduler = noobie_app.ExecutionScheduler(1, queue_size=4, rate=0, burst=2)
+    ran = []
+    for expected in [None, None, 'rate limited: too many runs, slow down']:
+        assert scheduler.submit('a', lambda: ran.append(1)) == expected
+        noobie_app.socketio.sleep(0.02)
+    assert ran == [1, 1]
+    # Tokens refill at the configured rate
+    scheduler.rate = 1000
+    noobie_app.socketio.sleep(0.01)
+    assert scheduler.submit('a', lambda: ran.append(1)) is None
+    # Another session has its own bucket
+    scheduler.rate = 0
+    assert scheduler.submit('b', lambda: None) is None
+    scheduler.forget('a')
+    assert 'a' not in scheduler.buckets
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """Record the events output captures send instead of emitting them"""
+    sent = []
+    monkeypatch.setattr(noobie_app, 'send_event', lambda session_id, event, data=None, callback=None:
+                        sent.append((event, data)))
+    return sent
+
+
+def test_output_is_coalesced_into_timed_frames(sent, monkeypatch):
+    monkeypatch.setattr(noobie_app, 'OUTPUT_FRAME_WINDOW', 0.05)
+    capture = noobie_app.WebOutputCapture('frames')
+    capture.write('a\n')
+    capture.write('b\nc')
+    assert sent == []
+    noobie_app.socketio.sleep(0.1)
+    # The partial line waits for its newline
+    assert sent == [('output', {'type': 'stdout', 'lines': ['a', 'b']})]
+    capture.finish()
+    assert sent[-1] == ('output', {'type': 'stdout', 'lines': ['c']})
+
+
+def test_frames_are_sent_once_they_reach_the_size_limit(sent, monkeypatch):
+    monkeypatch.setattr(noobie_app, 'OUTPUT_FRAME_WINDOW', 60)
+    monkeypatch.setattr(noobie_app, 'OUTPUT_FRAME_MAX_BYTES', 8)
+    capture = noobie_app.WebOutputCapture('frames')
+    capture.write('aaaa\n')
+    assert sent == []
+    capture.write('bbbb\n')
+    assert sent == [('output', {'type': 'stdout', 'lines': ['aaaa', 'bbbb']})]
+    # A line that never ends is split at the limit
+    capture.write('x' * 10)
+    assert sent[-1] == ('output', {'type': 'stdout', 'lines': ['x' * 10]})
+
+
+def test_output_over_the_limit_keeps_its_tail(sent, monkeypatch):
+    monkeypatch.setattr(noobie_app, 'OUTPUT_FRAME_WINDOW', 60)
+    monkeypatch.setattr(noobie_app, 'OUTPUT_LIMIT_BYTES', 10)
+    monkeypatch.setattr(noobie_app, 'OUTPUT_TAIL_BYTES', 6)
+    capture = noobie_app.WebOutputCapture('limit')
+    capture.write(''.join(f'l{n}\n' for n in range(1, 9)))
+    assert capture.buffered_bytes() <= 10 + 6
+    capture.finish()
+    assert sent == [
+        ('output', {'type': 'stdout', 'lines': ['l1', 'l2', 'l3']}),
+        ('output', {'type': 'warning', 'lines': ['output truncated, 9 bytes dropped']}),
+        ('output', {'type': 'stdout', 'lines': ['l7', 'l8']}),
+    ]
+    # The limit is per run
+    capture.write('next\n')
+    capture.flush()
+    assert sent[-1] == ('output', {'type': 'stdout', 'lines': ['next']})
+
+
+def test_writer_waits_for_frame_acknowledgements(sent, monkeypatch):
+    monkeypatch.setattr(noobie_app, 'OUTPUT_FRAME_MAX_BYTES', 1)
+    monkeypatch.setattr(noobie_app, 'OUTPUT_MAX_IN_FLIGHT', 1)
+    monkeypatch.setattr(noobie_app, 'OUTPUT_ACK_TIMEOUT', 0.3)
+    capture = noobie_app.WebOutputCapture('acks')
+    capture.write('a\n')
+    capture.write('b\n')
+    assert capture.in_flight == 2
+
+    def ack_later():
+        noobie_app.socketio.sleep(0.05)
+        capture._frame_acked()
+    noobie_app.socketio.start_background_task(ack_later)
+    started = time.monotonic()
+    capture.write('c\n')
+    assert 0.04 < time.monotonic() - started < 0.3
+    assert capture.acks_enabled
+
+    # A client that never acknowledges stops holding the writer after the timeout
+    started = time.monotonic()
+    capture.write('d\n')
+    assert time.monotonic() - started >= 0.3
+    assert not capture.acks_enabled
+    capture.write('e\n')
+    assert [data['lines'] for _, data in sent] == [['a'], ['b'], ['c'], ['d'], ['e']]
+
+
+@pytest.mark.parametrize('query, encoding', [('', 'json'), ('encoding=compact', 'compact'), ('encoding=cbor', 'json')])
+def test_encoding_negotiation(query, encoding):
+    client = noobie_app.socketio.test_client(noobie_app.app, query_string=query)
+    try:
+        (connected,) = [message['args'][0] for message in client.get_received() if message['name'] == 'connected']
+        assert connected['encoding'] == encoding
+        # A different program per case, so none is answered from the result cache
+        client.emit('execute_code', {'code': f'SAY "hi {query}" end\n'})
+        names = set()
+        deadline = time.monotonic() + 5
+        while 'execution_finished' not in names and time.monotonic() < deadline:
+            noobie_app.socketio.sleep(0.01)
+            for message in client.get_received():
+                names.add(decode_event(message['args'][0])[0] if message['name'] == 'frame' else message['name'])
+                if message['name'] == 'frame':
+                    assert encoding == 'compact'
+        assert {'output', 'execution_finished'} <= names
+        # Events without a compact code keep their JSON form
+        assert 'execution_queued' in names
+    finally:
+        client.disconnect()
+
+
+def connect():
+    client = noobie_app.socketio.test_client(noobie_app.app)
+    (connected,) = [message['args'][0] for message in client.get_received() if message['name'] == 'connected']
+    return client, connected['session_id']
+
+
+def test_reaper_evicts_idle_and_oversized_sessions(monkeypatch):
+    reaper = noobie_app.SessionReaper(interval=60, idle_timeout=10, memory_limit=4000)
+    idle, idle_id = connect()
+    large, large_id = connect()
+    busy, busy_id = connect()
+    try:
+        assert line_succeeds(large, 'CREATE STR s "' + 'x' * 5000 + '"') == [True]
+        monkeypatch.setitem(noobie_app.session_activity, idle_id, time.monotonic() - 20)
+        # A program still computing is not idle, however long since its last event
+        monkeypatch.setitem(noobie_app.session_activity, busy_id, time.monotonic() - 20)
+        monkeypatch.setattr(noobie_app.active_sessions[busy_id], 'running', True)
+        reaped = []
+        monkeypatch.setattr(noobie_app, 'send_event', lambda session_id, event, data=None, callback=None:
+                            reaped.append((session_id, data['reason'])))
+        reaper.sweep()
+
+        assert idle_id not in noobie_app.active_sessions and large_id not in noobie_app.active_sessions
+        assert busy_id in noobie_app.active_sessions
+        assert (reaper.stats()['reaped_idle'], reaper.stats()['reaped_memory']) == (1, 1)
+        assert not idle.is_connected() and not large.is_connected() and busy.is_connected()
+        assert reaped == [(idle_id, 'idle'), (large_id, 'memory')]
+    finally:
+        for client in (idle, large, busy):
+            if client.is_connected():
+                client.disconnect()
+
+
+def metric_samples():
+    response = noobie_app.app.test_client().get('/api/metrics')
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == 'text/plain; version=0.0.4; charset=utf-8'
+    samples = {}
+    for line in response.get_data(as_text=True).splitlines():
+        if line.startswith('#'):
+            assert re.match(r'# (HELP|TYPE) noobie_\w+ ', line)
+            continue
+        match = re.fullmatch(r'(noobie_\w+(?:\{[^}]*\})?) (\S+)', line)
+        assert match, line
+        samples[match.group(1)] = float(match.group(2))
+    return samples
+
+
+def test_metrics_endpoint(client):
+    before = metric_samples()
+    client.emit('execute_code', {'code': 'CREATE INT n 0\nINCREMENT n\nSAY "metrics" end\n'})
+    events(client)
+    after = metric_samples()
+    assert after['noobie_statements_executed_total'] >= before['noobie_statements_executed_total'] + 3
+    assert after['noobie_execution_duration_seconds_count'] == before['noobie_execution_duration_seconds_count'] + 1
+    assert after['noobie_execution_duration_seconds_bucket{le="+Inf"}'] == after['noobie_execution_duration_seconds_count']
+
+
+def run_program(client, code):
+    client.emit('execute_code', {'code': code})
+    received = events(client)
+    return 'execution_queued' in [name for name, _ in received], output_text(received, 'stdout')
+
+
+def test_deterministic_session_runs_are_replayed(client):
+    code = f'CREATE INT total {time.monotonic_ns()}\nINCREMENT total\nSAY "total=@total" end\n'
+    assert run_program(client, code)[0]
+    queued, output = run_program(client, code)
+    assert not queued
+    assert output.startswith('total=')
+    # The replay restores the run's variables
+    assert line_succeeds(client, 'INCREMENT total') == [True]
+
+
+def test_random_and_listen_runs_are_not_cached(client):
+    assert [run_program(client, 'RANDOM INT 1 6 r\nSAY "@r" end\n')[0] for _ in range(2)] == [True, True]
+    for _ in range(2):
+        client.emit('execute_code', {'code': 'LISTEN INT a "a? "\nSAY "@a" end\n'})
+        received = events(client, until='input_request')
+        assert 'execution_queued' in [name for name, _ in received]
+        client.emit('provide_input', {'input': '1'})
+        events(client)
+
+
+def test_api_run_caches_by_inputs_and_seed():
+    job = {'code': f'LISTEN INT a "a? "\nRANDOM INT 1 1000000 r\nSAY "@a @r" end # {time.monotonic_ns()}\n',
+           'inputs': [1], 'seed': 3}
+    first = api_run(job)[1]
+    again = api_run(job)[1]
+    assert (first['cached'], again['cached']) == (False, True)
+    assert first['status'] == 'ok' and again['stdout'] == first['stdout']
+    assert api_run(dict(job, inputs=[2]))[1]['cached'] is False
+    unseeded = dict(job, seed=None)
+    assert [api_run(unseeded)[1]['cached'] for _ in range(2)] == [False, False]
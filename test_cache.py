@@ -0,0 +1,44 @@
+"""Tests for the content-addressed result cache"""
+
+from cache import ResultCache, is_deterministic, result_key
+
+
+def test_key_ignores_layout_but_not_what_determines_the_result():
+    key = result_key('batch', 'SAY "a" end\n', [1], None, {'timeout': 1})
+    assert result_key('batch', '  SAY "a" end  \n\n\n', [1], None, {'timeout': 1}) == key
+    assert result_key('batch', 'SAY "b" end\n', [1], None, {'timeout': 1}) != key
+    assert result_key('batch', 'SAY "a" end\n', [2], None, {'timeout': 1}) != key
+    assert result_key('batch', 'SAY "a" end\n', [1], 7, {'timeout': 1}) != key
+    assert result_key('batch', 'SAY "a" end\n', [1], None, {'timeout': 2}) != key
+    assert result_key('session', 'SAY "a" end\n', [1], None, {'timeout': 1}) != key
+
+
+def test_random_and_listen_need_a_seed_and_inputs():
+    assert is_deterministic('CREATE INT a 1\nSAY "a" end\n')
+    assert not is_deterministic('RANDOM INT r 1 6\n')
+    assert is_deterministic('RANDOM INT r 1 6\n', seeded=True)
+    assert not is_deterministic('LISTEN INT a "a? "\n')
+    assert is_deterministic('LISTEN INT a "a? "\n', fixed_inputs=True)
+    # Only executed commands count, not words in strings or comments
+    assert is_deterministic('SAY "RANDOM LISTEN" end # RANDOM\n')
+
+
+def test_lru_is_bounded_by_encoded_size():
+    cache = ResultCache(max_bytes=30, max_entry_bytes=20)
+    cache.put('a', 'x' * 10)
+    cache.put('b', 'y' * 10)
+    assert cache.get('a') == 'x' * 10
+    cache.put('c', 'z' * 10)
+    # b was the least recently used
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == ('x' * 10, 'z' * 10)
+    cache.put('big', 'w' * 30)
+    assert cache.get('big') is None
+    assert cache.stats()['bytes'] <= 30
+
+
+def test_disk_tier_is_shared_between_caches(tmp_path):
+    ResultCache(1000, directory=str(tmp_path)).put('k' * 64, {'stdout': 'hi\n'})
+    other = ResultCache(1000, directory=str(tmp_path))
+    assert other.get('k' * 64) == {'stdout': 'hi\n'}
+    assert other.stats()['disk_hits'] == 1
@@ -0,0 +1,83 @@
+"""Tests for FUNCTION/CALL/RETURN and the memoization of pure functions"""
+
+import io
+
+import pytest
+
+from noobie02 import NoobieInterpreter
+
+FIB = '''FUNCTION fib(n) DO
+IF @n < 2 DO
+RETURN @n
+ENDO
+CALL fib(@n - 1) INTO a
+CALL fib(@n - 2) INTO b
+RETURN {a + b}
+ENDO
+'''
+
+
+def run(code):
+    output = io.StringIO()
+    errors = io.StringIO()
+    interpreter = NoobieInterpreter(output=output, error_output=errors)
+    try:
+        interpreter.interpret(code)
+    except SystemExit:
+        pass
+    return interpreter, output.getvalue(), errors.getvalue()
+
+
+def test_pure_function_is_memoized():
+    interpreter, output, errors = run(FIB + 'CALL fib(80) INTO result\nSAY "fib=@result" end\n')
+    assert (output, errors) == ('fib=23416728348467685\n', '')
+    assert interpreter.functions['fib'].pure
+    assert interpreter.memo_hits > 0
+    # Without the cache fib(80) would take longer than the universe has existed
+    assert interpreter.statements < 2000
+
+
+def test_impure_function_sees_globals_and_is_not_memoized():
+    code = '''CREATE INT total 0
+FUNCTION add(x) DO
+CHANGE total {total + x}
+ENDO
+CALL add(5)
+CALL add(5)
+SAY "total=@total" end
+'''
+    interpreter, output, errors = run(code)
+    assert (output, errors) == ('total=10\n', '')
+    assert not interpreter.functions['add'].pure
+    assert interpreter.memo_hits == 0
+
+
+def test_locals_do_not_leak():
+    code = '''FUNCTION greet(name, times) DO
+CREATE INT i 0
+WHILE @i < @times DO
+SAY "hi " name end
+INCREMENT i
+ENDO
+RETURN "greeted @name"
+ENDO
+CALL greet("bob", 2) INTO message
+SAY message end
+'''
+    interpreter, output, errors = run(code)
+    assert (output, errors) == ('hi bob\nhi bob\ngreeted bob\n', '')
+    assert set(interpreter.variables) == {'message'}
+
+
+@pytest.mark.parametrize('code, message', [
+    ('CALL nowhere(1)\n', "LINE 1 -> ERROR: function 'nowhere' not defined"),
+    (FIB + 'CALL fib(1, 2) INTO x\n', "LINE 9 -> ERROR: function 'fib' takes 1 argument(s), got 2"),
+    ('RETURN 1\n', "LINE 1 -> ERROR: RETURN outside a function"),
+    ('FUNCTION f() DO\nCREATE INT z 1\nENDO\nCALL f() INTO q\n', "LINE 4 -> ERROR: function 'f' returned no value"),
+    ('FUNCTION down(n) DO\nCALL down(@n + 1) INTO x\nRETURN @x\nENDO\nCALL down(0) INTO y\n',
+     "LINE 2 -> ERROR: maximum call depth exceeded (1000)"),
+])
+def test_call_errors(code, message):
+    _, output, errors = run(code)
+    assert output == ''
+    assert errors == message + '\n'
@@ -0,0 +1,92 @@
+"""Tests for the interpreter's execution modes"""
+
+import io
+
+import pytest
+
+from noobie02 import NoobieInterpreter
+from test_validate import FLOW_DEPENDENT
+
+PROGRAMS = [
+    FLOW_DEPENDENT,
+    'CREATE INT n 0\nWHILE @n < 3 DO\nIF @n == 1 DO\nSAY "one" end\nELSE\nSAY "n=@n" end\nENDO\nINCREMENT n\nENDO\n',
+    'SAY "before" end\nCHANGE missing 1\nSAY "after" end\n',
+    'CREATE INT a 1\nIF @a == 1 DO\nSAY "open" end\n',
+]
+
+
+def run(interpreter_method, source):
+    output = io.StringIO()
+    errors = io.StringIO()
+    interpreter = NoobieInterpreter(output=output, error_output=errors)
+    try:
+        getattr(interpreter, interpreter_method)(source)
+    except SystemExit:
+        pass
+    return interpreter, output.getvalue(), errors.getvalue()
+
+
+@pytest.mark.parametrize('code', PROGRAMS)
+def test_streaming_matches_a_normal_run(code):
+    _, output, errors = run('interpret', code)
+    streamed, stream_output, stream_errors = run('interpret_stream', iter(code.splitlines()))
+    assert (stream_output, stream_errors) == (output, errors)
+    assert streamed.open_block == []
+
+
+def test_streaming_buffers_only_the_open_block():
+    seen = []
+
+    def lines(interpreter):
+        for line in ['CREATE INT i 0', 'WHILE @i < 2 DO', 'INCREMENT i', 'ENDO', 'SAY "i=@i" end']:
+            seen.append(list(interpreter.open_block))
+            yield line
+
+    output = io.StringIO()
+    interpreter = NoobieInterpreter(output=output)
+    interpreter.interpret_stream(lines(interpreter))
+    assert output.getvalue() == 'i=2\n'
+    assert seen == [[], [], ['WHILE @i < 2 DO'], ['WHILE @i < 2 DO', 'INCREMENT i'], []]
+
+
+NESTED = '''CREATE INT i 0
+CREATE INT evens 0
+WHILE @i < 4 DO
+CREATE INT j 0
+WHILE @j < 2 DO
+IF @i % 2 == 0 DO
+INCREMENT evens
+ELSE
+IF @j == 1 DO
+SAY "odd @i" end
+ENDO
+ENDO
+INCREMENT j
+ENDO
+INCREMENT i
+ENDO
+SAY "evens=@evens" end
+'''
+
+
+def test_nested_blocks_run_as_spans():
+    interpreter, output, errors = run('interpret', NESTED)
+    assert (output, errors) == ('odd 1\nodd 3\nevens=4\n', '')
+    assert interpreter.frames == []
+    # Headers are parsed once per run and reused on every iteration
+    assert len(interpreter._blocks) == 4
+    assert interpreter.block_cache_hits > interpreter.block_cache_misses
+
+
+def test_errors_in_nested_blocks_report_program_lines():
+    code = 'CREATE INT i 0\nWHILE @i < 2 DO\nIF @i == 1 DO\nCHANGE nope 1\nENDO\nINCREMENT i\nENDO\n'
+    _, output, errors = run('interpret', code)
+    assert errors == "LINE 4 -> ERROR: variable 'nope' not declared\n"
+
+
+def test_block_changes_reach_the_enclosing_program():
+    code = 'CREATE INT a 1\nCREATE INT b 2\nIF @a == 1 DO\nDEL b\nCHANGE a 5\nENDO\n'
+    interpreter, _, errors = run('interpret', code)
+    assert errors == ''
+    assert interpreter.variables['a'].value == 5
+    assert 'b' not in interpreter.variables
@@ -0,0 +1,77 @@
+"""Tests for RunJournal: re-running edited programs from the last unchanged checkpoint"""
+
+import io
+
+from noobie02 import NoobieInterpreter, RunJournal
+
+PROGRAM = '''CREATE INT total 0
+CREATE INT i 0
+WHILE @i < 200 DO
+CHANGE total {total + i}
+INCREMENT i
+ENDO
+CREATE INT gone 1
+DEL gone
+FUNCTION double(n) DO
+RETURN {n * 2}
+ENDO
+SAY "total=@total" end
+CALL double(@total) INTO twice
+SAY "twice=@twice" end
+'''
+
+
+def run(code, previous=None):
+    output = io.StringIO()
+    interpreter = NoobieInterpreter(output=output, error_output=output)
+    interpreter.journal_limit = 10000
+    assert interpreter.start(code, previous) is None
+    return interpreter, output.getvalue()
+
+
+def edited(line, text):
+    lines = PROGRAM.splitlines()
+    lines[line - 1] = text
+    return '\n'.join(lines) + '\n'
+
+
+def test_edited_program_resumes_after_unchanged_lines():
+    first, output = run(PROGRAM)
+    assert output == 'total=19900\ntwice=39800\n'
+
+    code = edited(14, 'SAY "twice is @twice" end')
+    fresh, expected = run(code)
+    resumed, output = run(code, first.journal)
+    assert output == expected == 'total=19900\ntwice is 39800\n'
+    assert resumed.statements_skipped > 0
+    assert resumed.statements < fresh.statements
+    assert resumed.statements_skipped + resumed.statements == fresh.statements
+    # State restored from the checkpoints matches a full run, deleted variables included
+    assert set(resumed.variables) == set(fresh.variables) == {'total', 'i', 'twice'}
+    assert 'double' in resumed.functions
+
+
+def test_change_on_the_first_line_runs_everything():
+    first, _ = run(PROGRAM)
+    resumed, output = run(edited(1, 'CREATE INT total 1'), first.journal)
+    assert resumed.statements_skipped == 0
+    assert output == 'total=19901\ntwice=39802\n'
+
+
+def test_journal_survives_serialization():
+    first, _ = run(PROGRAM)
+    journal = RunJournal.from_dict(first.journal.to_dict())
+    code = edited(14, 'SAY "done" end')
+    resumed, output = run(code, journal)
+    assert output == 'total=19900\ndone\n'
+    assert resumed.statements_skipped > 0
+
+
+def test_recording_stops_at_listen():
+    code = 'CREATE INT a 1\nLISTEN INT b "b? "\nSAY "@a @b" end\n'
+    interpreter = NoobieInterpreter(output=io.StringIO())
+    interpreter.journal_limit = 10000
+    assert interpreter.start(code) == 'b? '
+    assert interpreter.resume('2') is None
+    assert not interpreter.journal.recording
+    assert max(checkpoint[0] for checkpoint in interpreter.journal.checkpoints) <= 1
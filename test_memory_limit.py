@@ -0,0 +1,89 @@
+"""Tests for the per-run memory limit"""
+
+import io
+import sys
+import time
+
+import pytest
+
+from noobie02 import MemoryLimitExceeded, NoobieInterpreter
+from workers import run_job
+
+DOUBLING = 'CREATE STR s "x"\nCREATE INT n 0\nWHILE @n < 40 DO\nCHANGE s {s + s}\nINCREMENT n\nENDO\nSAY "done" end\n'
+
+
+def run(code, limit):
+    output = io.StringIO()
+    errors = io.StringIO()
+    interpreter = NoobieInterpreter(output=output, error_output=errors)
+    interpreter.memory_limit = limit
+    try:
+        interpreter.interpret(code)
+    except SystemExit:
+        pass
+    return interpreter, output.getvalue(), errors.getvalue()
+
+
+def test_growing_value_aborts_on_its_line():
+    interpreter, output, errors = run(DOUBLING, 200000)
+    assert output == ''
+    assert errors == 'LINE 4 -> ERROR: memory limit exceeded (200000 bytes)\n'
+    assert isinstance(interpreter.last_error, MemoryLimitExceeded)
+    # The value that broke the limit is reset, so the session stays usable
+    assert interpreter.variables['s'].value == ''
+    assert interpreter.value_bytes < 200000
+
+
+def test_no_limit_means_no_abort():
+    _, output, errors = run(DOUBLING.replace('@n < 40', '@n < 16'), None)
+    assert (output, errors) == ('done\n', '')
+
+
+def test_function_locals_are_released():
+    code = '''CREATE INT t 0
+FUNCTION pad(a) DO
+CREATE STR big "yyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyyy"
+RETURN {a + 1}
+ENDO
+CALL pad(1) INTO t
+CALL pad(2) INTO t
+SAY "t=@t" end
+'''
+    interpreter, output, errors = run(code, 10 ** 6)
+    assert (output, errors) == ('t=3\n', '')
+    assert interpreter.value_sizes == {'t': interpreter.value_bytes}
+
+
+def test_output_counts_towards_the_limit():
+    job = {'code': 'WHILE 1 == 1 DO\nSAY "xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx" end\nENDO\n',
+           'limits': {'timeout': 5, 'max_statements': 10 ** 7, 'max_output_bytes': 10 ** 7,
+                      'max_memory_bytes': 100000}}
+    result, _ = run_job(job)
+    assert result['status'] == 'memory_exceeded'
+    assert result['error_line'] == 2
+
+
+@pytest.mark.parametrize('code', [
+    'CREATE INT x {9**99999999}\n',
+    'CREATE STR s {"a" * 10**10}\n',
+    'CREATE INT x {1 << 10**10}\n',
+    'CREATE INT x 9**99999999\n',
+    'IF {9**99999999} > 1 DO\nSAY "big" end\nENDO\n',
+])
+def test_oversized_results_are_refused_before_they_are_built(code):
+    started = time.monotonic()
+    interpreter, output, errors = run(code, 10 ** 6)
+    assert time.monotonic() - started < 1
+    assert errors == 'LINE 1 -> ERROR: memory limit exceeded (1000000 bytes)\n'
+    assert isinstance(interpreter.last_error, MemoryLimitExceeded)
+
+
+def test_estimates_within_the_limit_are_computed():
+    _, output, errors = run('CREATE STR s {"ab" * 1000}\nCREATE INT n {2**1000 % 7}\nSAY "@n" end\n', 10 ** 6)
+    assert (output, errors) == ('2\n', '')
+
+
+def test_in_place_commands_are_tracked():
+    interpreter, _, errors = run('CREATE STR s "abc"\nREVERSE s\nCREATE INT i 1\nINCREMENT i\n', 10 ** 6)
+    assert errors == ''
+    assert interpreter.value_sizes == {'s': sys.getsizeof('cba'), 'i': sys.getsizeof(2)}
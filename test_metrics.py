@@ -0,0 +1,32 @@
+"""Tests for the text exposition rendered by metrics.py"""
+
+from metrics import MetricRegistry
+
+
+def test_exposition_format():
+    registry = MetricRegistry()
+    runs = registry.counter('runs_total', 'Runs', ('status',))
+    runs.labels('ok').inc()
+    runs.labels('ok').inc(2)
+    runs.labels('say "hi"\n').inc()
+    registry.gauge('sessions', 'Open sessions', function=lambda: 3)
+    latency = registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1))
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(7)
+
+    assert registry.render() == '''# HELP runs_total Runs
+# TYPE runs_total counter
+runs_total{status="ok"} 3
+runs_total{status="say \\"hi\\"\\n"} 1
+# HELP sessions Open sessions
+# TYPE sessions gauge
+sessions 3
+# HELP latency_seconds Latency
+# TYPE latency_seconds histogram
+latency_seconds_bucket{le="0.1"} 1
+latency_seconds_bucket{le="1"} 2
+latency_seconds_bucket{le="+Inf"} 3
+latency_seconds_sum 7.55
+latency_seconds_count 3
+'''
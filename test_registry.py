@@ -0,0 +1,61 @@
+"""Tests for the session registries"""
+
+import time
+
+import pytest
+
+from registry import LocalRedis, MemorySessionRegistry, RedisSessionRegistry
+
+
+class CountingClient:
+    """Wraps a client and counts the commands sent, pipelined or not"""
+    def __init__(self, client):
+        self.client = client
+        self.commands = 0
+
+    def __getattr__(self, command):
+        self.commands += 1
+        return getattr(self.client, command)
+
+
+@pytest.fixture(params=['memory', 'redis'])
+def registry(request):
+    if request.param == 'memory':
+        return MemorySessionRegistry()
+    return RedisSessionRegistry(LocalRedis(), ttl=60)
+
+
+def test_register_get_remove(registry):
+    registry.register('s1', {'node': 'a', 'sid': '1'})
+    registry.register('s2', {'node': 'b', 'sid': '2'})
+    assert registry.get('s1') == {'node': 'a', 'sid': '1'}
+    assert registry.count() == 2
+    registry.remove('s1')
+    assert registry.get('s1') is None
+    assert registry.count() == 1
+    assert registry.stats()['sessions'] == 1
+
+
+def test_sessions_expire_unless_refreshed():
+    registry = RedisSessionRegistry(LocalRedis(), ttl=0.2)
+    registry.register('kept', {'node': 'a'})
+    registry.register('lost', {'node': 'b'})
+    time.sleep(0.12)
+    registry.refresh(['kept'])
+    time.sleep(0.12)
+    registry.refresh(['kept'])
+    assert registry.get('kept') == {'node': 'a'}
+    assert registry.get('lost') is None
+    assert registry.count() == 1
+    assert registry.client.zcount(registry.index, '-inf', '+inf') == 1
+
+
+def test_refresh_cost_does_not_grow_with_other_sessions():
+    client = CountingClient(LocalRedis())
+    registry = RedisSessionRegistry(client, ttl=60)
+    for number in range(500):
+        registry.register(f"other-{number}", {'node': 'b'})
+    registry.register('mine', {'node': 'a'})
+    client.commands = 0
+    registry.refresh(['mine'])
+    assert client.commands == 1  # a single pipeline
@@ -0,0 +1,65 @@
+"""Tests for interpreter snapshot() / restore()"""
+
+import io
+
+import pytest
+
+from noobie02 import NoobieError, NoobieInterpreter, SNAPSHOT_FORMAT, SNAPSHOT_MAGIC
+
+PROGRAM = '''CREATE INT sum 0
+CREATE INT i 0
+FUNCTION ask(label) DO
+LISTEN INT v "@label? "
+RETURN {v * 10}
+ENDO
+WHILE @i < 2 DO
+CALL ask("n@i") INTO got
+CHANGE sum {sum + got}
+INCREMENT i
+ENDO
+SAY "sum=@sum" end
+'''
+
+
+def interpreter():
+    output = io.StringIO()
+    return NoobieInterpreter(output=output, error_output=output), output
+
+
+def test_suspended_run_continues_after_restore():
+    original, _ = interpreter()
+    assert original.start(PROGRAM) == 'n0? '
+    assert original.resume('1') == 'n1? '
+    data = original.snapshot({'session': 'abc'})
+    assert data.startswith(SNAPSHOT_MAGIC)
+
+    restored, output = interpreter()
+    assert restored.restore(data) == {'session': 'abc'}
+    assert restored.resume('2') is None
+    assert output.getvalue() == 'sum=30\n'
+    assert restored.variables['sum'].value == 30
+
+
+def test_open_repl_block_survives():
+    original, _ = interpreter()
+    original._run(*original.take_statement('CREATE INT a 5'))
+    assert original.take_statement('IF @a == 5 DO') is None
+    assert original.take_statement('SAY "five" end') is None
+
+    restored, output = interpreter()
+    restored.restore(original.snapshot())
+    piece = restored.take_statement('ENDO')
+    assert piece is not None
+    restored._run(*piece)
+    assert output.getvalue() == 'five\n'
+
+
+@pytest.mark.parametrize('data, message', [
+    (b'garbage', 'not an interpreter snapshot'),
+    (SNAPSHOT_MAGIC + bytes([SNAPSHOT_FORMAT + 1]) + b'x', 'unsupported snapshot format'),
+    (SNAPSHOT_MAGIC + bytes([SNAPSHOT_FORMAT]) + b'not zlib', 'corrupt snapshot'),
+])
+def test_bad_snapshots_are_rejected(data, message):
+    target, _ = interpreter()
+    with pytest.raises(NoobieError, match=message):
+        target.restore(data)
@@ -0,0 +1,50 @@
+"""Tests for the quote-aware tokenizer in func.py"""
+
+import io
+
+import pytest
+
+from func import strip_comment, tokenize
+from noobie02 import NoobieInterpreter
+
+
+def pieces(line):
+    return [(str(token), token.kind) for token in tokenize(line)]
+
+
+def test_words_references_and_expressions():
+    assert pieces('CHANGE total {total + @step * 2}') == [
+        ('CHANGE', 'word'), ('total', 'word'), ('{total + @step * 2}', 'expr')]
+    assert pieces('SWAP @a ?b') == [('SWAP', 'word'), ('@a', 'ref'), ('?b', 'ref')]
+
+
+def test_quoted_strings_are_one_token():
+    assert pieces('SAY "hello   world" end') == [('SAY', 'word'), ('"hello   world"', 'string'), ('end', 'word')]
+    assert pieces("SAY 'a b' end") == [('SAY', 'word'), ("'a b'", 'string'), ('end', 'word')]
+
+
+def test_comments_end_the_line_outside_quotes_only():
+    assert pieces('SAY "a # b" end # note') == [('SAY', 'word'), ('"a # b"', 'string'), ('end', 'word')]
+    assert pieces("CHANGE s {s + '#'} # note") == [('CHANGE', 'word'), ('s', 'word'), ("{s + '#'}", 'expr')]
+    assert pieces('# only a comment') == []
+    assert pieces('INCREMENT i#trailing') == [('INCREMENT', 'word'), ('i', 'word')]
+
+
+def test_unterminated_quote_runs_to_the_end():
+    assert pieces('SAY "open # still text') == [('SAY', 'word'), ('"open # still text', 'string')]
+
+
+@pytest.mark.parametrize('line, stripped', [
+    ('SAY "x" end   # comment', 'SAY "x" end'),
+    ('SAY "# not a comment" end', 'SAY "# not a comment" end'),
+    ('  INCREMENT i  ', 'INCREMENT i'),
+    ('# all comment', ''),
+])
+def test_strip_comment(line, stripped):
+    assert strip_comment(line) == stripped
+
+
+def test_hash_in_strings_reaches_the_output():
+    output = io.StringIO()
+    NoobieInterpreter(output=output).interpret('CREATE STR tag "#1"  # the first\nSAY "tag @tag # ok" end\n')
+    assert output.getvalue() == 'tag #1 # ok\n'
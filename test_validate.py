@@ -0,0 +1,107 @@
+"""Tests for the static validate() pass"""
+
+import os
+import subprocess
+import sys
+
+from noobie02 import IncrementalValidator, validate
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Runs fine: the loop creates x before the branch changing it is taken
+FLOW_DEPENDENT = '''CREATE INT i 0
+WHILE i < 3 DO
+IF i == 1 DO
+CHANGE x {x + 1}
+ELSE
+CREATE INT x 10
+ENDO
+INCREMENT i
+ENDO
+SAY "x=" x end
+'''
+
+
+def messages(errors):
+    return [(error.line_number, str(error)) for error in errors]
+
+
+def test_valid_program_has_no_findings():
+    warnings = []
+    assert validate('CREATE INT a 1\nINCREMENT a\nSAY "a=@a" end\n', warnings) == []
+    assert warnings == []
+
+
+def test_flow_dependent_declaration_is_only_a_warning():
+    warnings = []
+    assert validate(FLOW_DEPENDENT, warnings) == []
+    assert messages(warnings) == [(4, "variable 'x' may not be declared")]
+
+
+def test_structural_errors():
+    code = 'SAY "a" end\nENDO\nIF 1 == 1 DO\nELSE\nELSE\nWHILE 1 == 1 DO\n'
+    assert messages(validate(code)) == [
+        (2, "ENDO without matching IF or WHILE"),
+        (3, "missing ENDO for IF statement"),
+        (5, "ELSE without matching IF"),
+        (6, "missing ENDO for WHILE statement"),
+    ]
+
+
+def test_unknown_command_and_arity():
+    errors = messages(validate('FOO 1\nSWAP a\nCREATE BANANA b 1\n'))
+    assert errors[0] == (1, "Unknown command: foo")
+    assert errors[1][0] == 2 and 'SWAP' in errors[1][1]
+    assert errors[2] == (3, "unsupported type: BANANA")
+
+
+def test_commented_lines_are_skipped():
+    assert validate('## \nFOO 1\n##\nSAY "ok" end # FOO\n') == []
+
+
+def noobie(*args):
+    return subprocess.run([sys.executable, 'noobie02.py', *args], capture_output=True, text=True, cwd=HERE)
+
+
+def test_check_flag_exit_status(tmp_path):
+    program = tmp_path / 'flow.noob'
+    program.write_text(FLOW_DEPENDENT)
+    check = noobie('--check', str(program))
+    assert check.returncode == 0
+    assert check.stderr == "LINE 4 -> WARNING: variable 'x' may not be declared\n"
+    assert noobie(str(program)).stdout == 'x=10\n'
+
+    program.write_text('FOO 1\n')
+    check = noobie('--check', str(program))
+    assert check.returncode == 1
+    assert check.stderr == "LINE 1 -> ERROR: Unknown command: foo\n"
+
+
+def test_function_parameters_are_local_to_the_body():
+    code = 'FUNCTION twice(n) DO\nCREATE INT doubled {n * 2}\nRETURN @doubled\nENDO\nCHANGE n 1\nCHANGE doubled 2\n'
+    warnings = []
+    assert validate(code, warnings) == []
+    assert messages(warnings) == [(5, "variable 'n' may not be declared"), (6, "variable 'doubled' may not be declared")]
+
+
+def test_incremental_diagnostics_match_validate():
+    document = IncrementalValidator('CREATE INT a 1\nSAY "a" end\n')
+    warnings = []
+    assert document.diagnostics(warnings) == [] and warnings == []
+
+    document.apply_edit(1, 2, ['CHANGE b 2', 'FOO'])
+    warnings = []
+    errors = document.diagnostics(warnings)
+    assert messages(errors) == [(3, "Unknown command: foo")]
+    assert messages(warnings) == [(2, "variable 'b' may not be declared")]
+
+    document.set_text(FLOW_DEPENDENT)
+    warnings = []
+    assert document.diagnostics(warnings) == []
+    assert messages(warnings) == messages(_warnings_of(FLOW_DEPENDENT))
+
+
+def _warnings_of(code):
+    warnings = []
+    validate(code, warnings)
+    return warnings
@@ -0,0 +1,55 @@
+"""Tests for the compact event encoding in wire.py"""
+
+import pytest
+
+from wire import EVENT_CODES, _pack_into, _unpack_from, decode_event, encode_event, pack, unpack
+
+VALUES = [
+    None, True, False, 0, 127, 128, 255, 256, 65536, 2 ** 32, 2 ** 63, -1, -32, -33, -2 ** 31, -2 ** 63,
+    1.5, -0.25, '', 'short', 'x' * 31, 'y' * 200, 'z' * 70000, 'città ✓', b'\x00\x01', b'b' * 300,
+    [], [1, [2, [3]]], list(range(20)), {'a': 1, 'b': [None]}, {str(n): n for n in range(20)},
+]
+
+
+def fallback_round_trip(value):
+    out = bytearray()
+    _pack_into(value, out)
+    decoded, end = _unpack_from(bytes(out), 0)
+    assert end == len(out)
+    return decoded
+
+
+@pytest.mark.parametrize('value', VALUES)
+def test_pack_round_trips(value):
+    assert unpack(pack(value)) == value
+    assert fallback_round_trip(value) == value
+
+
+def test_fallback_matches_the_msgpack_format():
+    out = bytearray()
+    _pack_into([1, 'a', None, True, -1, 300], out)
+    assert bytes(out) == b'\x96\x01\xa1a\xc0\xc3\xff\xcd\x01\x2c'
+
+
+@pytest.mark.parametrize('event, data', [
+    ('output', {'type': 'stdout', 'lines': ['a', '', 'b']}),
+    ('output', {'type': 'custom', 'lines': ['x']}),
+    ('line_executed', {'line': 'INCREMENT a', 'success': False, 'error': 'boom', 'pending': None}),
+    ('input_request', {'prompt': 'a? '}),
+    ('execution_finished', {}),
+])
+def test_events_round_trip(event, data):
+    name, decoded = decode_event(encode_event(event, data))
+    assert name == event
+    assert isinstance(decoded.pop('timestamp'), int)
+    assert decoded == {field: data.get(field) for field in EVENT_CODES[event][1]}
+
+
+def test_single_text_output_is_sent_as_lines():
+    _, decoded = decode_event(encode_event('output', {'type': 'error', 'text': 'Error: x\n'}))
+    assert (decoded['type'], decoded['lines']) == ('error', ['Error: x\n'])
+
+
+def test_unknown_event_code_is_rejected():
+    with pytest.raises(ValueError):
+        decode_event(pack([99, 0]))
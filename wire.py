@@ -0,0 +1,205 @@
+"""Compact binary encoding for high-volume Socket.IO events.
+
+Clients that negotiate the 'compact' encoding receive these events as a
+single binary 'frame' event: a msgpack array holding an integer event code,
+an epoch-millisecond timestamp and the event's fields in a fixed order.
+"""
+
+import time
+import struct
+from typing import Any, Dict, List, Tuple
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Event name -> (code, ordered field names)
+EVENT_CODES: Dict[str, Tuple[int, Tuple[str, ...]]] = {
+    'output': (1, ('type', 'lines')),
+    'line_executed': (2, ('line', 'success', 'error', 'pending')),
+    'input_request': (3, ('prompt',)),
+    'execution_started': (4, ()),
+    'execution_finished': (5, ()),
+}
+
+# Output types are sent as their index in this list
+OUTPUT_TYPES: List[str] = ['stdout', 'stderr', 'error', 'warning', 'input_echo', 'info', 'success']
+
+
+def _pack_into(obj: Any, out: bytearray):
+    """Append the msgpack encoding of obj to out"""
+    if obj is None:
+        out.append(0xc0)
+    elif obj is True:
+        out.append(0xc3)
+    elif obj is False:
+        out.append(0xc2)
+    elif isinstance(obj, int):
+        if 0 <= obj <= 0x7f:
+            out.append(obj)
+        elif -32 <= obj < 0:
+            out.append(obj & 0xff)
+        elif 0 <= obj <= 0xff:
+            out += bytes((0xcc, obj))
+        elif 0 <= obj <= 0xffff:
+            out += b'\xcd' + struct.pack('>H', obj)
+        elif 0 <= obj <= 0xffffffff:
+            out += b'\xce' + struct.pack('>I', obj)
+        elif -0x80000000 <= obj < 0:
+            out += b'\xd2' + struct.pack('>i', obj)
+        elif 0 <= obj <= 0xffffffffffffffff:
+            out += b'\xcf' + struct.pack('>Q', obj)
+        elif -0x8000000000000000 <= obj < 0:
+            out += b'\xd3' + struct.pack('>q', obj)
+        else:
+            _pack_into(str(obj), out)
+    elif isinstance(obj, float):
+        out += b'\xcb' + struct.pack('>d', obj)
+    elif isinstance(obj, str):
+        data = obj.encode('utf-8')
+        size = len(data)
+        if size < 32:
+            out.append(0xa0 | size)
+        elif size < 0x100:
+            out += bytes((0xd9, size))
+        elif size < 0x10000:
+            out += b'\xda' + struct.pack('>H', size)
+        else:
+            out += b'\xdb' + struct.pack('>I', size)
+        out += data
+    elif isinstance(obj, (bytes, bytearray)):
+        size = len(obj)
+        if size < 0x100:
+            out += bytes((0xc4, size))
+        elif size < 0x10000:
+            out += b'\xc5' + struct.pack('>H', size)
+        else:
+            out += b'\xc6' + struct.pack('>I', size)
+        out += obj
+    elif isinstance(obj, (list, tuple)):
+        size = len(obj)
+        if size < 16:
+            out.append(0x90 | size)
+        elif size < 0x10000:
+            out += b'\xdc' + struct.pack('>H', size)
+        else:
+            out += b'\xdd' + struct.pack('>I', size)
+        for item in obj:
+            _pack_into(item, out)
+    elif isinstance(obj, dict):
+        size = len(obj)
+        if size < 16:
+            out.append(0x80 | size)
+        elif size < 0x10000:
+            out += b'\xde' + struct.pack('>H', size)
+        else:
+            out += b'\xdf' + struct.pack('>I', size)
+        for key, value in obj.items():
+            _pack_into(key, out)
+            _pack_into(value, out)
+    else:
+        _pack_into(str(obj), out)
+
+
+def pack(obj: Any) -> bytes:
+    """Encode obj with msgpack"""
+    if msgpack is not None:
+        return msgpack.packb(obj, use_bin_type=True)
+    out = bytearray()
+    _pack_into(obj, out)
+    return bytes(out)
+
+
+def _unpack_from(data: bytes, pos: int) -> Tuple[Any, int]:
+    """Decode one msgpack value from data at pos, returning (value, next pos)"""
+    tag = data[pos]
+    pos += 1
+    if tag <= 0x7f:
+        return tag, pos
+    if tag >= 0xe0:
+        return tag - 0x100, pos
+    if 0xa0 <= tag <= 0xbf:
+        size = tag & 0x1f
+        return data[pos:pos + size].decode('utf-8'), pos + size
+    if 0x90 <= tag <= 0x9f:
+        return _unpack_items(data, pos, tag & 0x0f)
+    if 0x80 <= tag <= 0x8f:
+        return _unpack_map(data, pos, tag & 0x0f)
+    if tag == 0xc0:
+        return None, pos
+    if tag == 0xc2:
+        return False, pos
+    if tag == 0xc3:
+        return True, pos
+    if tag in (0xcc, 0xcd, 0xce, 0xcf, 0xd0, 0xd1, 0xd2, 0xd3, 0xca, 0xcb):
+        fmt = {0xcc: '>B', 0xcd: '>H', 0xce: '>I', 0xcf: '>Q', 0xd0: '>b', 0xd1: '>h',
+               0xd2: '>i', 0xd3: '>q', 0xca: '>f', 0xcb: '>d'}[tag]
+        size = struct.calcsize(fmt)
+        return struct.unpack_from(fmt, data, pos)[0], pos + size
+    if tag in (0xd9, 0xda, 0xdb, 0xc4, 0xc5, 0xc6):
+        fmt = {0xd9: '>B', 0xda: '>H', 0xdb: '>I', 0xc4: '>B', 0xc5: '>H', 0xc6: '>I'}[tag]
+        size = struct.unpack_from(fmt, data, pos)[0]
+        pos += struct.calcsize(fmt)
+        raw = data[pos:pos + size]
+        return (raw.decode('utf-8') if tag in (0xd9, 0xda, 0xdb) else bytes(raw)), pos + size
+    if tag in (0xdc, 0xdd):
+        fmt = '>H' if tag == 0xdc else '>I'
+        size = struct.unpack_from(fmt, data, pos)[0]
+        return _unpack_items(data, pos + struct.calcsize(fmt), size)
+    if tag in (0xde, 0xdf):
+        fmt = '>H' if tag == 0xde else '>I'
+        size = struct.unpack_from(fmt, data, pos)[0]
+        return _unpack_map(data, pos + struct.calcsize(fmt), size)
+    raise ValueError(f"unsupported msgpack tag: {tag:#x}")
+
+
+def _unpack_items(data: bytes, pos: int, size: int) -> Tuple[list, int]:
+    items = []
+    for _ in range(size):
+        item, pos = _unpack_from(data, pos)
+        items.append(item)
+    return items, pos
+
+
+def _unpack_map(data: bytes, pos: int, size: int) -> Tuple[dict, int]:
+    result = {}
+    for _ in range(size):
+        key, pos = _unpack_from(data, pos)
+        result[key], pos = _unpack_from(data, pos)
+    return result, pos
+
+
+def unpack(data: bytes) -> Any:
+    """Decode a msgpack value"""
+    if msgpack is not None:
+        return msgpack.unpackb(data, raw=False)
+    return _unpack_from(data, 0)[0]
+
+
+def encode_event(event: str, data: Dict[str, Any]) -> bytes:
+    """Encode a high-volume event as [code, epoch ms, *fields]"""
+    code, fields = EVENT_CODES[event]
+    values = []
+    for field in fields:
+        if field == 'lines':
+            values.append(data.get('lines') or [data.get('text', '')])
+        elif field == 'type':
+            output_type = data.get('type')
+            values.append(OUTPUT_TYPES.index(output_type) if output_type in OUTPUT_TYPES else output_type)
+        else:
+            values.append(data.get(field))
+    return pack([code, int(time.time() * 1000)] + values)
+
+
+def decode_event(payload: bytes) -> Tuple[str, Dict[str, Any]]:
+    """Decode a frame produced by encode_event back into (event, data)"""
+    code, timestamp, *values = unpack(payload)
+    for event, (event_code, fields) in EVENT_CODES.items():
+        if event_code == code:
+            data = dict(zip(fields, values))
+            if isinstance(data.get('type'), int):
+                data['type'] = OUTPUT_TYPES[data['type']]
+            data['timestamp'] = timestamp
+            return event, data
+    raise ValueError(f"unknown event code: {code}")
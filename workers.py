@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+"""Worker processes that run Noobie programs outside the web server process.
+
+The server talks to each worker over its stdin/stdout with one JSON message
+per line. Program output travels back over the same pipe, so a CPU-bound
+program never blocks the server's event loop. A program reaching LISTEN is
+suspended and its state handed back, so no worker waits on a user.
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import threading
+import subprocess
+
+from func import *
+from noobie02 import NoobieInterpreter, ExecutionControl, StatementLimitExceeded, MemoryLimitExceeded, RunJournal
+
+WORKER_SCRIPT = os.path.abspath(__file__)
+
+# Seconds a worker gets past a batch job's timeout to report the timeout
+# itself before it is killed; a single slow statement never reaches the
+# interpreter's own deadline check
+WORKER_TIMEOUT_GRACE = 1.0
+
+
+class WorkerCrashed(Exception):
+    """Raised when a worker process stops answering"""
+
+
+class WorkerTimeout(Exception):
+    """Raised when a worker has not answered by a run's deadline"""
+
+
+class ChannelWriter:
+    """File-like object forwarding interpreter output to the server"""
+    def __init__(self, send, output_type):
+        self.send = send
+        self.output_type = output_type
+
+    def write(self, text):
+        if text:
+            self.send({'event': 'output', 'type': self.output_type, 'text': text})
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class InputExhausted(NoobieError):
+    """Raised when a non-interactive job runs out of LISTEN inputs"""
+
+
+class CaptureWriter:
+    """File-like buffer keeping at most limit characters of output"""
+    def __init__(self, limit):
+        self.limit = limit
+        self.parts = []
+        self.size = 0
+        self.truncated = False
+
+    def write(self, text):
+        room = self.limit - self.size
+        if len(text) > room:
+            self.truncated = True
+            text = text[:max(room, 0)]
+        if text:
+            self.parts.append(text)
+            self.size += len(text)
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return ''.join(self.parts)
+
+    def buffered_bytes(self):
+        return self.size
+
+
+def run_job(job, control=None):
+    """Run a non-interactive job and return (result, run stats).
+
+    job holds 'code', 'inputs' answering each LISTEN in order, an optional
+    'seed' for RANDOM and 'limits' with 'timeout' (seconds),
+    'max_statements', 'max_output_bytes' and optionally 'max_memory_bytes'.
+    The result is JSON-friendly.
+    """
+    control = control or ExecutionControl()
+    limits = job['limits']
+    stdout = CaptureWriter(limits['max_output_bytes'])
+    stderr = CaptureWriter(limits['max_output_bytes'])
+    inputs = list(job.get('inputs') or [])
+
+    def next_input(prompt=''):
+        # Prompts are part of the transcript, as on the command line
+        stdout.write(prompt)
+        if not inputs:
+            raise InputExhausted("no input left for LISTEN")
+        return str(inputs.pop(0))
+
+    interpreter = NoobieInterpreter(output=stdout, error_output=stderr, input_provider=next_input, control=control)
+    interpreter.statement_limit = limits['max_statements']
+    interpreter.memory_limit = limits.get('max_memory_bytes')
+    # On the thread backend the job shares the server's event loop
+    interpreter.cooperative = True
+    if job.get('seed') is not None:
+        interpreter.rng.seed(job['seed'])
+
+    started = time.perf_counter()
+    interpreter.deadline = time.monotonic() + limits['timeout']
+    try:
+        interpreter.interpret(job['code'])
+    except SystemExit:
+        pass
+    duration = time.perf_counter() - started
+
+    error = interpreter.last_error
+    if control.cancelled:
+        status = 'timeout'
+    elif isinstance(error, InputExhausted):
+        status = 'input_exhausted'
+    elif isinstance(error, StatementLimitExceeded):
+        status = 'limit_exceeded'
+    elif isinstance(error, MemoryLimitExceeded):
+        status = 'memory_exceeded'
+    elif error is not None:
+        status = 'error'
+    else:
+        status = 'ok'
+
+    result = {
+        'status': status,
+        'stdout': stdout.getvalue(),
+        'stderr': stderr.getvalue(),
+        'error': str(error) if error is not None else None,
+        'error_line': error.line_number if error is not None else None,
+        'statements': interpreter.statements,
+        'duration_ms': round(duration * 1000, 3),
+        'truncated': stdout.truncated or stderr.truncated,
+    }
+    return result, interpreter.run_stats()
+
+
+def timed_out_job(duration):
+    """(result, run stats) of a job whose worker was killed at its deadline"""
+    result = {
+        'status': 'timeout',
+        'stdout': '',
+        'stderr': '',
+        'error': None,
+        'error_line': None,
+        'statements': 0,
+        'duration_ms': round(duration * 1000, 3),
+        'truncated': False,
+    }
+    stats = {'statements': 0, 'statements_skipped': 0, 'errors': 0,
+             'block_cache_hits': 0, 'block_cache_misses': 0, 'memo_hits': 0}
+    return result, stats
+
+
+def worker_main():
+    """Serve run requests from the parent process until its pipe closes"""
+    channel = sys.stdout
+    channel_lock = threading.Lock()
+    jobs = queue.Queue()
+    control = ExecutionControl()
+
+    def send(message):
+        with channel_lock:
+            channel.write(json.dumps(message) + '\n')
+            channel.flush()
+
+    def read_commands():
+        for raw in sys.stdin:
+            message = json.loads(raw)
+            op = message['op']
+            if op in ('run', 'continue', 'batch'):
+                # Requests for the previous run must not leak into this one
+                control.clear()
+                jobs.put(message)
+            elif op == 'stop':
+                control.stop()
+            elif op == 'pause':
+                control.pause()
+            elif op == 'resume':
+                control.resume()
+        # The server went away: end the current run and let the loop exit
+        control.stop()
+        jobs.put(None)
+
+    threading.Thread(target=read_commands, daemon=True).start()
+
+    # The real stdout is reserved for the channel; stray prints go to the log
+    sys.stdout = sys.stderr
+    error_output = ChannelWriter(send, 'stderr')
+
+    interpreter = NoobieInterpreter(
+        output=ChannelWriter(send, 'stdout'),
+        error_output=error_output,
+        control=control,
+    )
+    send({'event': 'ready'})
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+
+        if job['op'] == 'batch':
+            result, stats = run_job(job['job'], control)
+            send({'event': 'result', 'result': result, 'stats': stats})
+            continue
+
+        interpreter.reset()
+        interpreter.memory_limit = job.get('memory_limit')
+        prompt = None
+        try:
+            if job['op'] == 'run':
+                interpreter.journal_limit = job.get('journal_limit')
+                previous = job.get('journal')
+                prompt = interpreter.start(job['code'], RunJournal.from_dict(previous) if previous else None)
+            else:
+                interpreter.set_state(job['state'])
+                prompt = interpreter.resume(job['text'])
+        except SystemExit:
+            pass
+        except Exception as e:
+            error_output.write(f"Execution error: {e}\n")
+
+        stats = interpreter.run_stats()
+        if prompt is not None:
+            send({'event': 'suspended', 'prompt': prompt, 'state': interpreter.get_state(), 'stats': stats})
+        else:
+            journal = interpreter.journal.to_dict() if interpreter.journal is not None else None
+            send({'event': 'finished', 'variables': encode_variables(interpreter.variables),
+                  'journal': journal, 'stats': stats})
+
+
+class WorkerProcess:
+    """Handle on a single worker process"""
+    def __init__(self):
+        self.runs = 0
+        self.send_lock = threading.Lock()
+        self.process = subprocess.Popen(
+            [sys.executable, WORKER_SCRIPT],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            encoding='utf-8',
+            bufsize=1,
+        )
+        # Messages are read on their own thread so receive() can give up at a deadline
+        self.messages = queue.Queue()
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        try:
+            for line in self.process.stdout:
+                self.messages.put(line)
+        except (OSError, ValueError):
+            pass
+        self.messages.put(None)
+
+    def send(self, message):
+        # Stop/pause requests arrive from other threads than the run loop
+        with self.send_lock:
+            self.process.stdin.write(json.dumps(message) + '\n')
+            self.process.stdin.flush()
+
+    def signal(self, op):
+        """Forward a stop/pause/resume request; a dead worker is recycled anyway"""
+        try:
+            self.send({'op': op})
+        except (OSError, ValueError):
+            pass
+
+    def receive(self, timeout=None):
+        try:
+            line = self.messages.get(timeout=timeout)
+        except queue.Empty:
+            raise WorkerTimeout("worker did not answer in time")
+        if line is None:
+            raise WorkerCrashed("worker process exited")
+        return json.loads(line)
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def stop(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=1)
+        except Exception:
+            self.process.kill()
+
+    def kill(self):
+        """End the process at once, e.g. when it is stuck in a single statement"""
+        try:
+            self.process.kill()
+            self.process.wait(timeout=1)
+        except Exception:
+            pass
+
+
+class ProcessWorkerPool:
+    """Pool of pre-started worker processes, each recycled after max_runs runs.
+    
+    With memory_limit set, interactive runs are held to that many bytes of
+    values and buffered output (see NoobieInterpreter.memory_limit).
+    """
+    def __init__(self, size, max_runs=100, memory_limit=None):
+        self.size = size
+        self.max_runs = max_runs
+        self.memory_limit = memory_limit
+        self.recycled = 0
+        self.killed = 0  # workers killed at a batch job's deadline
+        self.idle = queue.Queue()
+        for _ in range(size):
+            self.idle.put(WorkerProcess())
+
+    def run(self, code, write_output, control=None, journal=None, journal_limit=None):
+        """Run code on a free worker; see _outcome for the result.
+        
+        With journal_limit set the run records a RunJournal, and journal (a
+        RunJournal.to_dict() of an earlier run) lets it skip what that run
+        already executed.
+        """
+        request = {'op': 'run', 'code': code, 'journal': journal, 'journal_limit': journal_limit,
+                   'memory_limit': self.memory_limit}
+        return self._outcome(self._execute(request, write_output, control))
+
+    def resume(self, state, text, write_output, control=None):
+        """Continue a suspended run on any free worker, answering its LISTEN with text"""
+        request = {'op': 'continue', 'state': state, 'text': text, 'memory_limit': self.memory_limit}
+        return self._outcome(self._execute(request, write_output, control))
+
+    def batch(self, job):
+        """Run a non-interactive job (see run_job) and return (result, stats).
+        
+        A worker that has not answered shortly after the job's timeout is
+        killed and replaced, and the job reported as timed out.
+        """
+        started = time.monotonic()
+        deadline = started + job['limits']['timeout'] + WORKER_TIMEOUT_GRACE
+        try:
+            message = self._execute({'op': 'batch', 'job': job}, None, None, deadline)
+        except WorkerTimeout:
+            self.killed += 1
+            return timed_out_job(time.monotonic() - started)
+        return message['result'], message['stats']
+
+    @staticmethod
+    def _outcome(message):
+        """Return (variables, suspended, stats, journal), suspended being (prompt, state) for
+        a run parked at LISTEN, stats the interpreter's run_stats() for this part of the run
+        and journal the finished run's RunJournal.to_dict(), if it recorded one.
+        """
+        if message['event'] == 'suspended':
+            state = message['state']
+            return decode_variables(state['variables']), (message['prompt'], state), message['stats'], None
+        return decode_variables(message['variables']), None, message['stats'], message.get('journal')
+
+    def _execute(self, request, write_output, control, deadline=None):
+        """Send request to a free worker and return the message that ends it.
+
+        write_output(output_type, text) receives program output as it arrives.
+        Stop/pause requests on control are forwarded to the worker. Past
+        deadline (time.monotonic()) WorkerTimeout is raised and the worker
+        killed.
+        """
+        worker = self.idle.get()
+        finished = False
+        try:
+            worker.send(request)
+            if control is not None:
+                control.relay = worker.signal
+                # Requests made while the run was queued
+                if control.cancelled:
+                    worker.signal('stop')
+                elif control.paused:
+                    worker.signal('pause')
+            while True:
+                message = worker.receive(None if deadline is None else max(0, deadline - time.monotonic()))
+                event = message['event']
+                if event == 'output':
+                    write_output(message['type'], message['text'])
+                elif event in ('finished', 'suspended', 'result'):
+                    finished = True
+                    worker.runs += 1
+                    return message
+        except (OSError, ValueError, WorkerCrashed) as e:
+            raise NoobieError(f"worker process failed: {e}")
+        finally:
+            if control is not None:
+                control.relay = None
+            # A worker abandoned mid-run is never handed out again
+            if not finished or worker.runs >= self.max_runs or not worker.alive():
+                if finished:
+                    worker.stop()
+                else:
+                    worker.kill()
+                worker = WorkerProcess()
+                self.recycled += 1
+            self.idle.put(worker)
+
+    def shutdown(self):
+        """Stop every idle worker process"""
+        while True:
+            try:
+                self.idle.get_nowait().stop()
+            except queue.Empty:
+                break
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'idle': self.idle.qsize(),
+            'max_runs': self.max_runs,
+            'memory_limit': self.memory_limit,
+            'recycled': self.recycled,
+            'killed': self.killed,
+        }
+
+
+if __name__ == '__main__':
+    worker_main()